@@ -0,0 +1,45 @@
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Each statement runs in a fresh interpreter, as in a newly spawned worker. Heavy modules must not be imported by the lightweight statements.
+STATEMENTS = {
+    'enums': dict(code='import mobile_traffic; mobile_traffic.City, mobile_traffic.Service', forbidden=['xarray', 'geopandas', 'joblib', 'tqdm', 'pandas'], max_seconds=0.1),
+    'load': dict(code='import mobile_traffic; mobile_traffic.load_traffic_data', forbidden=['geopandas', 'tqdm'], max_seconds=None),
+    'aggregate': dict(code='import mobile_traffic; mobile_traffic.get_night_traffic_by_tile_service_time_city', forbidden=[], max_seconds=None),
+}
+N_REPEATS = 5
+
+
+def run_statement(code: str, forbidden: list):
+    # The child reports its own import time and which of the forbidden modules ended up in sys.modules.
+    child = f'import sys, time; start = time.perf_counter(); {code}; seconds = time.perf_counter() - start; import json; print(json.dumps({{"seconds": seconds, "imported": [m for m in {forbidden!r} if m in sys.modules]}}))'
+    output = subprocess.run([sys.executable, '-c', child], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of mobile_traffic in fresh interpreters and check that heavy dependencies are deferred.')
+    parser.add_argument('--repeats', type=int, default=N_REPEATS)
+    parser.add_argument('--output', default=None, help='JSON lines file the results are appended to.')
+    args = parser.parse_args()
+
+    failed = False
+    for name, statement in STATEMENTS.items():
+        runs = [run_statement(code=statement['code'], forbidden=statement['forbidden']) for _ in range(args.repeats)]
+        seconds = statistics.median(r['seconds'] for r in runs)
+        imported = sorted(set(m for r in runs for m in r['imported']))
+        too_slow = statement['max_seconds'] is not None and seconds > statement['max_seconds']
+        failed = failed or too_slow or bool(imported)
+        result = {'statement': name, 'median_seconds': seconds, 'forbidden_imported': imported, 'max_seconds': statement['max_seconds'], 'ok': not too_slow and not imported}
+        print(json.dumps(result))
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
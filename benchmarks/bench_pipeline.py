@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time as time_
+import argparse
+import tempfile
+import resource
+import platform
+import tracemalloc
+import subprocess
+from datetime import date, time, datetime
+
+from joblib.externals.loky import get_reusable_executor
+
+import mobile_traffic as mt
+from mobile_traffic import aggregate, clean, load, file_io, synthetic
+
+# Wikipedia is always included because the tile index of a city is read from one of its files.
+# Each preset generates, loads and aggregates n_day days only. A full-scale Paris file is ~96 MB, so the paris preset is 2 services x 3 days x UL/DL, ~1.2 GB.
+SCALES = {
+    'small': dict(city=mt.City.DIJON, n_service=3, n_day=7, scale=0.05, density=0.5),
+    'medium': dict(city=mt.City.DIJON, n_service=10, n_day=14, scale=0.25, density=0.3),
+    'paris': dict(city=mt.City.PARIS, n_service=2, n_day=3, scale=1.0, density=0.3),
+}
+START_NIGHT, END_NIGHT = time(22), time(6)
+# The days start on Monday 2019-03-18, so that the first nights are not removed as nights before a weekend day.
+FIRST_DAY = 2
+# The tile index of a city is read from its Wikipedia file of this day, see load.get_location_list, so that file is generated whatever the days of the preset.
+TILE_INDEX_DAY = date(2019, 4, 1)
+
+
+def measure(func, **kwargs):
+    tracemalloc.start()
+    start = time_.perf_counter()
+    result = func(**kwargs)
+    seconds = time_.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_traced_bytes': peak_bytes, 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def run_scale(name: str, folder_path: str):
+    config = SCALES[name]
+    city = config['city']
+    service = [mt.Service.WIKIPEDIA] + [s for s in mt.Service if s != mt.Service.WIKIPEDIA][:config['n_service'] - 1]
+    day = mt.TimeOptions.get_days()[FIRST_DAY:FIRST_DAY + config['n_day']]
+
+    if not os.path.exists(os.path.join(folder_path, 'tile', city.value)):
+        _, metrics = measure(synthetic.generate_synthetic_data, folder_path=folder_path, city=[city], service=service, day=day, scale=config['scale'], density=config['density'])
+        yield 'generate', metrics
+        if TILE_INDEX_DAY not in day:
+            synthetic.generate_synthetic_data(folder_path=folder_path, city=[city], service=[mt.Service.WIKIPEDIA], day=[TILE_INDEX_DAY], scale=config['scale'], density=config['density'])
+
+    use_data_dir(folder_path=folder_path)
+
+    traffic_data, metrics = measure(load.load_traffic_data, traffic_type=mt.TrafficType.UL_AND_DL, city=city, service=service, day=day)
+    yield 'load_traffic_data', metrics
+    traffic_data, metrics = measure(aggregate.day_time_to_datetime_index, xar=traffic_data)
+    yield 'day_time_to_datetime_index', metrics
+    _, metrics = measure(clean.remove_nights_and_times_outside_range, traffic_data=traffic_data, city=city, start=START_NIGHT, end=END_NIGHT)
+    yield 'clean', metrics
+    del traffic_data
+    _, metrics = measure(aggregate.get_night_traffic_by_tile_service_time_city, traffic_type=mt.TrafficType.UL_AND_DL, start_night=START_NIGHT, end_night=END_NIGHT, city=[city], service=service, day=day)
+    yield 'get_night_traffic_by_tile_service_time_city', metrics
+
+
+def use_data_dir(folder_path: str):
+    # Worker processes import file_io afresh and read the folders from the environment, the current process reads the module attributes.
+    cache_dir = os.path.join(folder_path, 'cache')
+    os.environ.update({'DATA_DIR': folder_path, 'CACHE_DIR': cache_dir, 'RESULT_CACHE_DIR': os.path.join(cache_dir, 'results')})
+    file_io.data_dir, file_io.cache_dir, file_io.result_cache_dir = folder_path, cache_dir, os.path.join(cache_dir, 'results')
+    load._location_lists.clear()
+    # Workers kept alive from a previous scale still have the folders of that scale.
+    get_reusable_executor().shutdown(wait=True)
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and memory-profile the load -> clean -> aggregate pipeline on synthetic data.')
+    parser.add_argument('--scale', nargs='+', choices=list(SCALES), default=['small'])
+    parser.add_argument('--data-dir', default=None, help='Folder for the synthetic data. It is reused across runs when given, otherwise a temporary folder is used.')
+    parser.add_argument('--output', default=None, help='JSON lines file the results are appended to. Defaults to stdout.')
+    parser.add_argument('--readahead', type=int, default=None, help='Number of (service, day) slabs read ahead by I/O threads, see load.default_readahead.')
+    args = parser.parse_args()
+    if args.readahead is not None:
+        load.default_readahead = args.readahead
+
+    header = {'timestamp': datetime.now().isoformat(), 'git_commit': get_git_commit(), 'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'readahead': load.default_readahead}
+    output = open(args.output, 'a') if args.output is not None else sys.stdout
+    try:
+        for name in args.scale:
+            folder_path = os.path.join(args.data_dir, name) if args.data_dir is not None else tempfile.mkdtemp(prefix=f'mobile_traffic_bench_{name}_')
+            for stage, metrics in run_scale(name=name, folder_path=folder_path):
+                output.write(json.dumps({**header, 'scale': name, 'stage': stage, **metrics}) + '\n')
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,44 @@
-from .enums import City, Service, TrafficType, ServiceType, TimeOptions
-from .utils import Calendar, Anomalies, CityDimensions
-from .aggregate import get_night_traffic_by_tile_service_time_city, MobileTrafficDataset
-from .load import load_traffic_data, load_tile_geo_data, load_tile_geo_data_city
-from .file_io import save_mobile_traffic_data
\ No newline at end of file
+import importlib
+
+from .enums import City, Service, TrafficType, ServiceType, TimeOptions, Backend, ProfileKey
+
+# The rest of the public API is resolved on first access, so that a process which only needs the enums does not import xarray, geopandas, joblib or tqdm.
+_lazy_attributes = {
+    'Calendar': 'utils',
+    'Anomalies': 'utils',
+    'CityDimensions': 'utils',
+    'get_night_traffic_by_tile_service_time_city': 'aggregate',
+    'MobileTrafficDataset': 'aggregate',
+    'load_traffic_data': 'load',
+    'load_tile_geo_data': 'load',
+    'load_tile_geo_data_city': 'load',
+    'convert_traffic_data_city_to_cache': 'load',
+    'plan_night_query': 'plan',
+    'get_plan_day_time': 'plan',
+    'NightQuery': 'plan',
+    'Scheduler': 'scheduler',
+    'save_mobile_traffic_data': 'file_io',
+    'save_mobile_traffic_dataset': 'file_io',
+    'load_mobile_traffic_dataset': 'file_io',
+    'get_temporal_profiles': 'temporal',
+    'MeanProfile': 'temporal',
+    'DailyTotals': 'temporal',
+    'DailyQuantiles': 'temporal',
+    'RollingMean': 'temporal',
+    'get_daily_stats': 'anomaly',
+    'detect_anomaly_days': 'anomaly',
+}
+
+__all__ = ['City', 'Service', 'TrafficType', 'ServiceType', 'TimeOptions', 'Backend', 'ProfileKey'] + list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_lazy_attributes[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
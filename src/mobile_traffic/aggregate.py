@@ -1,59 +1,204 @@
 from typing import List, Dict, Callable
+from dataclasses import replace
+import os
+import shutil
+import tempfile
 
 import numpy as np
+import pandas as pd
 import xarray as xr
-from datetime import time
+from datetime import datetime, date, time, timedelta
 from tqdm import tqdm
 
 from .enums import TrafficDataDimensions, TrafficType, City, Service, TimeOptions
-from .load import load_traffic_data
-from .clean import remove_times_outside_range, remove_nights_when_traffic_data_is_noisy
+from .load import load_traffic_data, get_location_list
+from .clean import remove_datetime_mask
+from .plan import NightQuery, plan_night_query, get_plan_day_time
+from . import file_io
+from . import result_cache
+from . import sparsity
+from . import instrument
+from . import precision
+from .scheduler import Scheduler
+from .utils import CityDimensions
 
 
 class MobileTrafficDataset:
     def __init__(self, data: Dict[City, xr.DataArray]):
         self.data = data
 
-    def save(self, folder_path: str):
-        for city, data in self.data.items():
-            time_as_str = [str(t) for t in data.time.values]
-            data_ = data.assign_coords(time=time_as_str)
-            data_.to_netcdf(f'{folder_path}/mobile_traffic_{city.value.lower()}_by_tile_service_and_time.nc')
+    def save(self, folder_path: str, append: bool = False, n_jobs: int = -1, dtype: np.dtype = None, scale_factor: float = None, format: str = None, clip: bool = False) -> str:
+        return file_io.save_mobile_traffic_dataset(data=self.data, folder_path=folder_path, append=append, n_jobs=n_jobs, dtype=dtype, scale_factor=scale_factor, format=format, clip=clip)
+
+    @staticmethod
+    def load(folder_path: str, city: List[City] = None, chunks: Dict[str, int] = None) -> 'MobileTrafficDataset':
+        return MobileTrafficDataset(data=file_io.load_mobile_traffic_dataset(folder_path=folder_path, city=city, chunks=chunks))
 
 
 def day_time_to_datetime_index(xar: xr.DataArray) -> xr.DataArray:
-    new_index = np.add.outer(xar.indexes[TrafficDataDimensions.DAY.value], xar.indexes[TrafficDataDimensions.TIME.value]).flatten()
-    datetime_xar = xar.stack(datetime=(TrafficDataDimensions.DAY.value, TrafficDataDimensions.TIME.value), create_index=False)
-    datetime_xar = datetime_xar.reindex({TrafficDataDimensions.DATETIME.value: new_index})
+    with instrument.stage('stack') as metrics:
+        new_index = np.add.outer(xar.indexes[TrafficDataDimensions.DAY.value], xar.indexes[TrafficDataDimensions.TIME.value]).flatten()
+        datetime_xar = xar.stack(datetime=(TrafficDataDimensions.DAY.value, TrafficDataDimensions.TIME.value), create_index=False)
+        # Stacking (day, time) is day-major, which is exactly the order of new_index, so we can label the axis without copying the data.
+        datetime_xar = datetime_xar.assign_coords({TrafficDataDimensions.DATETIME.value: new_index})
+        metrics['array_bytes'] = datetime_xar.nbytes
     return datetime_xar
 
 
-def get_night_traffic_by_tile_service_time_city(traffic_type: TrafficType, start_night: time, end_night: time, city: List[City] = None, service: List[Service] = None, remove_noisy_nights: bool = True) -> MobileTrafficDataset:
+def get_night_traffic_by_tile_service_time_city(traffic_type: TrafficType, start_night: time, end_night: time, city: List[City] = None, service: List[Service] = None, remove_noisy_nights: bool = True, streaming: bool = True, memmap_dir: str = None, use_cache: bool = False, scheduler: Scheduler = None, service_batch_size: int = None, density_threshold: float = None, tile: Dict[City, List[int]] = None, dtype: np.dtype = None, anomalies: pd.DataFrame = None, day: List[date] = None) -> MobileTrafficDataset:
+    # The options that shape the result are bundled in a NightQuery, which is what the per-city functions and the scheduler tasks receive.
+    query = NightQuery(traffic_type=traffic_type, start_night=start_night, end_night=end_night, remove_noisy_nights=remove_noisy_nights, streaming=streaming, memmap_dir=memmap_dir, density_threshold=density_threshold, tile=tile, dtype=dtype, anomalies=anomalies, day=day)
     city = city if city is not None else [c for c in City]
     service = service if service is not None else [s for s in Service]
-    traffic_data = {c: get_night_traffic_city_by_tile_service_time(city=c, traffic_type=traffic_type, start_night=start_night, end_night=end_night, service=service, remove_noisy_nights=remove_noisy_nights) for c in tqdm(city)}
+    get_night_traffic_city = get_night_traffic_city_by_tile_service_time_cached if use_cache else get_night_traffic_city_by_tile_service_time
+    if scheduler is None:
+        traffic_data = {}
+        for c in tqdm(city):
+            with instrument.stage('night_traffic_city', city=c.value):
+                traffic_data[c] = get_night_traffic_city(query=query, city=c, service=service)
+        return MobileTrafficDataset(data=traffic_data)
+
+    # Tasks are (city, service batch) pairs. Workers write their results to files, the result cache or a scratch folder, instead of pickling them back to the parent.
+    service_batch_size = service_batch_size if service_batch_size is not None else len(service)
+    service_batches = [service[i:i + service_batch_size] for i in range(0, len(service), service_batch_size)]
+    n_workers = scheduler.get_n_workers(task_memory_bytes=max(_estimate_night_traffic_memory(query=query, city=c, n_service=len(service_batches[0])) for c in city))
+    n_jobs = scheduler.get_inner_n_jobs(n_workers=n_workers)
+    if use_cache:
+        tasks = [dict(query=query, city=c, service=s, n_jobs=n_jobs) for c in city for s in service_batches]
+        scheduler.map(func=_get_night_traffic_city_by_tile_service_time_to_file, tasks=tasks, n_workers=n_workers)
+        traffic_data = {c: get_night_traffic_city_by_tile_service_time_cached(query=query, city=c, service=service) for c in city}
+        return MobileTrafficDataset(data=traffic_data)
+
+    # The scratch folder is removed even when a task fails, so that a failed run does not leave its results behind.
+    scratch_dir = tempfile.mkdtemp(dir=memmap_dir)
+    try:
+        tasks = [dict(query=query, city=c, service=s, n_jobs=n_jobs, file_path=os.path.join(scratch_dir, f'{c.value.lower()}_{i}.nc')) for c in city for i, s in enumerate(service_batches)]
+        file_paths = scheduler.map(func=_get_night_traffic_city_by_tile_service_time_to_file, tasks=tasks, n_workers=n_workers)
+        traffic_data = {c: sparsity.concat([file_io.load_mobile_traffic_data_city(file_path=f) for task, f in zip(tasks, file_paths) if task['city'] == c], dim=TrafficDataDimensions.SERVICE.value, density_threshold=density_threshold) for c in city}
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
     return MobileTrafficDataset(data=traffic_data)
 
 
-def get_night_traffic_city_by_tile_service_time(city: City, traffic_type: TrafficType, start_night: time, end_night: time, service: List[Service], remove_noisy_nights: bool = True):
+def _get_night_traffic_city_by_tile_service_time_to_file(query: NightQuery, city: City, service: List[Service], n_jobs: int, file_path: str = None) -> str:
+    # Without a file path the result goes to the result cache, where the parent picks it up.
+    with instrument.stage('night_traffic_city', city=city.value, service=[s.value for s in service]):
+        if file_path is None:
+            get_night_traffic_city_by_tile_service_time_cached(query=query, city=city, service=service, n_jobs=n_jobs)
+        else:
+            traffic_data = get_night_traffic_city_by_tile_service_time(query=query, city=city, service=service, n_jobs=n_jobs)
+            file_io.save_mobile_traffic_data_city(data=traffic_data, file_path=file_path)
+    return file_path
+
+
+def _estimate_night_traffic_memory(query: NightQuery, city: City, n_service: int) -> int:
+    # Streaming holds one day of data for every service, twice for the pandas frames it is assembled from, plus the float64 running sum.
+    # The cube holds every day of the query for a batch of services, once as loaded and once as cleaned. A memmap cube is on disk, only its cleaned copy is in memory.
+    n_rows, n_cols = CityDimensions.get_city_dim(city=city)
+    n_values = n_rows * n_cols * len(TimeOptions.get_times())
+    if query.streaming:
+        return (2 * precision.get_dtype(dtype=query.dtype).itemsize + np.dtype(precision.accumulation_dtype).itemsize) * n_values * n_service
+    if query.memmap_dir is not None:
+        return precision.get_dtype(dtype=query.dtype, default=np.float32).itemsize * n_values * n_service * len(query.get_days())
+    return 2 * precision.get_dtype(dtype=query.dtype).itemsize * n_values * _get_cube_batch_size(query=query, n_service=n_service) * len(query.get_days())
+
+
+def _get_cube_batch_size(query: NightQuery, n_service: int) -> int:
+    # With a memmap directory the cube lives on disk, so all services can be loaded at once instead of in batches of 5 (10 in float32).
+    return min(n_service, 5 * 8 // precision.get_dtype(dtype=query.dtype).itemsize) if query.memmap_dir is None else n_service
+
+
+def get_night_traffic_city_by_tile_service_time_cached(query: NightQuery, city: City, service: List[Service], n_jobs: int = -1):
+    # The per-service aggregate is the unit of caching: only services missing from the cache are computed, the rest are read back.
+    # Night sums are linear, so UL_AND_DL is the sum of the cached UL and DL aggregates.
+    if query.traffic_type == TrafficType.UL_AND_DL:
+        ul_data = get_night_traffic_city_by_tile_service_time_cached(query=replace(query, traffic_type=TrafficType.UL), city=city, service=service, n_jobs=n_jobs)
+        dl_data = get_night_traffic_city_by_tile_service_time_cached(query=replace(query, traffic_type=TrafficType.DL), city=city, service=service, n_jobs=n_jobs)
+        return sparsity.add(xar_a=ul_data, xar_b=dl_data, density_threshold=query.density_threshold)
+
+    keys = {s: result_cache.get_result_cache_key(query=query, city=city, service=s) for s in service}
+    traffic_data_service = {s: result_cache.load_cached_result(key=keys[s]) for s in service}
+    missing_service = [s for s in service if traffic_data_service[s] is None]
+    if len(missing_service) > 0:
+        traffic_data_missing = get_night_traffic_city_by_tile_service_time(query=query, city=city, service=missing_service, n_jobs=n_jobs)
+        for s in missing_service:
+            # Each service picks its own storage: sparse if its density is below the threshold, dense otherwise.
+            traffic_data_service[s] = sparsity.to_sparse_if_sparse(xar=traffic_data_missing.sel({TrafficDataDimensions.SERVICE.value: [s.value]}), density_threshold=query.density_threshold)
+            result_cache.save_cached_result(key=keys[s], data=traffic_data_service[s])
+
+    traffic_data_city = sparsity.concat([traffic_data_service[s] for s in service], dim=TrafficDataDimensions.SERVICE.value, density_threshold=query.density_threshold)
+    return traffic_data_city
+
+
+def get_night_traffic_city_by_tile_service_time(query: NightQuery, city: City, service: List[Service], n_jobs: int = -1):
+    if query.streaming:
+        return get_night_traffic_city_by_tile_service_time_streaming(query=query, city=city, service=service, n_jobs=n_jobs)
+
+    batch_size = _get_cube_batch_size(query=query, n_service=len(service))
+    memmap_path = None
+    if query.memmap_dir is not None:
+        fd, memmap_path = tempfile.mkstemp(suffix='.npy', dir=query.memmap_dir)
+        os.close(fd)
+    try:
+        traffic_data_city = _get_night_traffic_city_batches(query=query, city=city, service=service, batch_size=batch_size, memmap_path=memmap_path, n_jobs=n_jobs)
+    finally:
+        # The buffer can be as large as the cube, so it is removed even when loading or cleaning fails.
+        if memmap_path is not None and os.path.exists(memmap_path):
+            os.remove(memmap_path)
+    with instrument.stage('concat') as metrics:
+        traffic_data_city = sparsity.concat(traffic_data_city, dim=TrafficDataDimensions.SERVICE.value, density_threshold=query.density_threshold)
+        metrics['array_bytes'] = traffic_data_city.nbytes
+    return traffic_data_city
+
+
+def _get_night_traffic_city_batches(query: NightQuery, city: City, service: List[Service], batch_size: int, memmap_path: str = None, n_jobs: int = -1) -> List[xr.DataArray]:
+    # As in the streaming path, only the days and time columns that survive cleaning are loaded. The cleaning mask is the one of the plan,
+    # computed on all the days of the query, since the first-night rule of the cleaning would give another answer on the loaded days alone.
+    tile, dtype = query.get_tile(city=city), query.dtype
+    plan = plan_night_query(city=city, start_night=query.start_night, end_night=query.end_night, day=query.get_days(), remove_noisy_nights=query.remove_noisy_nights, anomalies=query.anomalies)
+    kept_day, kept_time, removed = get_plan_day_time(plan=plan)
     traffic_data_city = []
-    for i in range(0, len(service), 5):
-        service_ = service[i:i + 5]
-        traffic_data_service = load_traffic_data(traffic_type=traffic_type, city=city, service=service_, day=TimeOptions.get_days())
+    for i in range(0, len(service), batch_size):
+        service_ = service[i:i + batch_size]
+        traffic_data_service = load_traffic_data(traffic_type=query.traffic_type, city=city, service=service_, day=kept_day, time=kept_time, memmap_path=memmap_path, n_jobs=n_jobs, density_threshold=query.density_threshold, tile=tile, dtype=dtype)
         traffic_data_service = day_time_to_datetime_index(xar=traffic_data_service)
-        if remove_noisy_nights:
-            traffic_data_service = remove_nights_when_traffic_data_is_noisy(traffic_data=traffic_data_service, city=city)
-
-        traffic_data_service = remove_times_outside_range(traffic_data=traffic_data_service, start=start_night, end=end_night)
-        traffic_data_service = traffic_data_service.groupby(group=f'{TrafficDataDimensions.DATETIME.value}.time').sum()
-        sorted_time_index = _sort_time_index(time_index=traffic_data_service.time.values, reference_time=start_night)
+        traffic_data_service = remove_datetime_mask(traffic_data=traffic_data_service, mask=removed)
+        with instrument.stage('groupby_sum', service=[s.value for s in service_]) as metrics:
+            traffic_data_service = traffic_data_service.groupby(group=f'{TrafficDataDimensions.DATETIME.value}.time').sum(dtype=precision.accumulation_dtype).astype(precision.get_dtype(dtype=dtype))
+            metrics['array_bytes'] = traffic_data_service.nbytes
+        sorted_time_index = _sort_time_index(time_index=traffic_data_service.time.values, reference_time=query.start_night)
         traffic_data_service = traffic_data_service.reindex({TrafficDataDimensions.TIME.value: sorted_time_index})
         traffic_data_city.append(traffic_data_service)
-
-    traffic_data_city = xr.concat(traffic_data_city, dim=TrafficDataDimensions.SERVICE.value)
     return traffic_data_city
 
 
+def get_night_traffic_city_by_tile_service_time_streaming(query: NightQuery, city: City, service: List[Service], n_jobs: int = -1):
+    # Reads one day at a time and folds its kept time slots into a running (tile, time, service) sum, so peak memory is one day of data instead of the full datetime cube.
+    # A night spanning two days is covered because each day contributes its morning slots to the previous night and its evening slots to the next one.
+    # The plan tells us up front which days and time columns survive cleaning, so the other files and columns are never read.
+    tile, dtype = query.get_tile(city=city), query.dtype
+    plan = plan_night_query(city=city, start_night=query.start_night, end_night=query.end_night, day=query.get_days(), remove_noisy_nights=query.remove_noisy_nights, anomalies=query.anomalies)
+    kept_times = get_plan_day_time(plan=plan)[1]
+    location_list = get_location_list(city=city) if tile is None else pd.Index(tile, name=TrafficDataDimensions.TILE.value)
+
+    traffic_data_sum = np.zeros(shape=(len(location_list), len(kept_times), len(service)), dtype=precision.accumulation_dtype)
+    for d, t in plan.items():
+        traffic_data_day = load_traffic_data(traffic_type=query.traffic_type, city=city, service=service, day=[d], time=t, n_jobs=n_jobs, tile=tile, dtype=dtype).values[..., 0]
+        with instrument.stage('accumulate', day=d) as metrics:
+            traffic_data_sum[:, kept_times.get_indexer(t), :] += traffic_data_day
+            metrics['array_bytes'] = traffic_data_sum.nbytes
+
+    time_index = [(datetime.min + t).time() for t in kept_times]
+    coords = {TrafficDataDimensions.TILE.value: location_list,
+              TrafficDataDimensions.TIME.value: time_index,
+              TrafficDataDimensions.SERVICE.value: [s.value for s in service]}
+    traffic_data_city = xr.DataArray(traffic_data_sum.astype(precision.get_dtype(dtype=dtype), copy=False), coords=coords, dims=[TrafficDataDimensions.TILE.value, TrafficDataDimensions.TIME.value, TrafficDataDimensions.SERVICE.value])
+    sorted_time_index = _sort_time_index(time_index=time_index, reference_time=query.start_night)
+    traffic_data_city = traffic_data_city.reindex({TrafficDataDimensions.TIME.value: sorted_time_index})
+    traffic_data_city = traffic_data_city.transpose(TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.TIME.value)
+    return sparsity.to_sparse_if_sparse(xar=traffic_data_city, density_threshold=query.density_threshold)
+
+
 def _sort_time_index(time_index: List[time], reference_time: time):
     auxiliary_day = datetime(2020, 2, 1)
     auxiliary_dates = []
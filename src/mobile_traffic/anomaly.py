@@ -0,0 +1,130 @@
+import os
+import warnings
+import itertools
+from datetime import date, timedelta
+from typing import List, Dict
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from joblib import Parallel, delayed
+
+from .enums import City, Service, TrafficType, TrafficDataDimensions, TimeOptions
+from .utils import Anomalies, logger
+from . import cache
+
+# When recording is enabled, the per-slot totals, NaN counts and value counts of every file that is loaded are kept next to the binary cache.
+# They are a by-product of the load pass, so the anomaly detection does not have to read the traffic data again.
+# Recording is off by default because it writes to the cache from the read path. Worker processes inherit the setting through the environment.
+_recording_env_var = 'RECORD_DAILY_STATS'
+# Rows of a stats array of shape (3, number of time slots).
+TOTAL, NANS, VALUES = 0, 1, 2
+# Slots of each file whose stats are known, with or without NaN counts, so that loading them again in this process does not even look at the stats file.
+_recorded: Dict[tuple, np.ndarray] = {}
+
+
+def enable_recording():
+    os.environ[_recording_env_var] = '1'
+
+
+def disable_recording():
+    os.environ.pop(_recording_env_var, None)
+
+
+def is_recording() -> bool:
+    return os.getenv(_recording_env_var, '0') == '1'
+
+
+def record_daily_stats(traffic_data: pd.DataFrame, traffic_type: TrafficType, city: City, service: Service, day: date, nans: pd.Series = None):
+    # traffic_data holds every tile of the file and some or all time slots. Slots already recorded are not recomputed.
+    # nans are the NaN counts per slot before they were replaced with 0, unknown when the data comes from the binary cache.
+    if not is_recording():
+        return
+    key = (traffic_type, city, service, day, nans is not None)
+    times = TimeOptions.get_times()
+    position = times.get_indexer(traffic_data.columns)
+    if key in _recorded and _recorded[key][position].all():
+        return
+    try:
+        is_cached = cache.is_daily_stats_cached(traffic_type=traffic_type, city=city, service=service, day=day)
+        stats = cache.load_cached_daily_stats(traffic_type=traffic_type, city=city, service=service, day=day) if is_cached else np.full((3, len(times)), np.nan)
+        if np.isnan(stats[TOTAL, position]).any() or (nans is not None and np.isnan(stats[NANS, position]).any()):
+            stats[TOTAL, position] = traffic_data.sum().to_numpy(dtype=np.float64)
+            stats[VALUES, position] = len(traffic_data)
+            if nans is not None:
+                stats[NANS, position] = nans.to_numpy(dtype=np.float64)
+            cache.save_cached_daily_stats(stats=stats, traffic_type=traffic_type, city=city, service=service, day=day)
+        _recorded[key] = ~np.isnan(stats[TOTAL]) & (nans is None or ~np.isnan(stats[NANS]))
+    except OSError as e:
+        logger.debug(f'Could not record the daily stats of traffic_type={traffic_type.value}, city={city.value}, service={service.value}, day={day}: {e}')
+
+
+def get_daily_stats(city: List[City] = None, traffic_type: List[TrafficType] = None, service: List[Service] = None, day: List[date] = None, time: List[timedelta] = None, n_jobs: int = -1) -> xr.Dataset:
+    # Daily total, NaN count and value count per (city, traffic type, service, day), summed over the given time slots (all by default).
+    # A day is NaN when one of the slots was never recorded, e.g. a day only read by night queries when all slots are asked for.
+    city = city if city is not None else [c for c in City]
+    traffic_type = traffic_type if traffic_type is not None else [TrafficType.UL, TrafficType.DL]
+    service = service if service is not None else [s for s in Service]
+    day = day if day is not None else [d.date() for d in TimeOptions.get_days()]
+    position = np.arange(len(TimeOptions.get_times())) if time is None else TimeOptions.get_times().get_indexer(pd.TimedeltaIndex(time))
+    stats = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_get_daily_stats_city)(city=c, traffic_type=traffic_type, service=service, day=day, position=position) for c in city)
+    stats = np.stack(stats)
+    coords = {TrafficDataDimensions.CITY.value: [c.value for c in city],
+              TrafficDataDimensions.TRAFFIC_TYPE.value: [t.value for t in traffic_type],
+              TrafficDataDimensions.SERVICE.value: [s.value for s in service],
+              TrafficDataDimensions.DAY.value: pd.DatetimeIndex(day)}
+    dims = [TrafficDataDimensions.CITY.value, TrafficDataDimensions.TRAFFIC_TYPE.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.DAY.value]
+    return xr.Dataset({'total': (dims, stats[..., TOTAL]), 'nans': (dims, stats[..., NANS]), 'values': (dims, stats[..., VALUES])}, coords=coords)
+
+
+def _get_daily_stats_city(city: City, traffic_type: List[TrafficType], service: List[Service], day: List[date], position: np.ndarray) -> np.ndarray:
+    stats = np.full((len(traffic_type), len(service), len(day), 3), np.nan)
+    for (i, t), (j, s), (k, d) in itertools.product(enumerate(traffic_type), enumerate(service), enumerate(day)):
+        if cache.is_daily_stats_cached(traffic_type=t, city=city, service=s, day=d):
+            stats[i, j, k] = cache.load_cached_daily_stats(traffic_type=t, city=city, service=s, day=d)[:, position].sum(axis=1)
+    return stats
+
+
+def detect_anomaly_days(stats: xr.Dataset, threshold: float = 3.5, min_flagged_share: float = 0.5, max_nan_share: float = 0., by_weekday: bool = True) -> pd.DataFrame:
+    # Scores every day against the other days of its (city, traffic type, service) series, for all series at once on the (city, traffic type, service, day) array.
+    # A day is an anomaly of a city when at least min_flagged_share of the series of the city have a robust z-score beyond threshold, or when its NaN share exceeds max_nan_share.
+    dims = [TrafficDataDimensions.CITY.value, TrafficDataDimensions.TRAFFIC_TYPE.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.DAY.value]
+    stats = stats.transpose(*dims)
+    # On a log scale a z-score measures a relative change, the same for large and small services.
+    x = np.log1p(stats['total'].values)
+    day = pd.DatetimeIndex(stats.indexes[TrafficDataDimensions.DAY.value])
+    with warnings.catch_warnings():
+        # Series without any recorded day have all-NaN slices, which end up with NaN scores.
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if by_weekday:
+            # Each day is compared with the median of its weekday first, so that weekends are not flagged against weekdays.
+            weekday = day.weekday.values
+            baseline = np.full_like(x, np.nan)
+            for w in np.unique(weekday):
+                baseline[..., weekday == w] = np.nanmedian(x[..., weekday == w], axis=-1, keepdims=True)
+            x = x - baseline
+        median = np.nanmedian(x, axis=-1, keepdims=True)
+        mad = np.nanmedian(np.abs(x - median), axis=-1, keepdims=True)
+        # 0.6745 scales the MAD to the standard deviation of a normal distribution. Constant series, e.g. services without traffic, are never flagged.
+        z = np.divide(0.6745 * (x - median), mad, out=np.zeros_like(x), where=mad > 0)
+        z[np.isnan(x)] = np.nan
+        n_series = (~np.isnan(z)).sum(axis=(1, 2))
+        flagged_share = np.divide((np.abs(np.nan_to_num(z)) > threshold).sum(axis=(1, 2)), n_series, out=np.full(n_series.shape, np.nan), where=n_series > 0)
+        score = np.nanmedian(z, axis=(1, 2))
+        nan_share = np.nansum(stats['nans'].values, axis=(1, 2)) / np.nansum(np.where(np.isnan(stats['nans'].values), np.nan, stats['values'].values), axis=(1, 2))
+    is_anomaly = pd.array(((flagged_share >= min_flagged_share) | (nan_share > max_nan_share)).ravel(), dtype='boolean')
+    # Days without any recorded series are unknown rather than normal, e.g. the hand-picked anomaly days, which night queries never read.
+    is_anomaly[((n_series == 0) & ~(nan_share > max_nan_share)).ravel()] = pd.NA
+
+    index = pd.MultiIndex.from_product([stats.indexes[TrafficDataDimensions.CITY.value], day.date], names=[TrafficDataDimensions.CITY.value, TrafficDataDimensions.DAY.value])
+    return pd.DataFrame({'score': score.ravel(), 'flagged_share': flagged_share.ravel(), 'nan_share': nan_share.ravel(), 'n_series': n_series.ravel(), 'is_anomaly': is_anomaly}, index=index).reset_index()
+
+
+def get_anomaly_dates(anomalies: pd.DataFrame, city: City) -> List[date]:
+    # Reads the anomaly days of a city from a table of detect_anomaly_days, in the form of Anomalies.get_anomaly_dates_by_city.
+    # Days the table has no verdict on, missing or unknown, fall back to the hand-picked list, so that a table never puts back nights it could not judge.
+    rows = anomalies[anomalies[TrafficDataDimensions.CITY.value] == city.value]
+    is_anomaly = rows['is_anomaly'].astype('boolean')
+    detected = {pd.Timestamp(d).date() for d in rows[TrafficDataDimensions.DAY.value][is_anomaly.fillna(False)]}
+    known = {pd.Timestamp(d).date() for d in rows[TrafficDataDimensions.DAY.value][is_anomaly.notna()]}
+    return sorted(detected | {d for d in Anomalies.get_anomaly_dates_by_city(city=city) if d not in known})
@@ -0,0 +1,117 @@
+import os
+import io
+from datetime import date, timedelta
+from typing import List, Dict
+
+import numpy as np
+import pandas as pd
+
+from .enums import City, Service, TrafficType, TrafficDataDimensions, TimeOptions
+from . import file_io
+
+# Tile indexes read from disk, by file path so that a change of cache_dir is picked up. Every cached file of a city is read against its tile index.
+_tile_indexes: Dict[str, pd.Index] = {}
+
+
+def is_traffic_data_file_cached(traffic_type: TrafficType, city: City, service: Service, day: date) -> bool:
+    cache_file_path = file_io.get_mobile_traffic_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    if not os.path.exists(cache_file_path) or not os.path.exists(file_io.get_tile_index_cache_file_path(city=city)):
+        return False
+    # A cache file stays valid while it is newer than its source. If the source is gone, the cache is all we have.
+    file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    return not os.path.exists(file_path) or os.path.getmtime(cache_file_path) >= os.path.getmtime(file_path)
+
+
+def load_cached_traffic_data_file(traffic_type: TrafficType, city: City, service: Service, day: date, time: List[timedelta] = None, tile: List[int] = None, buffer: bytes = None) -> pd.DataFrame:
+    cache_file_path = file_io.get_mobile_traffic_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day) if buffer is None else io.BytesIO(buffer)
+    index = load_cached_tile_index(city=city)
+    if time is None and tile is None:
+        return pd.DataFrame(np.load(cache_file_path), index=index, columns=TimeOptions.get_times())
+    # Selections go through a memory map, so only the requested rows and columns are read from disk.
+    values = np.load(cache_file_path, mmap_mode='r' if buffer is None else None)
+    if tile is not None:
+        positions = index.get_indexer(tile)
+        index, values = index[positions], values[positions]
+    columns = TimeOptions.get_times() if time is None else pd.TimedeltaIndex(time)
+    if time is not None:
+        values = values[:, TimeOptions.get_times().get_indexer(columns)]
+    return pd.DataFrame(np.asarray(values), index=index, columns=columns)
+
+
+def is_npy_buffer(buffer: bytes) -> bool:
+    return buffer[:6] == b'\x93NUMPY'
+
+
+def save_cached_traffic_data_file(traffic_data: pd.DataFrame, traffic_type: TrafficType, city: City, service: Service, day: date) -> str:
+    tile_index = load_cached_tile_index(city=city)
+    values = traffic_data.reindex(index=tile_index, fill_value=0).to_numpy(dtype=np.float32)
+    cache_file_path = file_io.get_mobile_traffic_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    _save_npy_atomic(file_path=cache_file_path, values=values)
+    return cache_file_path
+
+
+def is_daily_stats_cached(traffic_type: TrafficType, city: City, service: Service, day: date) -> bool:
+    cache_file_path = file_io.get_daily_stats_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    if not os.path.exists(cache_file_path):
+        return False
+    file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    return not os.path.exists(file_path) or os.path.getmtime(cache_file_path) >= os.path.getmtime(file_path)
+
+
+def load_cached_daily_stats(traffic_type: TrafficType, city: City, service: Service, day: date) -> np.ndarray:
+    return np.load(file_io.get_daily_stats_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day))
+
+
+def save_cached_daily_stats(stats: np.ndarray, traffic_type: TrafficType, city: City, service: Service, day: date) -> str:
+    cache_file_path = file_io.get_daily_stats_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    _save_npy_atomic(file_path=cache_file_path, values=stats)
+    return cache_file_path
+
+
+def is_tile_index_cached(city: City) -> bool:
+    return os.path.exists(file_io.get_tile_index_cache_file_path(city=city))
+
+
+def load_cached_tile_index(city: City) -> pd.Index:
+    cache_file_path = file_io.get_tile_index_cache_file_path(city=city)
+    if cache_file_path not in _tile_indexes:
+        _tile_indexes[cache_file_path] = pd.Index(np.load(cache_file_path), name=TrafficDataDimensions.TILE.value)
+    return _tile_indexes[cache_file_path]
+
+
+def save_cached_tile_index(tile_index: pd.Index, city: City) -> str:
+    cache_file_path = file_io.get_tile_index_cache_file_path(city=city)
+    _save_npy_atomic(file_path=cache_file_path, values=np.asarray(tile_index, dtype=np.int64))
+    _tile_indexes[cache_file_path] = pd.Index(np.asarray(tile_index, dtype=np.int64), name=TrafficDataDimensions.TILE.value)
+    return cache_file_path
+
+
+def is_tile_geo_data_cached(city: City) -> bool:
+    cache_file_path = file_io.get_tile_geo_cache_file_path(city=city)
+    if not os.path.exists(cache_file_path):
+        return False
+    file_path = file_io.get_data_file_path(city=city)
+    return not os.path.exists(file_path) or os.path.getmtime(cache_file_path) >= os.path.getmtime(file_path)
+
+
+def load_cached_tile_geo_data(city: City):
+    import geopandas as gpd
+    return gpd.read_parquet(file_io.get_tile_geo_cache_file_path(city=city))
+
+
+def save_cached_tile_geo_data(tile_geo_data, city: City) -> str:
+    cache_file_path = file_io.get_tile_geo_cache_file_path(city=city)
+    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+    tmp_file_path = f'{cache_file_path}.{os.getpid()}.tmp'
+    tile_geo_data.to_parquet(tmp_file_path)
+    os.replace(tmp_file_path, cache_file_path)
+    return cache_file_path
+
+
+def _save_npy_atomic(file_path: str, values: np.ndarray):
+    # Write to a temporary file first so that concurrent readers never see a partially written array.
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_file_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_file_path, 'wb') as f:
+        np.save(f, values)
+    os.replace(tmp_file_path, file_path)
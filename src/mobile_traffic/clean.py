@@ -7,43 +7,93 @@ import numpy as np
 
 from .enums import City
 from .utils import Calendar, Anomalies
+from . import instrument
+from . import anomaly
 
 
-def remove_time_period_on_dates(traffic_data: xr.DataArray, dates: List[date], time_start_period: time, length_period: timedelta):
-    datetime_ = pd.DatetimeIndex(traffic_data.datetime.values).to_pydatetime()  # noqa
-    datetime_intervals_to_remove = [(datetime.combine(day, time_start_period), datetime.combine(day, time_start_period) + length_period) for day in dates]
-    datetime_to_remove = np.concatenate([np.where((datetime_ >= start) & (datetime_ < end))[0] for start, end in datetime_intervals_to_remove])
-    datetime_to_keep = np.setdiff1d(np.arange(len(datetime_)), datetime_to_remove)
-    return traffic_data.isel(datetime=datetime_to_keep)
+def get_time_period_on_dates_mask(datetime_index: np.ndarray, dates: List[date], time_start_period: time, length_period: timedelta) -> np.ndarray:
+    # A datetime lies in one of the periods iff more periods have started than ended at that datetime, which two searchsorted calls over the sorted bounds tell us.
+    datetime_index = np.asarray(datetime_index, dtype='datetime64[ns]')
+    starts = np.sort(np.asarray(dates, dtype='datetime64[D]').astype('datetime64[ns]') + _time_to_timedelta64(t=time_start_period))
+    ends = starts + np.timedelta64(length_period)
+    return np.searchsorted(starts, datetime_index, side='right') > np.searchsorted(ends, datetime_index, side='right')
 
 
-def remove_nights_before_holidays(traffic_data: xr.DataArray) -> xr.DataArray:
+def get_nights_before_holidays_mask(datetime_index: np.ndarray) -> np.ndarray:
     days_holiday = Calendar.holidays()
     days_before_holiday = [holiday - timedelta(days=1) for holiday in days_holiday]
     days_to_remove = list(set(days_before_holiday).union(set(Calendar.fridays_and_saturdays())))
-    traffic_data = remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=time(15), length_period=timedelta(days=1), dates=days_to_remove)
+    mask = get_time_period_on_dates_mask(datetime_index=datetime_index, dates=days_to_remove, time_start_period=time(15), length_period=timedelta(days=1))
     # Since the first day is a saturday, we cut of its night. If we do not remove it, we have half a day detached from the rest of our series.
-    traffic_data = remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=time(0), length_period=timedelta(days=1), dates=[pd.Timestamp(traffic_data.datetime[0].values).to_pydatetime().date()])
-    return traffic_data
+    if not mask.all():
+        first_date = pd.Timestamp(np.asarray(datetime_index)[np.argmin(mask)]).date()
+        mask |= get_time_period_on_dates_mask(datetime_index=datetime_index, dates=[first_date], time_start_period=time(0), length_period=timedelta(days=1))
+    return mask
 
 
-def remove_nights_before_anomalies(traffic_data: xr.DataArray, city: City) -> xr.DataArray:
-    days_anomaly = Anomalies.get_anomaly_dates_by_city(city=city)
+def get_nights_before_anomalies_mask(datetime_index: np.ndarray, city: City, anomalies: pd.DataFrame = None) -> np.ndarray:
+    # With a table of anomaly.detect_anomaly_days the detected days are removed instead of the hand-picked ones.
+    days_anomaly = Anomalies.get_anomaly_dates_by_city(city=city) if anomalies is None else anomaly.get_anomaly_dates(anomalies=anomalies, city=city)
     days_before_anomaly = [day - timedelta(days=1) for day in days_anomaly]
     days_to_remove = list(set(days_anomaly).union(set(days_before_anomaly)))
-    return remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=time(15), length_period=timedelta(days=1), dates=days_to_remove)
+    return get_time_period_on_dates_mask(datetime_index=datetime_index, dates=days_to_remove, time_start_period=time(15), length_period=timedelta(days=1))
 
 
-def remove_nights_when_traffic_data_is_noisy(traffic_data: xr.DataArray, city: City) -> xr.DataArray:
-    traffic_data = remove_nights_before_holidays(traffic_data=traffic_data)
-    traffic_data = remove_nights_before_anomalies(traffic_data=traffic_data, city=city)
-    return traffic_data
+def get_nights_when_traffic_data_is_noisy_mask(datetime_index: np.ndarray, city: City, anomalies: pd.DataFrame = None) -> np.ndarray:
+    return get_nights_before_holidays_mask(datetime_index=datetime_index) | get_nights_before_anomalies_mask(datetime_index=datetime_index, city=city, anomalies=anomalies)
 
 
-def remove_times_outside_range(traffic_data: xr.DataArray, start: time, end: time) -> xr.DataArray:
+def get_times_outside_range_mask(datetime_index: np.ndarray, start: time, end: time) -> np.ndarray:
     auxiliary_date = date(2020, 1, 1)
     auxiliary_datetime_start, auxiliary_datetime_end = datetime.combine(auxiliary_date, start), datetime.combine(auxiliary_date, end)
     length_period_keep = auxiliary_datetime_end - auxiliary_datetime_start if auxiliary_datetime_end > auxiliary_datetime_start else (auxiliary_datetime_end + timedelta(days=1)) - auxiliary_datetime_start
     length_period_remove = timedelta(days=1) - length_period_keep
-    dates = list(np.unique([d.date() for d in pd.DatetimeIndex(traffic_data.datetime.values).to_pydatetime()]))  # noqa
-    return remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=end, length_period=length_period_remove, dates=dates)
\ No newline at end of file
+    dates = np.unique(np.asarray(datetime_index, dtype='datetime64[D]'))
+    return get_time_period_on_dates_mask(datetime_index=datetime_index, dates=dates, time_start_period=end, length_period=length_period_remove)
+
+
+def get_removed_datetime_mask(datetime_index: np.ndarray, city: City, start: time, end: time, remove_noisy_nights: bool = True, anomalies: pd.DataFrame = None) -> np.ndarray:
+    with instrument.stage('clean.times_outside_range'):
+        mask = get_times_outside_range_mask(datetime_index=datetime_index, start=start, end=end)
+    if remove_noisy_nights:
+        with instrument.stage('clean.noisy_nights'):
+            mask |= get_nights_when_traffic_data_is_noisy_mask(datetime_index=datetime_index, city=city, anomalies=anomalies)
+    return mask
+
+
+def remove_datetime_mask(traffic_data: xr.DataArray, mask: np.ndarray) -> xr.DataArray:
+    with instrument.stage('clean.isel') as metrics:
+        traffic_data = traffic_data.isel(datetime=np.flatnonzero(~mask))
+        metrics['array_bytes'] = traffic_data.nbytes
+    return traffic_data
+
+
+def remove_time_period_on_dates(traffic_data: xr.DataArray, dates: List[date], time_start_period: time, length_period: timedelta):
+    mask = get_time_period_on_dates_mask(datetime_index=traffic_data.datetime.values, dates=dates, time_start_period=time_start_period, length_period=length_period)
+    return remove_datetime_mask(traffic_data=traffic_data, mask=mask)
+
+
+def remove_nights_before_holidays(traffic_data: xr.DataArray) -> xr.DataArray:
+    return remove_datetime_mask(traffic_data=traffic_data, mask=get_nights_before_holidays_mask(datetime_index=traffic_data.datetime.values))
+
+
+def remove_nights_before_anomalies(traffic_data: xr.DataArray, city: City, anomalies: pd.DataFrame = None) -> xr.DataArray:
+    return remove_datetime_mask(traffic_data=traffic_data, mask=get_nights_before_anomalies_mask(datetime_index=traffic_data.datetime.values, city=city, anomalies=anomalies))
+
+
+def remove_nights_when_traffic_data_is_noisy(traffic_data: xr.DataArray, city: City, anomalies: pd.DataFrame = None) -> xr.DataArray:
+    return remove_datetime_mask(traffic_data=traffic_data, mask=get_nights_when_traffic_data_is_noisy_mask(datetime_index=traffic_data.datetime.values, city=city, anomalies=anomalies))
+
+
+def remove_times_outside_range(traffic_data: xr.DataArray, start: time, end: time) -> xr.DataArray:
+    return remove_datetime_mask(traffic_data=traffic_data, mask=get_times_outside_range_mask(datetime_index=traffic_data.datetime.values, start=start, end=end))
+
+
+def remove_nights_and_times_outside_range(traffic_data: xr.DataArray, city: City, start: time, end: time, remove_noisy_nights: bool = True, anomalies: pd.DataFrame = None) -> xr.DataArray:
+    # Builds the combined mask first and copies the data once, instead of once per cleaning step.
+    mask = get_removed_datetime_mask(datetime_index=traffic_data.datetime.values, city=city, start=start, end=end, remove_noisy_nights=remove_noisy_nights, anomalies=anomalies)
+    return remove_datetime_mask(traffic_data=traffic_data, mask=mask)
+
+
+def _time_to_timedelta64(t: time) -> np.timedelta64:
+    return np.timedelta64(timedelta(hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond)).astype('timedelta64[ns]')
@@ -1,16 +1,17 @@
 from enum import Enum
 from datetime import timedelta
 
-import pandas as pd
-
 
 class TimeOptions:
     @staticmethod
     def get_times():
+        # pandas is imported here rather than at module level, so that importing the enums stays cheap.
+        import pandas as pd
         return pd.timedelta_range(start='00:00:00', end='23:59:00', freq='15min')
 
     @staticmethod
     def get_days():
+        import pandas as pd
         return pd.date_range(start='2019-03-16', end='2019-05-31', freq='D')
 
 
@@ -223,6 +224,13 @@ class Service(Enum):
             return data_consumption_service_in_timespan
 
 
+class Backend(Enum):
+    SERIAL = 'serial'
+    THREADS = 'threads'
+    PROCESSES = 'processes'
+    DASK = 'dask'
+
+
 class TrafficDataDimensions(Enum):
     SERVICE = 'service'
     TIME = 'time'
@@ -230,3 +238,18 @@ class TrafficDataDimensions(Enum):
     DATETIME = 'datetime'
     TILE = 'tile'
     CITY = 'city'
+    TRAFFIC_TYPE = 'traffic_type'
+    REGION = 'region'
+    WEEKDAY = 'weekday'
+    HOUR = 'hour'
+    QUANTILE = 'quantile'
+    ROW = 'row'
+    COL = 'col'
+
+
+class ProfileKey(Enum):
+    TIME = 'time'
+    HOUR = 'hour'
+    WEEKDAY = 'weekday'
+    WEEKDAY_TIME = 'weekday_time'
+    WEEKDAY_HOUR = 'weekday_hour'
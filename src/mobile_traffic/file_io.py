@@ -1,26 +1,215 @@
 import os
-from datetime import date
-from typing import Dict
+import shutil
+import importlib.util
+from datetime import date, time, datetime
+from typing import Dict, List
 
+import numpy as np
+import pandas as pd
 import xarray as xr
+from joblib import Parallel, delayed
 
-from .enums import City, Service, TrafficType
+from .enums import City, Service, TrafficType, TrafficDataDimensions
+from . import sparsity
+from . import instrument
+from . import precision
 
 data_dir = os.getenv('DATA_DIR')
+cache_dir = os.getenv('CACHE_DIR', f'{data_dir}/cache')
+result_cache_dir = os.getenv('RESULT_CACHE_DIR', f'{cache_dir}/results')
 
-def get_mobile_traffic_data_file_path(traffic_type: TrafficType, city: City, service: Service, day: date):
+def get_mobile_traffic_data_file_path(traffic_type: TrafficType, city: City, service: Service, day: date, folder_path: str = None):
+    folder_path = folder_path if folder_path is not None else data_dir
     day_str = day.strftime('%Y%m%d')
-    path = f'{data_dir}/tile/{city.value}/{service.value}/{day_str}/'
+    path = f'{folder_path}/tile/{city.value}/{service.value}/{day_str}/'
     file_name = f'{city.value}_{service.value}_{day_str}_{traffic_type.value}.txt'
     file_path = path + file_name
     return file_path
 
-def get_data_file_path(city: City) -> str:
-    return f'{data_dir}/{city.value}.geojson'
+def get_mobile_traffic_cache_file_path(traffic_type: TrafficType, city: City, service: Service, day: date):
+    day_str = day.strftime('%Y%m%d')
+    path = f'{cache_dir}/tile/{city.value}/{service.value}/{day_str}/'
+    file_name = f'{city.value}_{service.value}_{day_str}_{traffic_type.value}.npy'
+    file_path = path + file_name
+    return file_path
+
+def get_daily_stats_cache_file_path(traffic_type: TrafficType, city: City, service: Service, day: date) -> str:
+    day_str = day.strftime('%Y%m%d')
+    return f'{cache_dir}/stats/{city.value}/{service.value}/{city.value}_{service.value}_{day_str}_{traffic_type.value}.npy'
+
+def get_tile_index_cache_file_path(city: City):
+    return f'{cache_dir}/tile/{city.value}/{city.value}_tiles.npy'
+
+def get_tile_geo_cache_file_path(city: City) -> str:
+    return f'{cache_dir}/geo/{city.value}.parquet'
+
+def get_tile_region_operator_cache_file_path(city: City, region_set: str, regions_hash: str) -> str:
+    return f'{cache_dir}/regions/{city.value}_{region_set}_{regions_hash}.npz'
+
+def get_data_file_path(city: City, folder_path: str = None) -> str:
+    folder_path = folder_path if folder_path is not None else data_dir
+    return f'{folder_path}/{city.value}.geojson'
+
+
+def get_mobile_traffic_dataset_file_path(city: City, folder_path: str) -> str:
+    return f'{folder_path}/mobile_traffic_{city.value.lower()}_by_tile_service_and_time.nc'
+
+
+def get_mobile_traffic_dataset_store_path(folder_path: str) -> str:
+    return f'{folder_path}/mobile_traffic_by_tile_service_and_time.zarr'
 
 
 def save_mobile_traffic_data(data: Dict[City, xr.DataArray], folder_path: str):
-    for city, data in self.data.items():
-        time_as_str = [str(t) for t in data.time.values]
-        data_ = data.assign_coords(time=time_as_str)
-        data_.to_netcdf(f'{folder_path}/mobile_traffic_{city.value.lower()}_by_tile_service_and_time.nc')
\ No newline at end of file
+    for city, data_city in data.items():
+        with instrument.stage('save_city', city=city.value):
+            save_mobile_traffic_data_city(data=data_city, file_path=get_mobile_traffic_dataset_file_path(city=city, folder_path=folder_path))
+
+
+def save_mobile_traffic_data_city(data: xr.DataArray, file_path: str):
+    time_as_str = [str(t) for t in data.time.values]
+    data_ = data.assign_coords(time=time_as_str)
+    if sparsity.is_sparse(data_):
+        data_ = sparsity.to_coo_dataset(xar=data_)
+    with instrument.stage('save') as metrics:
+        data_.to_netcdf(file_path)
+        metrics['array_bytes'] = data_.nbytes
+        metrics['bytes_written'] = os.path.getsize(file_path)
+
+
+def load_mobile_traffic_data_city(file_path: str) -> xr.DataArray:
+    with xr.open_dataset(file_path) as ds:
+        is_coo = sparsity.is_coo_dataset(ds=ds)
+    data = sparsity.from_coo_dataset(ds=xr.load_dataset(file_path)) if is_coo else xr.load_dataarray(file_path)
+    time_ = [time.fromisoformat(str(t)) for t in data.time.values]
+    return data.assign_coords(time=time_)
+
+
+# Chunk sizes of the dataset store. A chunk holds one service and a few hours of a block of tiles, so a (city, service, time) selection reads only the chunks it needs. Other dimensions are not chunked.
+dataset_chunks = {TrafficDataDimensions.TILE.value: 8192, TrafficDataDimensions.REGION.value: 8192, TrafficDataDimensions.SERVICE.value: 1, TrafficDataDimensions.TIME.value: 16}
+dataset_variable = 'traffic'
+
+
+def get_default_dataset_format() -> str:
+    # zarr is an optional dependency. Without it datasets are saved as one netCDF file per city, the format used before the zarr store.
+    return 'zarr' if importlib.util.find_spec('zarr') is not None else 'netcdf'
+
+
+def save_mobile_traffic_dataset(data: Dict[City, xr.DataArray], folder_path: str, append: bool = False, n_jobs: int = -1, dtype: np.dtype = None, scale_factor: float = None, format: str = None, clip: bool = False) -> str:
+    # With the zarr format all cities go to one chunked, compressed store, one group per city, written in parallel. Compression releases the GIL, so threads are enough.
+    # With append=True, new cities are added to an existing store and new services are appended to the cities already in it.
+    # dtype is the type of the values on disk. A float type casts them, an integer type stores them quantized, see precision.get_quantization_encoding for the error bounds.
+    # dtype and scale_factor are set when a city is first written, and appended services are packed with the encoding of the store. Values that do not fit
+    # the quantized range raise a ValueError, unless clip=True saturates them.
+    # The netcdf format writes one file per city, zlib-compressed when netCDF4 is installed. It supports neither append nor quantized storage.
+    format = format if format is not None else get_default_dataset_format()
+    if format == 'netcdf':
+        if append:
+            raise ValueError('append=True is only supported by the zarr format')
+        if precision.is_quantized_dtype(dtype=dtype):
+            raise ValueError(f'dtype={np.dtype(dtype)} is only supported by the zarr format. Use a floating point type with the netcdf format.')
+        Parallel(n_jobs=n_jobs, prefer='threads')(delayed(save_mobile_traffic_dataset_city_netcdf)(data=data_city, file_path=get_mobile_traffic_dataset_file_path(city=city, folder_path=folder_path), city=city, dtype=dtype) for city, data_city in data.items())
+        return folder_path
+    if format != 'zarr':
+        raise ValueError(f'Invalid format {format}, expected zarr or netcdf')
+    store_path = get_mobile_traffic_dataset_store_path(folder_path=folder_path)
+    if not append and os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    Parallel(n_jobs=n_jobs, prefer='threads')(delayed(save_mobile_traffic_dataset_city)(data=data_city, store_path=store_path, city=city, dtype=dtype, scale_factor=scale_factor, clip=clip) for city, data_city in data.items())
+    return store_path
+
+
+def save_mobile_traffic_dataset_city(data: xr.DataArray, store_path: str, city: City, dtype: np.dtype = None, scale_factor: float = None, clip: bool = False):
+    with instrument.stage('save_city', city=city.value) as metrics:
+        data_ = sparsity.to_dense(xar=data) if sparsity.is_sparse(data) else data
+        # Service names are stored as variable-length strings, so services with longer names can be appended later.
+        data_ = _time_to_timedelta_coords(xar=data_).to_dataset(name=dataset_variable)
+        data_ = data_.assign_coords({TrafficDataDimensions.SERVICE.value: data_.indexes[TrafficDataDimensions.SERVICE.value].astype(object)})
+        if dtype is not None and not precision.is_quantized_dtype(dtype=dtype):
+            data_ = data_.astype(dtype)
+        if not os.path.exists(os.path.join(store_path, city.value)):
+            encoding = {dataset_variable: {'chunks': tuple(min(dataset_chunks.get(d, n), n) for d, n in data_[dataset_variable].sizes.items())}}
+            if precision.is_quantized_dtype(dtype=dtype):
+                encoding[dataset_variable].update(precision.get_quantization_encoding(xar=data_[dataset_variable], dtype=dtype, scale_factor=scale_factor))
+                data_[dataset_variable] = precision.clip_to_quantization_range(xar=data_[dataset_variable], encoding=encoding[dataset_variable], saturate=clip)
+            data_.to_zarr(store_path, group=city.value, mode='w-', encoding=encoding, consolidated=False)
+        else:
+            if dtype is not None or scale_factor is not None:
+                raise ValueError(f'Cannot append to city={city.value} with dtype or scale_factor: appended values are stored with the encoding already in the store')
+            with xr.open_zarr(store_path, group=city.value, consolidated=False) as stored:
+                existing_service = set(stored.indexes[TrafficDataDimensions.SERVICE.value])
+                stored_encoding = stored[dataset_variable].encoding
+                for d in data_.dims:
+                    if d != TrafficDataDimensions.SERVICE.value and not stored.indexes[d].equals(data_.indexes[d]):
+                        raise ValueError(f'Cannot append to city={city.value}: coordinate {d} differs from the one in the store')
+            overlap = existing_service.intersection(data_.indexes[TrafficDataDimensions.SERVICE.value])
+            if overlap:
+                raise ValueError(f'Cannot append to city={city.value}: services {sorted(overlap)} are already in the store')
+            # Appended values are packed with the encoding already in the store, whose range was fitted to the values first written.
+            if 'scale_factor' in stored_encoding:
+                data_[dataset_variable] = precision.clip_to_quantization_range(xar=data_[dataset_variable], encoding=stored_encoding, saturate=clip)
+            data_.to_zarr(store_path, group=city.value, append_dim=TrafficDataDimensions.SERVICE.value, consolidated=False)
+        metrics['array_bytes'] = data_.nbytes
+
+
+def save_mobile_traffic_dataset_city_netcdf(data: xr.DataArray, file_path: str, city: City, dtype: np.dtype = None):
+    with instrument.stage('save_city', city=city.value) as metrics:
+        data_ = sparsity.to_dense(xar=data) if sparsity.is_sparse(data) else data
+        data_ = _time_to_timedelta_coords(xar=data_).to_dataset(name=dataset_variable)
+        if dtype is not None:
+            data_ = data_.astype(dtype)
+        if importlib.util.find_spec('netCDF4') is not None:
+            engine, encoding = 'netcdf4', {dataset_variable: {'zlib': True, 'complevel': 4}}
+        else:
+            engine, encoding = None, {}
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        data_.to_netcdf(file_path, engine=engine, encoding=encoding)
+        metrics['array_bytes'] = data_.nbytes
+
+
+def load_mobile_traffic_dataset(folder_path: str, city: List[City] = None, chunks: Dict[str, int] = None) -> Dict[City, xr.DataArray]:
+    # Arrays are opened lazily: only the chunks covering a selection are read and decompressed, e.g. when calling .sel(service=...).load().
+    # Pass chunks={} to get dask arrays with the chunking of the store instead.
+    # Folders without a zarr store are read as netCDF files, one per city, including those written by save_mobile_traffic_data.
+    store_path = get_mobile_traffic_dataset_store_path(folder_path=folder_path)
+    if not os.path.exists(store_path):
+        return _load_mobile_traffic_dataset_netcdf(folder_path=folder_path, city=city, chunks=chunks)
+    city = city if city is not None else [c for c in City if os.path.exists(os.path.join(store_path, c.value))]
+    data = {}
+    for c in city:
+        data_city = xr.open_zarr(store_path, group=c.value, chunks=chunks, consolidated=False)[dataset_variable]
+        data[c] = _timedelta_to_time_coords(xar=data_city)
+    return data
+
+
+def _load_mobile_traffic_dataset_netcdf(folder_path: str, city: List[City] = None, chunks: Dict[str, int] = None) -> Dict[City, xr.DataArray]:
+    city = city if city is not None else [c for c in City if os.path.exists(get_mobile_traffic_dataset_file_path(city=c, folder_path=folder_path))]
+    data = {}
+    for c in city:
+        file_path = get_mobile_traffic_dataset_file_path(city=c, folder_path=folder_path)
+        ds = xr.open_dataset(file_path, chunks=chunks)
+        # Sparse arrays written by save_mobile_traffic_data are stored as non-zero values and cannot be opened lazily.
+        if sparsity.is_coo_dataset(ds=ds):
+            ds.close()
+            data[c] = load_mobile_traffic_data_city(file_path=file_path)
+            continue
+        data_city = ds[list(ds.data_vars)[0]]
+        # save_mobile_traffic_data stored the time of day as strings.
+        if data_city.indexes[TrafficDataDimensions.TIME.value].dtype == object:
+            data_city = data_city.assign_coords({TrafficDataDimensions.TIME.value: [time.fromisoformat(str(t)) for t in data_city.time.values]})
+        data[c] = _timedelta_to_time_coords(xar=data_city)
+    return data
+
+
+def _time_to_timedelta_coords(xar: xr.DataArray) -> xr.DataArray:
+    # datetime.time has no native representation in the store, so the time of day is kept as a timedelta since midnight.
+    t = xar.indexes.get(TrafficDataDimensions.TIME.value)
+    if t is None or len(t) == 0 or not isinstance(t[0], time):
+        return xar
+    return xar.assign_coords({TrafficDataDimensions.TIME.value: pd.to_timedelta([v.isoformat() for v in t])})
+
+
+def _timedelta_to_time_coords(xar: xr.DataArray) -> xr.DataArray:
+    t = xar.indexes.get(TrafficDataDimensions.TIME.value)
+    if t is None or not isinstance(t, pd.TimedeltaIndex):
+        return xar
+    return xar.assign_coords({TrafficDataDimensions.TIME.value: [(datetime.min + v.to_pytimedelta()).time() for v in t]})
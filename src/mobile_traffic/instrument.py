@@ -0,0 +1,113 @@
+import os
+import json
+import time as time_
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import List, Dict, Any
+
+import pandas as pd
+
+_instrumentation_env_var = 'MOBILE_TRAFFIC_INSTRUMENT_JSONL'
+_context = contextvars.ContextVar('mobile_traffic_instrument_context', default={})
+
+
+class Instrumentation:
+    def __init__(self, jsonl_path: str = None):
+        self.jsonl_path = jsonl_path
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def record(self, record: Dict[str, Any]):
+        with self._lock:
+            self.records.append(record)
+            if self.jsonl_path is not None:
+                # Single short appends, so lines from several worker processes sharing the file do not interleave.
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+    @staticmethod
+    def from_jsonl(jsonl_path: str) -> 'Instrumentation':
+        # The JSON lines file also holds the records of worker processes, so this is the complete report of a parallel run.
+        instrumentation = Instrumentation()
+        with open(jsonl_path) as f:
+            instrumentation.records = [json.loads(line) for line in f if line.strip()]
+        return instrumentation
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records)
+
+    def summary(self) -> pd.DataFrame:
+        # Totals per (city, stage): how often the stage ran, how long it took, how much it read and the highest RSS seen.
+        records = self.to_dataframe()
+        if records.empty:
+            return records
+        if 'city' not in records:
+            records['city'] = None
+        records['city'] = records['city'].fillna('')
+        aggregations = {'seconds': ['count', 'sum'], 'peak_rss_bytes': 'max'}
+        aggregations.update({c: 'sum' for c in ['files_read', 'bytes_read', 'rows_parsed'] if c in records})
+        aggregations.update({c: 'max' for c in ['array_bytes'] if c in records})
+        summary = records.groupby(['city', 'stage']).agg(aggregations)
+        summary.columns = ['calls' if c == ('seconds', 'count') else c[0] for c in summary.columns]
+        return summary
+
+
+_instrumentation: Instrumentation = None
+
+
+def enable(jsonl_path: str = None) -> Instrumentation:
+    # Worker processes started after this call inherit the JSON lines path through the environment and append their own records to it.
+    global _instrumentation
+    _instrumentation = Instrumentation(jsonl_path=jsonl_path)
+    if jsonl_path is not None:
+        os.environ[_instrumentation_env_var] = jsonl_path
+    return _instrumentation
+
+
+def disable() -> Instrumentation:
+    global _instrumentation
+    instrumentation, _instrumentation = _instrumentation, None
+    os.environ.pop(_instrumentation_env_var, None)
+    return instrumentation
+
+
+def get_instrumentation() -> Instrumentation:
+    global _instrumentation
+    if _instrumentation is None and os.getenv(_instrumentation_env_var) is not None:
+        _instrumentation = Instrumentation(jsonl_path=os.getenv(_instrumentation_env_var))
+    return _instrumentation
+
+
+@contextmanager
+def stage(name: str, **context):
+    # Records the duration and memory of a pipeline stage. Context such as the city or services is inherited by nested stages.
+    # The yielded dict lets the stage add its own metrics, e.g. files read or array sizes. When instrumentation is off this is a no-op.
+    instrumentation = get_instrumentation()
+    if instrumentation is None:
+        yield {}
+        return
+
+    context = {**_context.get(), **context}
+    token = _context.set(context)
+    metrics = {}
+    start = time_.perf_counter()
+    try:
+        yield metrics
+    finally:
+        seconds = time_.perf_counter() - start
+        _context.reset(token)
+        instrumentation.record({'stage': name, **context, 'seconds': seconds, 'rss_bytes': _get_rss_bytes(), 'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 'pid': os.getpid(), **metrics})
+
+
+def is_enabled() -> bool:
+    return get_instrumentation() is not None
+
+
+def _get_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,56 +1,195 @@
-from datetime import date
+import os
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 from joblib import Parallel, delayed
-from typing import List
+from typing import List, Dict, Tuple
 import itertools
 
 import pandas as pd
 import xarray as xr
 import numpy as np
-from tqdm import tqdm
-import geopandas as gpd
 
 from .enums import City, Service, TrafficType, TrafficDataDimensions, TimeOptions
 from . import file_io
+from . import cache
+from . import sparsity
+from . import instrument
+from . import precision
+from . import anomaly
 from .utils import logger
 
-
-def load_traffic_data(traffic_type: TrafficType, city: City, service: List[Service], day: List[date]) -> xr.DataArray:
-    tuples = list(itertools.product(service, day))
-    map_tuple_index = {t: i for i, t in enumerate(tuples)}
-    data_vals = Parallel(n_jobs=-1)(delayed(load_traffic_data_base)(traffic_type=traffic_type, city=city, service=s, day=d) for s, d in tuples)
-    # data_vals = [load_traffic_data_base(traffic_type=traffic_type, geo_data_type=geo_data_type, city=city, service=s, day=d) for s, d in tqdm(tuples)]
-    data_vals = np.stack([np.stack([data_vals[map_tuple_index[(s, d)]] for i, s in enumerate(service)], axis=-1) for j, d in enumerate(day)], axis=-1)
-    coords = {TrafficDataDimensions.TILE.value: get_location_list(city=city),
-              TrafficDataDimensions.TIME.value: TimeOptions.get_times(),
+_location_lists: Dict[City, pd.Index] = {}
+# Number of (service, day) slabs whose files are read ahead by I/O threads while earlier ones are parsed. 0 lets each parse task read its own files.
+default_readahead = int(os.getenv('READAHEAD', 0))
+
+
+def load_traffic_data(traffic_type: TrafficType, city: City, service: List[Service], day: List[date], time: List[timedelta] = None, memmap_path: str = None, n_jobs: int = -1, density_threshold: float = None, tile: List[int] = None, dtype: np.dtype = None, readahead: int = None) -> xr.DataArray:
+    # With a list of tiles only those rows are kept, e.g. the tiles returned by a spatial query. Binary cache files are then read row by row instead of whole.
+    tile_ = None if tile is None else _get_tile_subset(city=city, tile=tile)
+    tile = get_location_list(city=city) if tile_ is None else tile_
+    times = TimeOptions.get_times() if time is None else pd.TimedeltaIndex(time)
+    # Values are float64 unless a narrower float type is asked for. The out-of-core buffer defaults to float32, the type of the binary cache.
+    dtype = precision.get_dtype(dtype=dtype, default=np.float64 if memmap_path is None else np.float32)
+    shape = (len(tile), len(times), len(service), len(day))
+    tuples = [(i, s, j, d) for (i, s), (j, d) in itertools.product(enumerate(service), enumerate(day))]
+    # With readahead, the raw bytes of the files are fetched by a bounded pool of I/O threads in task order and handed to the parse tasks,
+    # so that reads from slow storage overlap with parsing and with filling the output buffer.
+    readahead = readahead if readahead is not None else default_readahead
+    buffers = _prefetch_traffic_data_files(traffic_type=traffic_type, city=city, service_day=[(s, d) for i, s, j, d in tuples], readahead=readahead) if readahead > 0 else itertools.repeat(None)
+
+    with instrument.stage('load_traffic_data', city=city.value, service=[s.value for s in service]) as metrics:
+        if memmap_path is None and density_threshold is not None:
+            # Sparse mode: each slab is reduced to its non-zero values as it arrives, so the dense cube is never allocated.
+            slabs = Parallel(n_jobs=n_jobs, return_as='generator')(delayed(load_traffic_data_base)(traffic_type=traffic_type, city=city, service=s, day=d, time=time, tile=tile_, dtype=dtype, buffers=b) for (i, s, j, d), b in zip(tuples, buffers))
+            data_vals = sparsity.coo_from_slabs(slabs=(((i, j), slab) for (i, s, j, d), slab in zip(tuples, slabs)), shape=shape)
+        elif memmap_path is None:
+            data_vals = np.empty(shape=shape, dtype=dtype)
+            slabs = Parallel(n_jobs=n_jobs, return_as='generator')(delayed(load_traffic_data_base)(traffic_type=traffic_type, city=city, service=s, day=d, time=time, tile=tile_, dtype=dtype, buffers=b) for (i, s, j, d), b in zip(tuples, buffers))
+            for (i, s, j, d), slab in zip(tuples, slabs):
+                data_vals[:, :, i, j] = slab
+        else:
+            # Out-of-core mode: workers write each (service, day) slab straight into a disk-backed buffer instead of returning it to the parent.
+            # The buffer is laid out (service, day, tile, time) so that each slab is one contiguous run of pages, and is viewed as (tile, time, service, day).
+            np.lib.format.open_memmap(memmap_path, mode='w+', dtype=dtype, shape=shape[2:] + shape[:2]).flush()
+            Parallel(n_jobs=n_jobs)(delayed(_load_traffic_data_base_to_memmap)(memmap_path=memmap_path, service_index=i, day_index=j, traffic_type=traffic_type, city=city, service=s, day=d, time=time, tile=tile_, dtype=dtype, buffers=b) for (i, s, j, d), b in zip(tuples, buffers))
+            data_vals = np.load(memmap_path, mmap_mode='r').transpose(2, 3, 0, 1)
+        if instrument.is_enabled():
+            metrics.update(_get_read_metrics(traffic_type=traffic_type, city=city, service=service, day=day, n_time=len(times)))
+            metrics['tiles_kept'] = len(tile)
+            metrics['array_bytes'] = data_vals.nbytes
+
+    coords = {TrafficDataDimensions.TILE.value: tile,
+              TrafficDataDimensions.TIME.value: times,
               TrafficDataDimensions.SERVICE.value: [s.value for s in service],
               TrafficDataDimensions.DAY.value: day}
     dims = [TrafficDataDimensions.TILE.value, TrafficDataDimensions.TIME.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.DAY.value]
     xar = xr.DataArray(data_vals, coords=coords, dims=dims)
+    if density_threshold is not None:
+        # The storage is chosen once for the whole cube from its overall density, since the services of one DataArray cannot mix dense and sparse storage.
+        xar = sparsity.to_sparse_if_sparse(xar=xar, density_threshold=density_threshold)
     return xar
 
 
-def get_location_list(city: City):
-    traffic_data = load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=Service.WIKIPEDIA, day=date(2019, 4, 1))
-    return traffic_data.index
-
-
-def load_traffic_data_base(traffic_type: TrafficType, city: City, service: Service, day: date) -> pd.DataFrame:
+def _get_read_metrics(traffic_type: TrafficType, city: City, service: List[Service], day: List[date], n_time: int) -> Dict[str, int]:
+    # Counts the files behind a load and their size on disk, whichever of the binary cache or the text file was read.
+    traffic_types = [TrafficType.UL, TrafficType.DL] if traffic_type == TrafficType.UL_AND_DL else [traffic_type]
+    files_read, bytes_read = 0, 0
+    for t, s, d in itertools.product(traffic_types, service, day):
+        if cache.is_traffic_data_file_cached(traffic_type=t, city=city, service=s, day=d):
+            file_path = file_io.get_mobile_traffic_cache_file_path(traffic_type=t, city=city, service=s, day=d)
+        else:
+            file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=t, city=city, service=s, day=d)
+        files_read += 1
+        bytes_read += os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    return {'files_read': files_read, 'bytes_read': bytes_read, 'rows_parsed': files_read * len(get_location_list(city=city)), 'values_parsed': files_read * len(get_location_list(city=city)) * n_time}
+
+
+def _load_traffic_data_base_to_memmap(memmap_path: str, service_index: int, day_index: int, traffic_type: TrafficType, city: City, service: Service, day: date, time: List[timedelta] = None, tile: List[int] = None, dtype: np.dtype = None, buffers: Dict[TrafficType, bytes] = None):
+    data_vals = np.load(memmap_path, mmap_mode='r+')
+    data_vals[service_index, day_index] = load_traffic_data_base(traffic_type=traffic_type, city=city, service=service, day=day, time=time, tile=tile, dtype=dtype, buffers=buffers)
+    data_vals.flush()
+
+
+def _prefetch_traffic_data_files(traffic_type: TrafficType, city: City, service_day: List[Tuple[Service, date]], readahead: int):
+    # Yields the file contents of each (service, day) in order. At most readahead of them are being read or waiting to be consumed at any time.
+    with ThreadPoolExecutor(max_workers=readahead) as executor:
+        futures = deque()
+        for s, d in service_day:
+            futures.append(executor.submit(_read_traffic_data_files, traffic_type=traffic_type, city=city, service=s, day=d))
+            if len(futures) >= readahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def _read_traffic_data_files(traffic_type: TrafficType, city: City, service: Service, day: date) -> Dict[TrafficType, bytes]:
+    # Reads whichever file load_traffic_data_file would read, the binary cache file or the text file, without parsing it.
+    traffic_types = [TrafficType.UL, TrafficType.DL] if traffic_type == TrafficType.UL_AND_DL else [traffic_type]
+    buffers = {}
+    for t in traffic_types:
+        if cache.is_traffic_data_file_cached(traffic_type=t, city=city, service=service, day=day):
+            file_path = file_io.get_mobile_traffic_cache_file_path(traffic_type=t, city=city, service=service, day=day)
+        else:
+            file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=t, city=city, service=service, day=day)
+        with instrument.stage('prefetch_file', service=service.value, day=day) as metrics:
+            with open(file_path, 'rb') as f:
+                buffers[t] = f.read()
+            metrics['bytes_read'] = len(buffers[t])
+    return buffers
+
+
+def _get_tile_subset(city: City, tile: List[int]) -> pd.Index:
+    tile = pd.Index(tile, name=TrafficDataDimensions.TILE.value)
+    unknown = tile[get_location_list(city=city).get_indexer(tile) < 0]
+    if len(unknown) > 0:
+        raise ValueError(f'Tiles {list(unknown[:10])} are not tiles of city={city.value}')
+    return tile
+
+
+def get_location_list(city: City) -> pd.Index:
+    # The tile index of a city is read from one reference file once, persisted next to the binary cache and kept in memory afterwards.
+    # It is the tile order of every array we build, and files that deviate from it are realigned on load.
+    if city not in _location_lists:
+        if not cache.is_tile_index_cached(city=city):
+            traffic_data = _read_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=Service.WIKIPEDIA, day=date(2019, 4, 1))
+            try:
+                cache.save_cached_tile_index(tile_index=traffic_data.index, city=city)
+            except OSError as e:
+                logger.debug(f'Could not persist the tile index of city={city.value}: {e}')
+                _location_lists[city] = traffic_data.index
+                return traffic_data.index
+        _location_lists[city] = cache.load_cached_tile_index(city=city)
+    return _location_lists[city]
+
+
+def load_traffic_data_base(traffic_type: TrafficType, city: City, service: Service, day: date, time: List[timedelta] = None, tile: List[int] = None, dtype: np.dtype = None, buffers: Dict[TrafficType, bytes] = None) -> pd.DataFrame:
+    buffers = buffers if buffers is not None else {}
     if traffic_type == TrafficType.UL_AND_DL:
-        ul_data = load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service, day=day)
-        dl_data = load_traffic_data_file(traffic_type=TrafficType.DL, city=city, service=service, day=day)
+        ul_data = load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service, day=day, time=time, tile=tile, dtype=dtype, buffer=buffers.get(TrafficType.UL))
+        dl_data = load_traffic_data_file(traffic_type=TrafficType.DL, city=city, service=service, day=day, time=time, tile=tile, dtype=dtype, buffer=buffers.get(TrafficType.DL))
         traffic = ul_data + dl_data
         return traffic
     else:
-        return load_traffic_data_file(traffic_type=traffic_type, city=city, service=service, day=day)
+        return load_traffic_data_file(traffic_type=traffic_type, city=city, service=service, day=day, time=time, tile=tile, dtype=dtype, buffer=buffers.get(traffic_type))
+
+
+def load_traffic_data_file(traffic_type: TrafficType, city: City, service: Service, day: date, time: List[timedelta] = None, use_cache: bool = True, tile: List[int] = None, dtype: np.dtype = None, buffer: bytes = None) -> pd.DataFrame:
+    # A prefetched buffer holds the contents of the file, either a binary cache file (recognised by the .npy magic string) or a text file.
+    is_cached = cache.is_npy_buffer(buffer=buffer) if buffer is not None else use_cache and cache.is_traffic_data_file_cached(traffic_type=traffic_type, city=city, service=service, day=day)
+    if is_cached:
+        traffic_data = cache.load_cached_traffic_data_file(traffic_type=traffic_type, city=city, service=service, day=day, time=time, tile=tile, buffer=buffer)
+        if tile is None:
+            anomaly.record_daily_stats(traffic_data=traffic_data, traffic_type=traffic_type, city=city, service=service, day=day)
+        return traffic_data if dtype is None else traffic_data.astype(dtype, copy=False)
+
+    traffic_data = _read_traffic_data_file(traffic_type=traffic_type, city=city, service=service, day=day, time=time, dtype=dtype, buffer=buffer)
+    tile_, tile = tile, get_location_list(city=city)
+    if len(traffic_data.index) != len(tile) or not np.array_equal(traffic_data.index.values, tile.values):
+        logger.debug(f'WARNING: file of traffic_type={traffic_type.value}, city={city.value}, service={service.value}, day={day} does not follow the tile order of the city. Realigning it.')
+        traffic_data = traffic_data.reindex(index=tile, fill_value=0)
+    if tile_ is not None:
+        traffic_data = traffic_data.loc[tile_]
+    return traffic_data
 
 
-def load_traffic_data_file(traffic_type: TrafficType, city: City, service: Service, day: date) -> pd.DataFrame:
-    file_path = config.get_mobile_traffic_data_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+def _read_traffic_data_file(traffic_type: TrafficType, city: City, service: Service, day: date, time: List[timedelta] = None, dtype: np.dtype = None, buffer: bytes = None) -> pd.DataFrame:
+    file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
     cols = [TrafficDataDimensions.TILE.value] + list(TimeOptions.get_times())
-    traffic_data = pd.read_csv(file_path, sep=' ', names=cols)
+    # Only the requested time columns are parsed, the others are skipped by the reader.
+    usecols = None if time is None else [0] + list(TimeOptions.get_times().get_indexer(pd.TimedeltaIndex(time)) + 1)
+    with instrument.stage('read_file', service=service.value, day=day) as metrics:
+        traffic_data = pd.read_csv(file_path if buffer is None else io.BytesIO(buffer), sep=' ', names=cols, usecols=usecols, dtype=None if dtype is None else {c: dtype for c in cols[1:]})
+        metrics.update({'files_read': 1, 'bytes_read': os.path.getsize(file_path) if buffer is None else len(buffer), 'rows_parsed': len(traffic_data)})
     traffic_data.set_index(TrafficDataDimensions.TILE.value, inplace=True)
+    if time is not None:
+        traffic_data = traffic_data[pd.TimedeltaIndex(time)]
 
-    nans = traffic_data.isna().sum().sum()
+    nans_by_time = traffic_data.isna().sum()
+    nans = nans_by_time.sum()
+    # The totals and NaN counts of the parsed slots feed the anomaly detection, see anomaly.detect_anomaly_days.
+    anomaly.record_daily_stats(traffic_data=traffic_data, traffic_type=traffic_type, city=city, service=service, day=day, nans=nans_by_time)
 
     if nans > 0:
         logger.debug(f'WARNING: file of traffic_type={traffic_type.value}, city={city.value}, service={service.value}, day={day} contains NaN values n={nans}, share={nans / (traffic_data.shape[0] * traffic_data.shape[1])}. Replacing them with 0.')
@@ -59,6 +198,23 @@ def load_traffic_data_file(traffic_type: TrafficType, city: City, service: Servi
     return traffic_data
 
 
+def convert_traffic_data_file_to_cache(traffic_type: TrafficType, city: City, service: Service, day: date, overwrite: bool = False) -> str:
+    if not overwrite and cache.is_traffic_data_file_cached(traffic_type=traffic_type, city=city, service=service, day=day):
+        return file_io.get_mobile_traffic_cache_file_path(traffic_type=traffic_type, city=city, service=service, day=day)
+    traffic_data = load_traffic_data_file(traffic_type=traffic_type, city=city, service=service, day=day, use_cache=False)
+    return cache.save_cached_traffic_data_file(traffic_data=traffic_data, traffic_type=traffic_type, city=city, service=service, day=day)
+
+
+def convert_traffic_data_city_to_cache(city: City, traffic_type: List[TrafficType] = None, service: List[Service] = None, day: List[date] = None, overwrite: bool = False) -> List[str]:
+    traffic_type = traffic_type if traffic_type is not None else [TrafficType.UL, TrafficType.DL]
+    service = service if service is not None else [s for s in Service]
+    day = day if day is not None else TimeOptions.get_days()
+    get_location_list(city=city)
+    tuples = list(itertools.product(traffic_type, service, day))
+    file_paths = Parallel(n_jobs=-1)(delayed(convert_traffic_data_file_to_cache)(traffic_type=t, city=city, service=s, day=d, overwrite=overwrite) for t, s, d in tuples)
+    return file_paths
+
+
 def load_tile_geo_data():
     tile_geo_data = {}
     for city in City:
@@ -67,10 +223,19 @@ def load_tile_geo_data():
     return tile_geo_data
 
 
-def load_tile_geo_data_city(city: City):
-    file_path = config.get_data_file_path(city=city)
+def load_tile_geo_data_city(city: City, use_cache: bool = True):
+    # Parsing the GeoJSON is slow, so the geometries are kept in a GeoParquet file next to the binary cache after the first read.
+    if use_cache and cache.is_tile_geo_data_cached(city=city):
+        return cache.load_cached_tile_geo_data(city=city)
+    import geopandas as gpd
+    file_path = file_io.get_data_file_path(city=city)
     data = gpd.read_file(filename=file_path, engine="pyogrio")
     data['tile_id'] = data['tile_id'].astype(int)
     data.rename(columns={'tile_id': 'tile'}, inplace=True)
     data.set_index(keys='tile', inplace=True)
+    if use_cache:
+        try:
+            cache.save_cached_tile_geo_data(tile_geo_data=data, city=city)
+        except (OSError, ImportError) as e:
+            logger.debug(f'Could not cache the tile geometries of city={city.value}: {e}')
     return data
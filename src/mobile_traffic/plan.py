@@ -0,0 +1,63 @@
+from dataclasses import dataclass
+from datetime import date, time
+from typing import List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .enums import City, TrafficType, TimeOptions
+from .clean import get_removed_datetime_mask
+
+
+@dataclass(frozen=True)
+class NightQuery:
+    # Everything a night aggregate depends on besides the city and services it is computed for. It is passed whole through the aggregation
+    # and to the scheduler workers, so an option cannot be dropped on the way, and it is what the result cache key is built from.
+    traffic_type: TrafficType
+    start_night: time
+    end_night: time
+    remove_noisy_nights: bool = True
+    streaming: bool = True
+    # Only applies to streaming=False: the streaming aggregation holds one day of data at a time and has no cube to put on disk.
+    memmap_dir: str = None
+    density_threshold: float = None
+    # Tiles can be restricted per city, e.g. to the result of a spatial query. Cities without an entry are loaded whole.
+    tile: Dict[City, List[int]] = None
+    dtype: np.dtype = None
+    # A table of anomaly.detect_anomaly_days replaces the hand-picked anomaly days when noisy nights are removed.
+    anomalies: pd.DataFrame = None
+    # Days whose files are aggregated, all the days of the dataset by default.
+    day: List[date] = None
+
+    def __post_init__(self):
+        if self.streaming and self.memmap_dir is not None:
+            raise ValueError('memmap_dir only applies to streaming=False. The streaming aggregation already holds one day of data at a time.')
+
+    def get_tile(self, city: City) -> List[int]:
+        return None if self.tile is None else self.tile.get(city)
+
+    def get_days(self) -> pd.DatetimeIndex:
+        return TimeOptions.get_days() if self.day is None else pd.DatetimeIndex(self.day)
+
+
+def plan_night_query(city: City, start_night: time, end_night: time, day: List[date] = None, remove_noisy_nights: bool = True, anomalies: pd.DataFrame = None) -> Dict[date, pd.TimedeltaIndex]:
+    # Maps every day that contributes to the query to the time columns needed from its files. Days that are not in the plan do not need to be read at all.
+    day = day if day is not None else TimeOptions.get_days()
+    times = TimeOptions.get_times()
+    keep = get_kept_day_time_mask(city=city, start_night=start_night, end_night=end_night, day=day, remove_noisy_nights=remove_noisy_nights, anomalies=anomalies)
+    return {d: times[keep[j]] for j, d in enumerate(day) if keep[j].any()}
+
+
+def get_kept_day_time_mask(city: City, start_night: time, end_night: time, day: List[date], remove_noisy_nights: bool = True, anomalies: pd.DataFrame = None) -> np.ndarray:
+    times = TimeOptions.get_times()
+    datetime_index = np.add.outer(pd.DatetimeIndex(day), times).flatten()
+    removed = get_removed_datetime_mask(datetime_index=datetime_index, city=city, start=start_night, end=end_night, remove_noisy_nights=remove_noisy_nights, anomalies=anomalies)
+    return ~removed.reshape(len(day), len(times))
+
+
+def get_plan_day_time(plan: Dict[date, pd.TimedeltaIndex]) -> Tuple[pd.DatetimeIndex, pd.TimedeltaIndex, np.ndarray]:
+    # The smallest (day, time) cube that covers a plan, and the mask of the datetimes of that cube, in day-major order, that the plan does not keep.
+    times = TimeOptions.get_times()
+    kept_times = times[np.isin(times, np.concatenate([t.values for t in plan.values()]))] if plan else times[:0]
+    removed = np.array([~np.isin(kept_times, t) for t in plan.values()], dtype=bool).reshape(len(plan), len(kept_times))
+    return pd.DatetimeIndex(list(plan)), kept_times, removed.ravel()
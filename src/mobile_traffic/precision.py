@@ -0,0 +1,45 @@
+import numpy as np
+import xarray as xr
+
+from .utils import logger
+
+# Sums over nights are accumulated in this type, whatever the storage type, so that float32 inputs do not lose precision in long sums.
+accumulation_dtype = np.float64
+
+
+def get_dtype(dtype: np.dtype = None, default: np.dtype = np.float64) -> np.dtype:
+    # Values are held in memory as floats. Integer types are only used for quantized storage on disk, see get_quantization_encoding.
+    dtype = np.dtype(default if dtype is None else dtype)
+    if not np.issubdtype(dtype, np.floating):
+        raise ValueError(f'dtype={dtype} is not a floating point type. Integer types are supported when saving only.')
+    return dtype
+
+
+def is_quantized_dtype(dtype: np.dtype) -> bool:
+    return dtype is not None and np.issubdtype(np.dtype(dtype), np.integer)
+
+
+def get_quantization_encoding(xar: xr.DataArray, dtype: np.dtype, scale_factor: float = None) -> dict:
+    # Scaled integer packing: a value x is stored as q = round(x / scale_factor) and read back as q * scale_factor, so the error per value is at most scale_factor / 2.
+    # Without a scale factor it is chosen so that the largest value of the array fits, which bounds the error by max|x| / (2 * (iinfo(dtype).max - 1)),
+    # e.g. 7.6e-6 * max|x| for uint16 and 1.2e-10 * max|x| for uint32. The error of a sum over n values is at most n times that of one value.
+    # The largest integer of the type is reserved for missing values.
+    dtype = np.dtype(dtype)
+    if scale_factor is None:
+        max_value = float(abs(xar).max()) if xar.size > 0 else 0.
+        scale_factor = max_value / (np.iinfo(dtype).max - 1) if max_value > 0 else 1.
+    return {'dtype': dtype, 'scale_factor': scale_factor, '_FillValue': np.iinfo(dtype).max}
+
+
+def clip_to_quantization_range(xar: xr.DataArray, encoding: dict, saturate: bool = True) -> xr.DataArray:
+    # Values outside the range of the integer type would wrap around when packed. They are saturated, or rejected with saturate=False.
+    dtype, scale_factor = np.dtype(encoding['dtype']), encoding['scale_factor']
+    low, high = np.iinfo(dtype).min * scale_factor, (np.iinfo(dtype).max - 1) * scale_factor
+    n_outside = int(((xar < low) | (xar > high)).sum())
+    if n_outside > 0:
+        message = f'{n_outside} values are outside the range [{low}, {high}] of dtype={dtype} with scale_factor={scale_factor}'
+        if not saturate:
+            raise ValueError(f'{message}. Pass clip=True to saturate them.')
+        logger.warning(f'{message}. Saturating them.')
+        xar = xar.clip(min=low, max=high)
+    return xar
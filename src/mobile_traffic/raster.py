@@ -0,0 +1,189 @@
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .enums import City, TrafficDataDimensions
+from .load import load_tile_geo_data_city
+from . import sparsity
+
+# Side of the square blocks the grid is processed in when it is too large to hold at once, e.g. the France grid of 9742 x 9588 cells.
+block_size = 1024
+# Lambert-93, the metric projection the tiles are a regular grid in.
+_grid_crs = 2154
+
+
+class TileGrid:
+    def __init__(self, tile: pd.Index, row: np.ndarray, col: np.ndarray, shape: Tuple[int, int]):
+        # Cell (row, col) of each tile on a grid of the given shape, rows counted from the top.
+        self.tile = pd.Index(tile, name=TrafficDataDimensions.TILE.value)
+        self.row = np.asarray(row, dtype=np.int64)
+        self.col = np.asarray(col, dtype=np.int64)
+        self.shape = tuple(shape)
+        self._blocks: Dict[Tuple[int, int], Dict[Tuple[int, int], np.ndarray]] = {}
+
+    @staticmethod
+    def from_tile_geo_data(tile_geo_data) -> 'TileGrid':
+        # Each tile is placed at the cell of its centroid, on a grid whose step is the median tile size. This does not depend on how tiles are numbered.
+        # Reprojecting a 100 m grid to longitude/latitude and back moves centroids by far less than half a tile, so rounding recovers the cells exactly.
+        projected = tile_geo_data.to_crs(_grid_crs) if tile_geo_data.crs is not None else tile_geo_data
+        bounds = projected.geometry.bounds
+        size_x, size_y = float(np.median(bounds['maxx'] - bounds['minx'])), float(np.median(bounds['maxy'] - bounds['miny']))
+        x, y = ((bounds['minx'] + bounds['maxx']) / 2).to_numpy(), ((bounds['miny'] + bounds['maxy']) / 2).to_numpy()
+        row, col = np.rint((y.max() - y) / size_y).astype(np.int64), np.rint((x - x.min()) / size_x).astype(np.int64)
+        shape = (int(row.max()) + 1, int(col.max()) + 1) if len(row) > 0 else (0, 0)
+        if len(np.unique(row * shape[1] + col)) < len(row):
+            raise ValueError(f'The tile geometries do not form a regular grid of {size_x} x {size_y} tiles: several tiles fall in the same cell')
+        return TileGrid(tile=tile_geo_data.index, row=row, col=col, shape=shape)
+
+    def get_position(self, tile: pd.Index) -> np.ndarray:
+        position = self.tile.get_indexer(tile)
+        if (position < 0).any():
+            raise ValueError(f'Tiles {list(pd.Index(tile)[position < 0][:10])} are not on the tile grid')
+        return position
+
+    def get_blocks(self, block_shape: Tuple[int, int]) -> Dict[Tuple[int, int], np.ndarray]:
+        # Positions of the tiles falling in each block of the grid, for the blocks holding at least one tile. Computed once per block shape.
+        block_shape = tuple(block_shape)
+        if block_shape not in self._blocks:
+            n_block_cols = _n_blocks(n=self.shape[1], size=block_shape[1])
+            block_id = (self.row // block_shape[0]) * n_block_cols + self.col // block_shape[1]
+            order = np.argsort(block_id, kind='stable')
+            block_ids, starts = np.unique(block_id[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self._blocks[block_shape] = {(int(b) // n_block_cols, int(b) % n_block_cols): order[s:e] for b, s, e in zip(block_ids, starts, ends)}
+        return self._blocks[block_shape]
+
+
+_tile_grids: Dict[City, TileGrid] = {}
+
+
+def get_tile_grid(city: City) -> TileGrid:
+    # The cells of the tiles of a city are read from its tile geometries once per process.
+    if city not in _tile_grids:
+        _tile_grids[city] = TileGrid.from_tile_geo_data(tile_geo_data=load_tile_geo_data_city(city=city))
+    return _tile_grids[city]
+
+
+def _get_grid(city: City = None, grid: TileGrid = None) -> TileGrid:
+    # Grids that are not those of a city, e.g. the France grid, which has no City member, are built with TileGrid.from_tile_geo_data and passed as grid.
+    if grid is not None:
+        return grid
+    if city is None:
+        raise ValueError('Either city or grid must be given')
+    return get_tile_grid(city=city)
+
+
+def to_raster(xar: xr.DataArray, city: City = None, fill_value: float = 0., chunks: Tuple[int, int] = None, grid: TileGrid = None) -> xr.DataArray:
+    # Replaces the tile dimension by (row, col) grid dimensions, on the tile grid of the city. Cells without a tile, or whose tile is not in xar, hold fill_value.
+    # With chunks the raster is a dask array whose blocks are only filled when computed, so a national grid never has to be held at once. The rows of xar
+    # falling in a block are only selected when that block is computed, and a dask xar is not loaded beyond them.
+    grid = _get_grid(city=city, grid=grid)
+    xar = xar.transpose(TrafficDataDimensions.TILE.value, ...)
+    other_dims = list(xar.dims[1:])
+    other_shape = tuple(xar.shape[1:])
+    dtype = np.result_type(xar.dtype, np.asarray(fill_value).dtype)
+    position = grid.get_position(tile=xar.indexes[TrafficDataDimensions.TILE.value])
+    shape = grid.shape
+    if chunks is None:
+        values = np.asarray(sparsity.to_dense(xar=xar).values)
+        values = _to_grid_values(values=values, position=position, grid=grid, fill_value=fill_value, dtype=dtype)
+        data = _fill_raster_block(values=values, row=grid.row, col=grid.col, row_start=0, col_start=0, block_shape=shape, other_shape=other_shape, fill_value=fill_value, dtype=dtype)
+    else:
+        import dask.array as da
+        from dask import delayed
+
+        # Row of xar of each tile of the grid, -1 for the tiles xar does not cover.
+        xar_row = np.full(len(grid.tile), -1, dtype=np.int64)
+        xar_row[position] = np.arange(len(position))
+        # A dask array is indexed lazily as it is. Other arrays enter the graph once and are indexed inside it.
+        values = xar.data if isinstance(xar.data, da.Array) else delayed(xar.data, pure=True)
+        blocks = grid.get_blocks(block_shape=chunks)
+        rows = []
+        for i in range(_n_blocks(n=shape[0], size=chunks[0])):
+            cols = []
+            for j in range(_n_blocks(n=shape[1], size=chunks[1])):
+                block_shape = (min(chunks[0], shape[0] - i * chunks[0]), min(chunks[1], shape[1] - j * chunks[1]))
+                block_position = blocks.get((i, j), np.zeros(0, dtype=np.int64))
+                block_position = block_position[xar_row[block_position] >= 0]
+                block = delayed(_fill_raster_block)(values=values[xar_row[block_position]], row=grid.row[block_position], col=grid.col[block_position], row_start=i * chunks[0], col_start=j * chunks[1], block_shape=block_shape, other_shape=other_shape, fill_value=fill_value, dtype=dtype)
+                cols.append(da.from_delayed(block, shape=block_shape + other_shape, dtype=dtype))
+            rows.append(da.concatenate(cols, axis=1))
+        data = da.concatenate(rows, axis=0)
+    coords = {TrafficDataDimensions.ROW.value: np.arange(shape[0]), TrafficDataDimensions.COL.value: np.arange(shape[1])}
+    coords.update({d: xar.coords[d] for d in other_dims if d in xar.coords})
+    return xr.DataArray(data, coords=coords, dims=[TrafficDataDimensions.ROW.value, TrafficDataDimensions.COL.value] + other_dims)
+
+
+def from_raster(raster: xr.DataArray, city: City = None, tile: pd.Index = None, grid: TileGrid = None) -> xr.DataArray:
+    # Reads the grid cells of the given tiles, all tiles of the city by default, back into a tile-indexed array. A dask raster only computes the blocks holding those tiles.
+    grid = _get_grid(city=city, grid=grid)
+    tile = grid.tile if tile is None else pd.Index(tile, name=TrafficDataDimensions.TILE.value)
+    position = grid.get_position(tile=tile)
+    row, col = grid.row[position], grid.col[position]
+    raster = raster.transpose(TrafficDataDimensions.ROW.value, TrafficDataDimensions.COL.value, ...)
+    other_dims = list(raster.dims[2:])
+    if hasattr(raster.data, 'vindex'):
+        values = raster.data.vindex[row, col].compute()
+    else:
+        values = np.asarray(raster.data)[row, col]
+    coords = {TrafficDataDimensions.TILE.value: tile}
+    coords.update({d: raster.coords[d] for d in other_dims if d in raster.coords})
+    return xr.DataArray(values, coords=coords, dims=[TrafficDataDimensions.TILE.value] + other_dims)
+
+
+def convolve_tiles(xar: xr.DataArray, kernel: np.ndarray, city: City = None, block_shape: Tuple[int, int] = None, grid: TileGrid = None) -> xr.DataArray:
+    # Applies a 2-D kernel over the tile grid of the city to every tile, treating cells without a tile, or whose tile is not in xar, as 0. Returns a tile-indexed array like the input.
+    # The grid is processed block by block, each block padded with the cells within the kernel radius, so memory is bounded by one padded block.
+    from scipy import ndimage
+
+    kernel = np.asarray(kernel, dtype=np.float64)
+    block_shape = tuple(block_shape) if block_shape is not None else (block_size, block_size)
+    radius = (kernel.shape[0] // 2, kernel.shape[1] // 2)
+    if radius[0] > block_shape[0] or radius[1] > block_shape[1]:
+        raise ValueError(f'The kernel of shape {kernel.shape} is larger than the blocks of shape {block_shape}')
+
+    grid = _get_grid(city=city, grid=grid)
+    shape = grid.shape
+    dims = xar.dims
+    xar = sparsity.to_dense(xar=xar).transpose(TrafficDataDimensions.TILE.value, ...)
+    position = grid.get_position(tile=xar.indexes[TrafficDataDimensions.TILE.value])
+    values = _to_grid_values(values=np.asarray(xar.values, dtype=np.float64), position=position, grid=grid, fill_value=0., dtype=np.float64)
+    blocks = grid.get_blocks(block_shape=block_shape)
+    kernel_ = kernel.reshape(kernel.shape + (1,) * (values.ndim - 1))
+    result = np.zeros_like(values)
+    for (i, j), block_position in blocks.items():
+        row_start, col_start = max(i * block_shape[0] - radius[0], 0), max(j * block_shape[1] - radius[1], 0)
+        row_end, col_end = min((i + 1) * block_shape[0] + radius[0], shape[0]), min((j + 1) * block_shape[1] + radius[1], shape[1])
+        # The padding comes from the tiles of the neighbouring blocks.
+        window = np.concatenate([blocks.get((i + di, j + dj), np.zeros(0, dtype=np.int64)) for di in [-1, 0, 1] for dj in [-1, 0, 1]])
+        window = window[(grid.row[window] >= row_start) & (grid.row[window] < row_end) & (grid.col[window] >= col_start) & (grid.col[window] < col_end)]
+        raster = _fill_raster_block(values=values[window], row=grid.row[window], col=grid.col[window], row_start=row_start, col_start=col_start, block_shape=(row_end - row_start, col_end - col_start), other_shape=values.shape[1:], fill_value=0., dtype=np.float64)
+        convolved = ndimage.convolve(raster, kernel_, mode='constant', cval=0.)
+        result[block_position] = convolved[grid.row[block_position] - row_start, grid.col[block_position] - col_start]
+    return xar.copy(data=result[position]).transpose(*dims)
+
+
+def smooth_tiles(xar: xr.DataArray, city: City = None, size: int = 3, block_shape: Tuple[int, int] = None, grid: TileGrid = None) -> xr.DataArray:
+    # Mean over the size x size neighbourhood of every tile, counting cells without a tile as 0.
+    return convolve_tiles(xar=xar, kernel=np.full((size, size), 1 / size ** 2), city=city, block_shape=block_shape, grid=grid)
+
+
+def _to_grid_values(values: np.ndarray, position: np.ndarray, grid: TileGrid, fill_value: float, dtype: np.dtype) -> np.ndarray:
+    # Lays the values out in the tile order of the grid, so that the blocks of the grid, computed once, apply to any subset of its tiles.
+    if len(position) == len(grid.tile) and np.array_equal(position, np.arange(len(grid.tile))):
+        return values.astype(dtype, copy=False)
+    grid_values = np.full((len(grid.tile),) + values.shape[1:], fill_value, dtype=dtype)
+    grid_values[position] = values
+    return grid_values
+
+
+def _fill_raster_block(values: np.ndarray, row: np.ndarray, col: np.ndarray, row_start: int, col_start: int, block_shape: Tuple[int, int], other_shape: Tuple[int, ...], fill_value: float, dtype: np.dtype) -> np.ndarray:
+    block = np.full(tuple(block_shape) + tuple(other_shape), fill_value, dtype=dtype)
+    block[row - row_start, col - col_start] = values.todense() if type(values).__module__.startswith('sparse') else values
+    return block
+
+
+def _n_blocks(n: int, size: int) -> int:
+    return -(-n // size)
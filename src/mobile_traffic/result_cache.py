@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+from dataclasses import replace
+from typing import List
+
+import numpy as np
+import xarray as xr
+
+from .enums import City, Service, TrafficType, TimeOptions
+from .utils import Calendar, Anomalies, logger
+from . import file_io
+from . import anomaly
+from .plan import NightQuery
+
+max_size_bytes = int(os.getenv('RESULT_CACHE_MAX_SIZE', 50 * 1024 ** 3))
+
+
+def get_result_cache_key(query: NightQuery, city: City, service: Service) -> str:
+    # Results are cached per service so that a query only computes the services it has not seen yet.
+    # The key covers everything the result depends on: the query, the calendar and anomaly definitions, and the modification times of the source files.
+    tile, anomalies = query.get_tile(city=city), query.anomalies
+    key = {'traffic_type': query.traffic_type.value,
+           'start_night': str(query.start_night),
+           'end_night': str(query.end_night),
+           'city': city.value,
+           'service': service.value,
+           'remove_noisy_nights': query.remove_noisy_nights,
+           'holidays': [str(d) for d in Calendar.holidays()],
+           'fridays_and_saturdays': [str(d) for d in Calendar.fridays_and_saturdays()],
+           'anomalies': [str(d) for d in (Anomalies.get_anomaly_dates_by_city(city=city) if anomalies is None else anomaly.get_anomaly_dates(anomalies=anomalies, city=city))],
+           'days': [str(d) for d in query.get_days()],
+           'source_mtimes': _get_source_mtimes(traffic_type=query.traffic_type, city=city, service=service)}
+    # Only restricted or reduced-precision queries carry a tile list or a dtype, so that the keys of default queries stay the same.
+    if tile is not None:
+        key['tile'] = [int(t) for t in tile]
+    if query.dtype is not None:
+        key['dtype'] = np.dtype(query.dtype).name
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def load_cached_result(key: str) -> xr.DataArray:
+    file_path = _get_result_file_path(key=key)
+    # Touching the file records the access, which is what the LRU eviction sorts on. A result evicted by another process in the meantime is a cache miss.
+    try:
+        os.utime(file_path)
+        return file_io.load_mobile_traffic_data_city(file_path=file_path)
+    except FileNotFoundError:
+        return None
+
+
+def save_cached_result(key: str, data: xr.DataArray):
+    file_path = _get_result_file_path(key=key)
+    os.makedirs(file_io.result_cache_dir, exist_ok=True)
+    tmp_file_path = f'{file_path}.{os.getpid()}.tmp'
+    file_io.save_mobile_traffic_data_city(data=data, file_path=tmp_file_path)
+    os.replace(tmp_file_path, file_path)
+    evict_results(max_size_bytes=max_size_bytes)
+
+
+def invalidate_result(query: NightQuery, city: City, service: List[Service]):
+    traffic_types = [TrafficType.UL, TrafficType.DL] if query.traffic_type == TrafficType.UL_AND_DL else [query.traffic_type]
+    for t in traffic_types:
+        for s in service:
+            file_path = _get_result_file_path(key=get_result_cache_key(query=replace(query, traffic_type=t), city=city, service=s))
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+
+def clear_results():
+    for file_path in _get_result_file_paths():
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def evict_results(max_size_bytes: int):
+    # Removes the least recently used results until the cache fits in max_size_bytes.
+    # Scheduler workers evict concurrently, so files removed by another worker since they were listed are skipped.
+    stats = {}
+    for file_path in _get_result_file_paths():
+        try:
+            stats[file_path] = os.stat(file_path)
+        except FileNotFoundError:
+            pass
+    file_paths = sorted(stats, key=lambda f: stats[f].st_mtime)
+    size = sum(s.st_size for s in stats.values())
+    for file_path in file_paths:
+        if size <= max_size_bytes:
+            break
+        size -= stats[file_path].st_size
+        try:
+            os.remove(file_path)
+            logger.debug(f'Evicted cached result {file_path}')
+        except FileNotFoundError:
+            pass
+
+
+def _get_source_mtimes(traffic_type: TrafficType, city: City, service: Service) -> List[float]:
+    traffic_types = [TrafficType.UL, TrafficType.DL] if traffic_type == TrafficType.UL_AND_DL else [traffic_type]
+    mtimes = []
+    for t in traffic_types:
+        for d in TimeOptions.get_days():
+            file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=t, city=city, service=service, day=d)
+            mtimes.append(os.path.getmtime(file_path) if os.path.exists(file_path) else None)
+    return mtimes
+
+
+def _get_result_file_path(key: str) -> str:
+    return f'{file_io.result_cache_dir}/{key}.nc'
+
+
+def _get_result_file_paths() -> List[str]:
+    if not os.path.exists(file_io.result_cache_dir):
+        return []
+    return [os.path.join(file_io.result_cache_dir, f) for f in os.listdir(file_io.result_cache_dir) if f.endswith('.nc')]
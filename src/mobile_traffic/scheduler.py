@@ -0,0 +1,57 @@
+import os
+from typing import List, Dict, Callable, Any
+
+from joblib import Parallel, delayed
+
+from .enums import Backend
+
+
+class Scheduler:
+    def __init__(self, backend: Backend = Backend.PROCESSES, n_jobs: int = -1, max_memory_bytes: int = None, dask_address: str = None):
+        self.backend = backend
+        self.n_jobs = n_jobs
+        self.max_memory_bytes = max_memory_bytes
+        self.dask_address = dask_address
+
+    def get_n_workers(self, task_memory_bytes: int = None) -> int:
+        n_workers = os.cpu_count() if self.n_jobs < 0 else self.n_jobs
+        if self.backend == Backend.SERIAL:
+            n_workers = 1
+        # Never run more tasks at once than fit in the memory budget.
+        if self.max_memory_bytes is not None and task_memory_bytes is not None:
+            n_workers = min(n_workers, max(1, self.max_memory_bytes // task_memory_bytes))
+        return n_workers
+
+    def get_inner_n_jobs(self, n_workers: int) -> int:
+        # Splits the cores between the tasks so that the file loading inside each task does not oversubscribe the machine.
+        return max(1, os.cpu_count() // n_workers)
+
+    def map(self, func: Callable, tasks: List[Dict[str, Any]], n_workers: int = None) -> List[Any]:
+        n_workers = n_workers if n_workers is not None else self.get_n_workers()
+        if self.backend == Backend.SERIAL:
+            return [func(**task) for task in tasks]
+        elif self.backend == Backend.THREADS:
+            return Parallel(n_jobs=n_workers, backend='threading')(delayed(func)(**task) for task in tasks)
+        elif self.backend == Backend.PROCESSES:
+            return Parallel(n_jobs=n_workers, backend='loky')(delayed(func)(**task) for task in tasks)
+        elif self.backend == Backend.DASK:
+            return self._map_dask(func=func, tasks=tasks, n_workers=n_workers)
+        else:
+            raise ValueError(f'Invalid backend {self.backend}')
+
+    def _map_dask(self, func: Callable, tasks: List[Dict[str, Any]], n_workers: int) -> List[Any]:
+        from dask.distributed import Client, LocalCluster
+
+        if self.dask_address is not None:
+            client, cluster = Client(self.dask_address), None
+        else:
+            memory_limit = 'auto' if self.max_memory_bytes is None else self.max_memory_bytes // n_workers
+            cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1, processes=True, memory_limit=memory_limit)
+            client = Client(cluster)
+        try:
+            futures = [client.submit(func, pure=False, **task) for task in tasks]
+            return client.gather(futures)
+        finally:
+            client.close()
+            if cluster is not None:
+                cluster.close()
@@ -0,0 +1,90 @@
+from typing import List, TYPE_CHECKING
+
+import numpy as np
+import xarray as xr
+
+if TYPE_CHECKING:
+    import sparse
+
+
+def is_sparse(xar: xr.DataArray) -> bool:
+    return type(xar.data).__module__.startswith('sparse')
+
+
+def get_density(xar: xr.DataArray) -> float:
+    if is_sparse(xar):
+        return xar.data.nnz / max(xar.size, 1)
+    return np.count_nonzero(xar.values) / max(xar.size, 1)
+
+
+def to_sparse(xar: xr.DataArray) -> xr.DataArray:
+    import sparse
+
+    return xar if is_sparse(xar) else xar.copy(data=sparse.COO.from_numpy(xar.values))
+
+
+def to_dense(xar: xr.DataArray) -> xr.DataArray:
+    return xar.copy(data=xar.data.todense()) if is_sparse(xar) else xar
+
+
+def to_sparse_if_sparse(xar: xr.DataArray, density_threshold: float = None) -> xr.DataArray:
+    # Arrays whose share of non-zero values is below the threshold are stored as COO, the others stay dense. Without a threshold nothing changes.
+    if density_threshold is None:
+        return xar
+    return to_sparse(xar) if get_density(xar) < density_threshold else to_dense(xar)
+
+
+def concat(xars: List[xr.DataArray], dim: str, density_threshold: float = None) -> xr.DataArray:
+    # Pieces may mix dense and sparse storage, which xr.concat does not support. The result is sparse when its overall density is below the threshold.
+    # A DataArray has a single backing array, so once services are concatenated they share one storage. The choice per service only holds where
+    # services are kept apart, i.e. in the result cache, see aggregate.get_night_traffic_city_by_tile_service_time_cached.
+    if not any(is_sparse(x) for x in xars):
+        return xr.concat(xars, dim=dim)
+    nnz = sum(x.data.nnz if is_sparse(x) else np.count_nonzero(x.values) for x in xars)
+    size = sum(x.size for x in xars)
+    if density_threshold is not None and nnz / max(size, 1) < density_threshold:
+        return xr.concat([to_sparse(x) for x in xars], dim=dim)
+    return xr.concat([to_dense(x) for x in xars], dim=dim)
+
+
+def coo_from_slabs(slabs, shape) -> 'sparse.COO':
+    # Builds a COO array from (index, 2-D slab) pairs, where index addresses the trailing dimensions. Only one dense slab is held at a time.
+    import sparse
+
+    coords, data = [], []
+    for index, slab in slabs:
+        slab = np.asarray(slab)
+        nonzero = np.nonzero(slab)
+        coords.append(np.vstack(list(nonzero) + [np.full(len(nonzero[0]), i) for i in index]))
+        data.append(slab[nonzero])
+    coords = np.hstack(coords) if coords else np.zeros((len(shape), 0), dtype=np.intp)
+    data = np.concatenate(data) if data else np.zeros(0)
+    return sparse.COO(coords=coords, data=data, shape=shape)
+
+
+def to_coo_dataset(xar: xr.DataArray) -> xr.Dataset:
+    # File formats have no sparse arrays, so we store the non-zero values with one index variable per dimension next to the original coordinates.
+    data = to_sparse(xar).data
+    data_vars = {f'index_{dim}': ('nonzero', data.coords[i]) for i, dim in enumerate(xar.dims)}
+    data_vars['values'] = ('nonzero', data.data)
+    return xr.Dataset(data_vars=data_vars, coords=xar.coords, attrs={'sparse_dims': ' '.join(xar.dims)})
+
+
+def is_coo_dataset(ds: xr.Dataset) -> bool:
+    return 'sparse_dims' in ds.attrs
+
+
+def from_coo_dataset(ds: xr.Dataset) -> xr.DataArray:
+    import sparse
+
+    dims = ds.attrs['sparse_dims'].split(' ')
+    shape = tuple(ds.sizes[dim] for dim in dims)
+    coords = np.vstack([ds[f'index_{dim}'].values for dim in dims])
+    data = sparse.COO(coords=coords, data=ds['values'].values, shape=shape)
+    return xr.DataArray(data, coords={k: v for k, v in ds.coords.items()}, dims=dims)
+
+
+def add(xar_a: xr.DataArray, xar_b: xr.DataArray, density_threshold: float = None) -> xr.DataArray:
+    if is_sparse(xar_a) and is_sparse(xar_b):
+        return xar_a + xar_b
+    return to_sparse_if_sparse(xar=to_dense(xar_a) + to_dense(xar_b), density_threshold=density_threshold)
@@ -0,0 +1,136 @@
+import os
+import hashlib
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .enums import City, TrafficDataDimensions
+from .load import load_tile_geo_data_city
+from .aggregate import MobileTrafficDataset
+from . import file_io
+from . import sparsity
+
+# Lambert-93, the metric projection used for areas when the geometries come in longitude/latitude.
+_area_crs = 2154
+# Query geometries are assumed to be longitude/latitude unless a crs is given.
+_query_crs = 4326
+
+_tile_spatial_indexes: Dict[City, 'TileSpatialIndex'] = {}
+
+
+class TileRegionOperator:
+    def __init__(self, weights, tile: pd.Index, region: pd.Index):
+        # weights[r, t] is the share of the area of tile t that lies in region r.
+        self.weights = weights
+        self.tile = tile
+        self.region = region
+
+    def apply(self, xar: xr.DataArray) -> xr.DataArray:
+        # Rolls the tile dimension up to regions with one sparse matmul over all the other dimensions at once.
+        other_dims = [d for d in xar.dims if d != TrafficDataDimensions.TILE.value]
+        xar = xar.transpose(TrafficDataDimensions.TILE.value, *other_dims)
+        tile_position = self.tile.get_indexer(xar.indexes[TrafficDataDimensions.TILE.value])
+        known = tile_position >= 0
+        weights = self.weights[:, tile_position[known]]
+        values = xar.data[known].reshape((int(known.sum()), int(np.prod([xar.sizes[d] for d in other_dims]))))
+        if sparsity.is_sparse(xar):
+            import sparse
+            region_values = sparse.COO.from_scipy_sparse(weights) @ values
+        else:
+            region_values = weights @ np.asarray(values)
+        region_values = region_values.reshape((len(self.region),) + tuple(xar.sizes[d] for d in other_dims))
+        coords = {d: xar.coords[d] for d in other_dims if d in xar.coords}
+        coords[TrafficDataDimensions.REGION.value] = self.region
+        return xr.DataArray(region_values, coords=coords, dims=[TrafficDataDimensions.REGION.value] + other_dims)
+
+    def save(self, file_path: str):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        weights = self.weights.tocsr()
+        np.savez(file_path, data=weights.data, indices=weights.indices, indptr=weights.indptr, shape=weights.shape, tile=np.asarray(self.tile), region=np.asarray(self.region, dtype=str))
+
+    @classmethod
+    def load(cls, file_path: str) -> 'TileRegionOperator':
+        from scipy.sparse import csr_matrix
+
+        f = np.load(file_path)
+        weights = csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return cls(weights=weights, tile=pd.Index(f['tile'], name=TrafficDataDimensions.TILE.value), region=pd.Index(f['region'], name=TrafficDataDimensions.REGION.value))
+
+
+class TileSpatialIndex:
+    def __init__(self, tiles):
+        from shapely import STRtree
+
+        self.tile = pd.Index(tiles.index, name=TrafficDataDimensions.TILE.value)
+        self.crs = tiles.crs
+        self.tree = STRtree(tiles.geometry.values)
+
+    def query(self, geometry, crs=_query_crs, predicate: str = 'intersects') -> pd.Index:
+        # Returns the tiles matching the geometry, in the tile order of the city.
+        if crs is not None and self.crs is not None:
+            import geopandas as gpd
+            geometry = gpd.GeoSeries([geometry], crs=crs).to_crs(self.crs).iloc[0]
+        positions = np.sort(self.tree.query(geometry, predicate=predicate))
+        return self.tile[positions]
+
+
+def get_tile_spatial_index(city: City) -> TileSpatialIndex:
+    # Built once per process from the cached tile geometries.
+    if city not in _tile_spatial_indexes:
+        _tile_spatial_indexes[city] = TileSpatialIndex(tiles=load_tile_geo_data_city(city=city))
+    return _tile_spatial_indexes[city]
+
+
+def get_tiles_at_point(city: City, x: float, y: float, crs=_query_crs) -> pd.Index:
+    # A point on the border of several tiles returns all of them.
+    from shapely import Point
+    return get_tile_spatial_index(city=city).query(geometry=Point(x, y), crs=crs)
+
+
+def get_tiles_in_bbox(city: City, bbox: Tuple[float, float, float, float], crs=_query_crs) -> pd.Index:
+    # bbox is (min_x, min_y, max_x, max_y).
+    from shapely import box
+    return get_tile_spatial_index(city=city).query(geometry=box(*bbox), crs=crs)
+
+
+def get_tiles_in_polygon(city: City, polygon, crs=_query_crs) -> pd.Index:
+    return get_tile_spatial_index(city=city).query(geometry=polygon, crs=crs)
+
+
+def get_tile_region_operator(city: City, regions, region_set: str, region_column: str = None, use_cache: bool = True) -> TileRegionOperator:
+    # regions is a GeoDataFrame of polygons (IRIS zones, districts, ...). The operator is computed once per (city, region set) and cached on disk.
+    regions = regions if region_column is None else regions.set_index(region_column)
+    regions_hash = hashlib.sha256(b''.join(regions.geometry.to_wkb().values) + str(list(regions.index)).encode()).hexdigest()[:16]
+    file_path = file_io.get_tile_region_operator_cache_file_path(city=city, region_set=region_set, regions_hash=regions_hash)
+    if use_cache and os.path.exists(file_path):
+        return TileRegionOperator.load(file_path=file_path)
+
+    operator = build_tile_region_operator(tiles=load_tile_geo_data_city(city=city), regions=regions)
+    if use_cache:
+        operator.save(file_path=file_path)
+    return operator
+
+
+def build_tile_region_operator(tiles, regions) -> TileRegionOperator:
+    import geopandas as gpd
+    from scipy.sparse import csr_matrix
+
+    if tiles.crs is not None and tiles.crs.is_geographic:
+        tiles = tiles.to_crs(epsg=_area_crs)
+    regions = regions.to_crs(tiles.crs) if regions.crs is not None and tiles.crs is not None else regions
+
+    tile = pd.Index(tiles.index, name=TrafficDataDimensions.TILE.value)
+    region = pd.Index(regions.index, name=TrafficDataDimensions.REGION.value)
+    tiles_ = gpd.GeoDataFrame({'tile_position': np.arange(len(tile))}, geometry=tiles.geometry.values, crs=tiles.crs)
+    regions_ = gpd.GeoDataFrame({'region_position': np.arange(len(region))}, geometry=regions.geometry.values, crs=regions.crs)
+    overlap = gpd.overlay(tiles_, regions_, how='intersection', keep_geom_type=True)
+    tile_area = tiles_.geometry.area.values
+    weights = overlap.geometry.area.values / tile_area[overlap['tile_position'].values]
+    weights = csr_matrix((weights, (overlap['region_position'].values, overlap['tile_position'].values)), shape=(len(region), len(tile)))
+    return TileRegionOperator(weights=weights, tile=tile, region=region)
+
+
+def aggregate_tiles_to_regions(dataset: MobileTrafficDataset, operators: Dict[City, TileRegionOperator]) -> MobileTrafficDataset:
+    return MobileTrafficDataset(data={city: operators[city].apply(xar=xar) for city, xar in dataset.data.items()})
@@ -0,0 +1,61 @@
+import os
+from datetime import date
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from .enums import City, Service, TrafficType, TimeOptions
+from .utils import CityDimensions
+from . import file_io
+
+# Side of a tile in meters and origin of the synthetic grid in Lambert-93.
+_tile_size = 100
+_grid_origin = (650000, 6800000)
+
+
+def get_synthetic_grid_shape(city: City, scale: float = 1.0):
+    n_rows, n_cols = CityDimensions.get_city_dim(city=city)
+    return max(1, int(round(n_rows * scale))), max(1, int(round(n_cols * scale)))
+
+
+def generate_synthetic_data(folder_path: str, city: List[City], service: List[Service], day: List[date] = None, scale: float = 1.0, density: float = 0.5, seed: int = 0):
+    # Writes fake traffic files in the raw {city}/{service}/{day}/..._{UL|DL}.txt layout plus one tile geojson per city.
+    # The grid of a city is its CityDimensions grid shrunk by scale, and tiles are numbered row by row.
+    # density is the share of tiles on which a service has any traffic at all, which is how sparse services are simulated.
+    day = day if day is not None else TimeOptions.get_days()
+    rng = np.random.default_rng(seed)
+    times = TimeOptions.get_times()
+    daily_profile = 1.2 + np.sin(2 * np.pi * (np.asarray(times / pd.Timedelta(days=1)) - 0.375))
+    for c in city:
+        n_rows, n_cols = get_synthetic_grid_shape(city=c, scale=scale)
+        tile = np.arange(n_rows * n_cols)
+        generate_synthetic_geo_data(folder_path=folder_path, city=c, scale=scale)
+        for s in service:
+            active = rng.random(len(tile)) < density
+            level = rng.lognormal(mean=0, sigma=1, size=len(tile)) * active
+            for d in day:
+                for t in [TrafficType.UL, TrafficType.DL]:
+                    values = level[:, None] * daily_profile[None, :] * rng.random((len(tile), len(times))) * (10 if t == TrafficType.DL else 1)
+                    file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=t, city=c, service=s, day=d, folder_path=folder_path)
+                    _write_traffic_data_file(file_path=file_path, tile=tile, values=values)
+
+
+def generate_synthetic_geo_data(folder_path: str, city: City, scale: float = 1.0):
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    n_rows, n_cols = get_synthetic_grid_shape(city=city, scale=scale)
+    row, col = np.divmod(np.arange(n_rows * n_cols), n_cols)
+    x, y = _grid_origin[0] + col * _tile_size, _grid_origin[1] + (n_rows - 1 - row) * _tile_size
+    geometry = [box(x_, y_, x_ + _tile_size, y_ + _tile_size) for x_, y_ in zip(x, y)]
+    tiles = gpd.GeoDataFrame({'tile_id': (row * n_cols + col).astype(str)}, geometry=geometry, crs=2154).to_crs(4326)
+    os.makedirs(folder_path, exist_ok=True)
+    tiles.to_file(file_io.get_data_file_path(city=city, folder_path=folder_path), driver='GeoJSON')
+
+
+def _write_traffic_data_file(file_path: str, tile: np.ndarray, values: np.ndarray):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    data = pd.DataFrame(values)
+    data.insert(0, 'tile', tile)
+    data.to_csv(file_path, sep=' ', header=False, index=False, float_format='%.4f')
@@ -0,0 +1,176 @@
+from datetime import date, timedelta
+from typing import List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .enums import City, Service, TrafficType, TrafficDataDimensions, TimeOptions, ProfileKey
+from .load import load_traffic_data, get_location_list
+from .scheduler import Scheduler
+from . import precision
+from . import instrument
+
+
+class MeanProfile:
+    # Mean traffic per 15-minute slot, grouped by time of day, hour and/or weekday. Sums and counts add up, so partial profiles merge exactly.
+    def __init__(self, by: ProfileKey = ProfileKey.WEEKDAY_HOUR):
+        self.by = by
+        self.name = f'mean_by_{by.value}'
+        self.sums = None
+        self.counts = np.zeros(int(np.prod([len(c) for c in _get_profile_coords(by=by)[1]])), dtype=np.int64)
+
+    def update(self, day: date, time: pd.TimedeltaIndex, values: np.ndarray):
+        # values is (tile, time, service). One-hot matrix product folds the time slots of the day into their groups.
+        groups = _get_profile_groups(by=self.by, day=day, time=time)
+        one_hot = np.zeros((len(self.counts), len(time)))
+        one_hot[groups, np.arange(len(time))] = 1
+        sums = np.tensordot(values, one_hot, axes=([1], [1])).astype(precision.accumulation_dtype, copy=False)
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.counts += one_hot.sum(axis=1).astype(np.int64)
+
+    def merge(self, other: 'MeanProfile') -> 'MeanProfile':
+        if other.sums is not None:
+            self.sums = other.sums.copy() if self.sums is None else self.sums + other.sums
+            self.counts = self.counts + other.counts
+        return self
+
+    def result(self, tile: pd.Index, service: List[Service]) -> xr.DataArray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sums / self.counts
+        dims, coords = _get_profile_coords(by=self.by)
+        means = means.reshape((len(tile), len(service)) + tuple(len(c) for c in coords))
+        return xr.DataArray(means, coords={TrafficDataDimensions.TILE.value: tile, TrafficDataDimensions.SERVICE.value: [s.value for s in service], **dict(zip(dims, coords))},
+                            dims=[TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value] + dims)
+
+
+class DailyTotals:
+    # Keeps the total traffic of each day per (tile, service). Partial results over disjoint days merge by union.
+    # Over the 77 days of the dataset this is smaller than one day of raw data, so order statistics are computed exactly instead of with a sketch.
+    def __init__(self):
+        self.name = 'daily_total'
+        self.totals: Dict[date, np.ndarray] = {}
+
+    def update(self, day: date, time: pd.TimedeltaIndex, values: np.ndarray):
+        self.totals[day] = values.sum(axis=1, dtype=precision.accumulation_dtype)
+
+    def merge(self, other: 'DailyTotals') -> 'DailyTotals':
+        self.totals.update(other.totals)
+        return self
+
+    def result(self, tile: pd.Index, service: List[Service]) -> xr.DataArray:
+        day = sorted(self.totals)
+        values = np.stack([self.totals[d] for d in day], axis=-1) if day else np.zeros((len(tile), len(service), 0))
+        return xr.DataArray(values, coords={TrafficDataDimensions.TILE.value: tile, TrafficDataDimensions.SERVICE.value: [s.value for s in service], TrafficDataDimensions.DAY.value: pd.DatetimeIndex(day)},
+                            dims=[TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.DAY.value])
+
+
+class DailyQuantiles(DailyTotals):
+    # Quantiles of the daily totals across days, per (tile, service), e.g. the median day.
+    def __init__(self, quantiles: Tuple[float, ...] = (0.5,)):
+        super().__init__()
+        self.quantiles = list(quantiles)
+        self.name = 'daily_quantiles'
+
+    def result(self, tile: pd.Index, service: List[Service]) -> xr.DataArray:
+        totals = super().result(tile=tile, service=service)
+        return totals.quantile(q=self.quantiles, dim=TrafficDataDimensions.DAY.value).rename({'quantile': TrafficDataDimensions.QUANTILE.value})
+
+
+class RollingMean(DailyTotals):
+    # Trailing mean of the daily totals over the last window calendar days, each day included. Days that were not processed are skipped rather than counted as zero.
+    def __init__(self, window: int = 7):
+        super().__init__()
+        self.window = window
+        self.name = f'rolling_mean_{window}d'
+
+    def result(self, tile: pd.Index, service: List[Service]) -> xr.DataArray:
+        totals = super().result(tile=tile, service=service)
+        if totals.sizes[TrafficDataDimensions.DAY.value] == 0:
+            return totals
+        day = totals.indexes[TrafficDataDimensions.DAY.value]
+        calendar = pd.date_range(start=day.min(), end=day.max(), freq='D', name=TrafficDataDimensions.DAY.value)
+        rolling = totals.reindex({TrafficDataDimensions.DAY.value: calendar}).rolling({TrafficDataDimensions.DAY.value: self.window}, min_periods=1).mean()
+        return rolling.sel({TrafficDataDimensions.DAY.value: day})
+
+
+def get_temporal_profiles(traffic_type: TrafficType, city: City, statistics: list, service: List[Service] = None, day: List[date] = None, tile: List[int] = None, n_jobs: int = -1, dtype: np.dtype = None, scheduler: Scheduler = None, n_day_batches: int = None) -> Dict[str, xr.DataArray]:
+    # Computes all requested statistics (MeanProfile, DailyQuantiles, RollingMean, DailyTotals) in one pass over the days, reading each day once.
+    # With a scheduler the days are split into batches processed by separate workers, whose accumulators are then merged.
+    service = service if service is not None else [s for s in Service]
+    day = day if day is not None else [d.date() for d in TimeOptions.get_days()]
+    location_list = get_location_list(city=city) if tile is None else pd.Index(tile, name=TrafficDataDimensions.TILE.value)
+    if scheduler is None:
+        statistics = accumulate_temporal_statistics(traffic_type=traffic_type, city=city, statistics=statistics, service=service, day=day, tile=tile, n_jobs=n_jobs, dtype=dtype)
+    else:
+        n_day_batches = n_day_batches if n_day_batches is not None else scheduler.get_n_workers()
+        day_batches = [list(b) for b in np.array_split(np.array(day, dtype=object), min(n_day_batches, len(day))) if len(b) > 0]
+        tasks = [dict(traffic_type=traffic_type, city=city, statistics=statistics, service=service, day=b, tile=tile, n_jobs=scheduler.get_inner_n_jobs(n_workers=len(day_batches)), dtype=dtype) for b in day_batches]
+        partial_statistics = scheduler.map(func=accumulate_temporal_statistics, tasks=tasks, n_workers=len(day_batches))
+        statistics = [merge_temporal_statistics(statistics=list(s)) for s in zip(*partial_statistics)]
+    return {s.name: s.result(tile=location_list, service=service) for s in statistics}
+
+
+def accumulate_temporal_statistics(traffic_type: TrafficType, city: City, statistics: list, service: List[Service], day: List[date], tile: List[int] = None, n_jobs: int = -1, dtype: np.dtype = None) -> list:
+    # Folds the given days into fresh copies of the accumulators, which is what a worker returns to be merged with the others.
+    statistics = [_copy_empty(statistic=s) for s in statistics]
+    for d in day:
+        traffic_data_day = load_traffic_data(traffic_type=traffic_type, city=city, service=service, day=[d], n_jobs=n_jobs, tile=tile, dtype=dtype)
+        with instrument.stage('temporal_update', day=d):
+            values = np.asarray(traffic_data_day.values[..., 0])
+            for s in statistics:
+                s.update(day=d, time=traffic_data_day.indexes[TrafficDataDimensions.TIME.value], values=values)
+    return statistics
+
+
+def merge_temporal_statistics(statistics: list):
+    merged = _copy_empty(statistic=statistics[0])
+    for s in statistics:
+        merged.merge(other=s)
+    return merged
+
+
+def _copy_empty(statistic):
+    if isinstance(statistic, MeanProfile):
+        return MeanProfile(by=statistic.by)
+    if isinstance(statistic, DailyQuantiles):
+        return DailyQuantiles(quantiles=tuple(statistic.quantiles))
+    if isinstance(statistic, RollingMean):
+        return RollingMean(window=statistic.window)
+    return DailyTotals()
+
+
+def _get_profile_coords(by: ProfileKey) -> Tuple[List[str], list]:
+    times = [(pd.Timestamp(0) + t).time() for t in TimeOptions.get_times()]
+    weekdays, hours = list(range(7)), list(range(24))
+    if by == ProfileKey.TIME:
+        return [TrafficDataDimensions.TIME.value], [times]
+    elif by == ProfileKey.HOUR:
+        return [TrafficDataDimensions.HOUR.value], [hours]
+    elif by == ProfileKey.WEEKDAY:
+        return [TrafficDataDimensions.WEEKDAY.value], [weekdays]
+    elif by == ProfileKey.WEEKDAY_TIME:
+        return [TrafficDataDimensions.WEEKDAY.value, TrafficDataDimensions.TIME.value], [weekdays, times]
+    elif by == ProfileKey.WEEKDAY_HOUR:
+        return [TrafficDataDimensions.WEEKDAY.value, TrafficDataDimensions.HOUR.value], [weekdays, hours]
+    else:
+        raise ValueError(f'Invalid profile key {by}')
+
+
+def _get_profile_groups(by: ProfileKey, day: date, time: pd.TimedeltaIndex) -> np.ndarray:
+    # Flat group index of each time slot of the day, in the order of the coordinates of _get_profile_coords (weekday major).
+    slot = TimeOptions.get_times().get_indexer(time)
+    hour = np.asarray(time // timedelta(hours=1), dtype=np.int64)
+    weekday = day.weekday()
+    if by == ProfileKey.TIME:
+        return slot
+    elif by == ProfileKey.HOUR:
+        return hour
+    elif by == ProfileKey.WEEKDAY:
+        return np.full(len(time), weekday)
+    elif by == ProfileKey.WEEKDAY_TIME:
+        return weekday * len(TimeOptions.get_times()) + slot
+    elif by == ProfileKey.WEEKDAY_HOUR:
+        return weekday * 24 + hour
+    else:
+        raise ValueError(f'Invalid profile key {by}')
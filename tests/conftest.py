@@ -0,0 +1,30 @@
+import os
+from datetime import date
+
+import pytest
+from joblib.externals.loky import get_reusable_executor
+
+from mobile_traffic.enums import City, Service, TimeOptions
+from mobile_traffic import file_io, load, cache, synthetic
+
+# A few days of two services of Dijon, starting on Monday 2019-03-18, on a grid shrunk to 10 x 12 tiles.
+city = City.DIJON
+service = [Service.WIKIPEDIA, Service.TWITTER]
+day = list(TimeOptions.get_days()[2:6].date)
+# The tile index of a city is read from the Wikipedia file of this day, see load.get_location_list.
+tile_index_day = date(2019, 4, 1)
+
+
+@pytest.fixture(scope='session')
+def synthetic_data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    synthetic.generate_synthetic_data(folder_path=data_dir, city=[city], service=service, day=day, scale=0.05)
+    synthetic.generate_synthetic_data(folder_path=data_dir, city=[city], service=[Service.WIKIPEDIA], day=[tile_index_day], scale=0.05)
+    # Worker processes read the directories from the environment, the current process from the module attributes.
+    os.environ.update({'DATA_DIR': data_dir, 'CACHE_DIR': f'{data_dir}/cache', 'RESULT_CACHE_DIR': f'{data_dir}/cache/results'})
+    file_io.data_dir, file_io.cache_dir, file_io.result_cache_dir = data_dir, f'{data_dir}/cache', f'{data_dir}/cache/results'
+    # Workers started by earlier tests would keep the environment they were started with.
+    get_reusable_executor().shutdown(wait=True)
+    load._location_lists.clear()
+    cache._tile_indexes.clear()
+    return data_dir
@@ -0,0 +1,77 @@
+import os
+from datetime import time
+
+import numpy as np
+import pytest
+
+from mobile_traffic.enums import TrafficType
+from mobile_traffic import aggregate, load, plan
+
+from conftest import city, service, day
+
+
+def _get_night_traffic(**kwargs):
+    data = aggregate.get_night_traffic_by_tile_service_time_city(traffic_type=TrafficType.UL_AND_DL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day, **kwargs)
+    return data.data[city]
+
+
+def _assert_same_aggregate(xar, other, rtol: float = 1e-12):
+    assert other.dims == xar.dims
+    for d in xar.dims:
+        np.testing.assert_array_equal(other.indexes[d], xar.indexes[d])
+    np.testing.assert_allclose(other.values, xar.values, rtol=rtol)
+
+
+def test_memmap_cube_matches_the_in_memory_cube(synthetic_data_dir, tmp_path):
+    in_memory = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day, dtype=np.float32)
+    memmap = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day, memmap_path=str(tmp_path / 'cube.npy'))
+    assert memmap.dims == in_memory.dims and memmap.dtype == np.float32
+    np.testing.assert_array_equal(memmap.values, in_memory.values)
+
+
+def test_memmap_aggregate_matches_the_in_memory_aggregate(synthetic_data_dir, tmp_path):
+    load.convert_traffic_data_city_to_cache(city=city, service=service, day=day)
+    # The buffer holds float32 by default, so it is compared with a float32 cube.
+    _assert_same_aggregate(_get_night_traffic(streaming=False, dtype=np.float32), _get_night_traffic(streaming=False, memmap_dir=str(tmp_path), dtype=np.float32))
+    # The buffer is removed once the aggregate is computed.
+    assert os.listdir(tmp_path) == []
+
+
+def test_memmap_buffer_is_removed_when_the_aggregation_fails(synthetic_data_dir, tmp_path, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError('cleaning failed')
+    monkeypatch.setattr(aggregate, 'remove_datetime_mask', fail)
+    with pytest.raises(RuntimeError):
+        _get_night_traffic(streaming=False, memmap_dir=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+def test_memmap_dir_is_rejected_when_streaming(synthetic_data_dir, tmp_path):
+    with pytest.raises(ValueError):
+        _get_night_traffic(streaming=True, memmap_dir=str(tmp_path))
+
+
+@pytest.mark.parametrize('start_night, end_night', [(time(22), time(2)), (time(0), time(6)), (time(19, 30), time(23, 45))])
+def test_streaming_matches_the_cube_aggregate(synthetic_data_dir, start_night, end_night):
+    # The binary cache stores float32, so both paths are run on cached files, otherwise the first one would read the text files and the other the cache.
+    # The cube adds UL and DL in the storage type and the streaming path in float64, so they agree up to float32 rounding.
+    load.convert_traffic_data_city_to_cache(city=city, service=service, day=day)
+    kwargs = dict(traffic_type=TrafficType.UL_AND_DL, start_night=start_night, end_night=end_night, city=[city], service=service, day=day)
+    streaming = aggregate.get_night_traffic_by_tile_service_time_city(streaming=True, **kwargs).data[city]
+    cube = aggregate.get_night_traffic_by_tile_service_time_city(streaming=False, **kwargs).data[city]
+    assert float(streaming.sum()) > 0
+    _assert_same_aggregate(streaming, cube, rtol=1e-6)
+
+
+def test_cube_path_loads_only_the_planned_days_and_times(synthetic_data_dir, monkeypatch):
+    loaded = []
+    def load_traffic_data(**kwargs):
+        loaded.append((kwargs['day'], kwargs['time']))
+        return load.load_traffic_data(**kwargs)
+    monkeypatch.setattr(aggregate, 'load_traffic_data', load_traffic_data)
+    _get_night_traffic(streaming=False)
+    plan_ = plan.plan_night_query(city=city, start_night=time(22), end_night=time(2), day=day)
+    kept_day, kept_time, removed = plan.get_plan_day_time(plan=plan_)
+    assert len(loaded) == 1 and loaded[0][0].equals(kept_day) and loaded[0][1].equals(kept_time)
+    # 22:00 to 02:00 is 16 of the 96 slots of a day.
+    assert len(kept_time) == 16 and (~removed).sum() == sum(len(t) for t in plan_.values())
@@ -0,0 +1,75 @@
+from datetime import date, time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from mobile_traffic.enums import City, TrafficType, Service, TrafficDataDimensions, TimeOptions
+from mobile_traffic.utils import Anomalies
+from mobile_traffic import anomaly, aggregate, load
+
+from conftest import city, service, day
+
+
+def _get_stats(total: np.ndarray, day: pd.DatetimeIndex) -> xr.Dataset:
+    # total has shape (service, day), for one city and one traffic type.
+    coords = {TrafficDataDimensions.CITY.value: [City.DIJON.value],
+              TrafficDataDimensions.TRAFFIC_TYPE.value: [TrafficType.UL.value],
+              TrafficDataDimensions.SERVICE.value: [s.value for s in list(Service)[:total.shape[0]]],
+              TrafficDataDimensions.DAY.value: day}
+    dims = list(coords)
+    total = total[None, None]
+    return xr.Dataset({'total': (dims, total), 'nans': (dims, np.zeros_like(total)), 'values': (dims, np.full_like(total, 100.))}, coords=coords)
+
+
+def test_outlier_day_is_detected():
+    day = pd.date_range('2019-04-01', periods=28, freq='D')
+    total = np.random.default_rng(0).normal(1000, 10, size=(4, len(day)))
+    total[:, 10] = 10
+    anomalies = anomaly.detect_anomaly_days(stats=_get_stats(total=total, day=day))
+    assert list(anomalies.loc[anomalies['is_anomaly'].fillna(False), TrafficDataDimensions.DAY.value]) == [day[10].date()]
+
+
+def test_unrecorded_days_are_unknown_and_fall_back_to_the_hand_picked_list():
+    day = pd.date_range('2019-04-01', periods=28, freq='D')
+    total = np.random.default_rng(0).normal(1000, 10, size=(4, len(day)))
+    # 2019-04-09 is a hand-picked anomaly of Dijon that was never recorded, 2019-04-20 was not recorded either.
+    total[:, [8, 19]] = np.nan
+    anomalies = anomaly.detect_anomaly_days(stats=_get_stats(total=total, day=day))
+    assert anomalies['is_anomaly'].isna().sum() == 2
+    dates = anomaly.get_anomaly_dates(anomalies=anomalies, city=City.DIJON)
+    assert date(2019, 4, 9) in dates and date(2019, 4, 20) not in dates
+    # Days outside the table are not judged either.
+    assert set(Anomalies.get_anomaly_dates_by_city(city=City.DIJON)) <= set(dates)
+
+
+def test_recording_is_opt_in(monkeypatch):
+    monkeypatch.delenv(anomaly._recording_env_var, raising=False)
+    assert not anomaly.is_recording()
+    anomaly.enable_recording()
+    assert anomaly.is_recording()
+    anomaly.disable_recording()
+    assert not anomaly.is_recording()
+
+
+def test_recorded_stats_are_the_sums_of_the_loaded_files(synthetic_data_dir, monkeypatch):
+    monkeypatch.setattr(anomaly, '_recorded', {})
+    monkeypatch.setenv(anomaly._recording_env_var, '1')
+    traffic_data = {d: load.load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service[0], day=d, use_cache=False) for d in day[:2]}
+    stats = anomaly.get_daily_stats(city=[city], traffic_type=[TrafficType.UL], service=[service[0]], day=day[:2], n_jobs=1)
+    total = stats['total'].sel({TrafficDataDimensions.CITY.value: city.value, TrafficDataDimensions.TRAFFIC_TYPE.value: TrafficType.UL.value, TrafficDataDimensions.SERVICE.value: service[0].value}).values
+    np.testing.assert_allclose(total, [traffic_data[d].to_numpy().sum() for d in day[:2]], rtol=1e-9)
+    assert (stats['values'].values == load.get_location_list(city=city).size * len(TimeOptions.get_times())).all()
+    assert (stats['nans'].values == 0).all()
+
+
+def test_aggregate_removes_the_nights_of_detected_anomalies(synthetic_data_dir, monkeypatch):
+    # A table flagging a day removes the same nights as a hand-picked list holding that day.
+    anomalies = pd.DataFrame({TrafficDataDimensions.CITY.value: city.value, TrafficDataDimensions.DAY.value: day, 'is_anomaly': pd.array([False, True, False, False], dtype='boolean')})
+    kwargs = dict(traffic_type=TrafficType.UL_AND_DL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day)
+    detected = aggregate.get_night_traffic_by_tile_service_time_city(anomalies=anomalies, **kwargs).data[city]
+    monkeypatch.setattr(Anomalies, 'get_anomaly_dates_by_city', staticmethod(lambda city: [day[1]]))
+    hand_picked = aggregate.get_night_traffic_by_tile_service_time_city(**kwargs).data[city]
+    np.testing.assert_allclose(detected.values, hand_picked.values, rtol=1e-12)
+    monkeypatch.setattr(Anomalies, 'get_anomaly_dates_by_city', staticmethod(lambda city: []))
+    assert not np.allclose(aggregate.get_night_traffic_by_tile_service_time_city(**kwargs).data[city].values, detected.values)
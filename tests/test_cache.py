@@ -0,0 +1,120 @@
+import os
+from datetime import time
+
+import numpy as np
+
+from mobile_traffic.enums import TrafficType
+from mobile_traffic.plan import NightQuery
+from mobile_traffic import aggregate, cache, file_io, load, result_cache
+
+from conftest import city, service, day
+
+
+def _shift_mtime(file_path: str, seconds: float, reference_file_path: str = None):
+    mtime = os.path.getmtime(reference_file_path or file_path) + seconds
+    os.utime(file_path, (mtime, mtime))
+
+
+def test_binary_cache_is_invalidated_by_a_newer_source_file(synthetic_data_dir):
+    cache_file_path = load.convert_traffic_data_file_to_cache(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0])
+    assert cache.is_traffic_data_file_cached(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0])
+    # The source changing after the cache was written is the same as the cache being older than the source.
+    _shift_mtime(file_path=cache_file_path, seconds=-10, reference_file_path=file_io.get_mobile_traffic_data_file_path(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0]))
+    assert not cache.is_traffic_data_file_cached(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0])
+    assert load.convert_traffic_data_file_to_cache(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0]) == cache_file_path
+    assert cache.is_traffic_data_file_cached(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0])
+
+
+def test_cached_file_matches_the_text_file(synthetic_data_dir):
+    load.convert_traffic_data_file_to_cache(traffic_type=TrafficType.DL, city=city, service=service[1], day=day[1])
+    text = load.load_traffic_data_file(traffic_type=TrafficType.DL, city=city, service=service[1], day=day[1], use_cache=False)
+    cached = load.load_traffic_data_file(traffic_type=TrafficType.DL, city=city, service=service[1], day=day[1])
+    assert cached.index.equals(text.index) and cached.columns.equals(text.columns)
+    np.testing.assert_allclose(cached.to_numpy(), text.to_numpy(), rtol=1e-6)
+
+
+def test_cached_file_selection_reads_the_requested_slots(synthetic_data_dir):
+    load.convert_traffic_data_file_to_cache(traffic_type=TrafficType.UL, city=city, service=service[1], day=day[2])
+    cached = load.load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service[1], day=day[2])
+    time = list(cached.columns[[90, 3, 40]])
+    selected = load.load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service[1], day=day[2], time=time)
+    np.testing.assert_array_equal(selected.to_numpy(), cached[time].to_numpy())
+
+
+def test_result_cache_is_keyed_by_query_and_source_files(synthetic_data_dir):
+    query = NightQuery(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), day=day)
+    key = result_cache.get_result_cache_key(query=query, city=city, service=service[0])
+    assert key == result_cache.get_result_cache_key(query=NightQuery(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), day=day), city=city, service=service[0])
+    assert key != result_cache.get_result_cache_key(query=NightQuery(traffic_type=TrafficType.UL, start_night=time(23), end_night=time(2), day=day), city=city, service=service[0])
+    assert key != result_cache.get_result_cache_key(query=NightQuery(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), day=day, remove_noisy_nights=False), city=city, service=service[0])
+    assert key != result_cache.get_result_cache_key(query=query, city=city, service=service[1])
+    _shift_mtime(file_path=file_io.get_mobile_traffic_data_file_path(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[2]), seconds=10)
+    assert key != result_cache.get_result_cache_key(query=query, city=city, service=service[0])
+
+
+def test_cached_results_are_reused_and_invalidated(synthetic_data_dir):
+    result_cache.clear_results()
+    kwargs = dict(traffic_type=TrafficType.UL_AND_DL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day)
+    computed = aggregate.get_night_traffic_by_tile_service_time_city(use_cache=True, **kwargs).data[city]
+    # One result per service and traffic type.
+    assert len(result_cache._get_result_file_paths()) == 2 * len(service)
+    cached = aggregate.get_night_traffic_by_tile_service_time_city(use_cache=True, **kwargs).data[city]
+    np.testing.assert_array_equal(cached.values, computed.values)
+    query = NightQuery(traffic_type=TrafficType.UL_AND_DL, start_night=time(22), end_night=time(2), day=day)
+    result_cache.invalidate_result(query=query, city=city, service=service[:1])
+    assert len(result_cache._get_result_file_paths()) == 2 * (len(service) - 1)
+    result_cache.clear_results()
+    assert len(result_cache._get_result_file_paths()) == 0
+
+
+def test_eviction_removes_the_least_recently_used_results_and_skips_removed_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_io, 'result_cache_dir', str(tmp_path))
+    for i, key in enumerate(['a', 'b', 'c']):
+        file_path = result_cache._get_result_file_path(key=key)
+        with open(file_path, 'wb') as f:
+            f.write(b'0' * 100)
+        os.utime(file_path, (1000 + i, 1000 + i))
+    # Another worker removes a file between the listing and the eviction.
+    file_paths = result_cache._get_result_file_paths() + [result_cache._get_result_file_path(key='gone')]
+    monkeypatch.setattr(result_cache, '_get_result_file_paths', lambda: file_paths)
+    result_cache.evict_results(max_size_bytes=150)
+    assert sorted(os.listdir(tmp_path)) == ['c.nc']
+    assert result_cache.load_cached_result(key='gone') is None
+
+
+def test_only_services_missing_from_the_cache_are_computed(synthetic_data_dir, monkeypatch):
+    result_cache.clear_results()
+    computed = []
+    get_night_traffic_city = aggregate.get_night_traffic_city_by_tile_service_time
+    def get_night_traffic_city_recorded(query, city, service, n_jobs=-1):
+        computed.append((query.traffic_type, list(service)))
+        return get_night_traffic_city(query=query, city=city, service=service, n_jobs=n_jobs)
+    monkeypatch.setattr(aggregate, 'get_night_traffic_city_by_tile_service_time', get_night_traffic_city_recorded)
+    kwargs = dict(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), city=[city], day=day, use_cache=True)
+    first = aggregate.get_night_traffic_by_tile_service_time_city(service=service[:1], **kwargs).data[city]
+    both = aggregate.get_night_traffic_by_tile_service_time_city(service=service, **kwargs).data[city]
+    assert computed == [(TrafficType.UL, service[:1]), (TrafficType.UL, service[1:])]
+    assert list(both.indexes['service']) == [s.value for s in service]
+    np.testing.assert_array_equal(both.sel(service=[service[0].value]).values, first.values)
+    result_cache.clear_results()
+
+
+def test_tile_index_is_read_from_disk_once(synthetic_data_dir):
+    tile_index = cache.load_cached_tile_index(city=city)
+    assert cache.load_cached_tile_index(city=city) is tile_index
+    cache.save_cached_tile_index(tile_index=tile_index[::-1], city=city)
+    try:
+        assert cache.load_cached_tile_index(city=city).equals(tile_index[::-1])
+    finally:
+        cache.save_cached_tile_index(tile_index=tile_index, city=city)
+
+
+def test_tile_geometries_are_cached_as_geoparquet(synthetic_data_dir):
+    tiles = load.load_tile_geo_data_city(city=city, use_cache=False)
+    load.load_tile_geo_data_city(city=city)
+    assert cache.is_tile_geo_data_cached(city=city)
+    cached = load.load_tile_geo_data_city(city=city)
+    assert cached.index.equals(tiles.index) and cached.crs == tiles.crs
+    assert cached.geometry.geom_equals(tiles.geometry).all()
+    _shift_mtime(file_path=file_io.get_tile_geo_cache_file_path(city=city), seconds=-10, reference_file_path=file_io.get_data_file_path(city=city))
+    assert not cache.is_tile_geo_data_cached(city=city)
@@ -0,0 +1,94 @@
+from datetime import datetime, time, timedelta, date
+from typing import List
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import City, TimeOptions
+from mobile_traffic.utils import Calendar, Anomalies
+from mobile_traffic import clean
+
+# The cleaning steps as they were before they were rewritten as masks, applied one after the other on the data. The masks must remove exactly the same datetimes,
+# except that the out-of-range slots are now removed on every date of the data. The baseline only removed them on the dates that survived the noisy-night filter,
+# so a fully removed day let the out-of-range slots of the next day through.
+
+
+def _baseline_remove_time_period_on_dates(traffic_data: xr.DataArray, dates: List[date], time_start_period: time, length_period: timedelta):
+    datetime_ = pd.DatetimeIndex(traffic_data.datetime.values).to_pydatetime()
+    datetime_intervals_to_remove = [(datetime.combine(day, time_start_period), datetime.combine(day, time_start_period) + length_period) for day in dates]
+    datetime_to_remove = np.concatenate([np.where((datetime_ >= start) & (datetime_ < end))[0] for start, end in datetime_intervals_to_remove])
+    datetime_to_keep = np.setdiff1d(np.arange(len(datetime_)), datetime_to_remove)
+    return traffic_data.isel(datetime=datetime_to_keep)
+
+
+def _baseline_remove_nights_before_holidays(traffic_data: xr.DataArray) -> xr.DataArray:
+    days_holiday = Calendar.holidays()
+    days_before_holiday = [holiday - timedelta(days=1) for holiday in days_holiday]
+    days_to_remove = list(set(days_before_holiday).union(set(Calendar.fridays_and_saturdays())))
+    traffic_data = _baseline_remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=time(15), length_period=timedelta(days=1), dates=days_to_remove)
+    traffic_data = _baseline_remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=time(0), length_period=timedelta(days=1), dates=[pd.Timestamp(traffic_data.datetime[0].values).to_pydatetime().date()])
+    return traffic_data
+
+
+def _baseline_remove_nights_before_anomalies(traffic_data: xr.DataArray, city: City) -> xr.DataArray:
+    days_anomaly = Anomalies.get_anomaly_dates_by_city(city=city)
+    days_before_anomaly = [day - timedelta(days=1) for day in days_anomaly]
+    days_to_remove = list(set(days_anomaly).union(set(days_before_anomaly)))
+    return _baseline_remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=time(15), length_period=timedelta(days=1), dates=days_to_remove)
+
+
+def _baseline_remove_times_outside_range(traffic_data: xr.DataArray, start: time, end: time, dates: List[date] = None) -> xr.DataArray:
+    auxiliary_date = date(2020, 1, 1)
+    auxiliary_datetime_start, auxiliary_datetime_end = datetime.combine(auxiliary_date, start), datetime.combine(auxiliary_date, end)
+    length_period_keep = auxiliary_datetime_end - auxiliary_datetime_start if auxiliary_datetime_end > auxiliary_datetime_start else (auxiliary_datetime_end + timedelta(days=1)) - auxiliary_datetime_start
+    length_period_remove = timedelta(days=1) - length_period_keep
+    dates = dates if dates is not None else list(np.unique([d.date() for d in pd.DatetimeIndex(traffic_data.datetime.values).to_pydatetime()]))
+    return _baseline_remove_time_period_on_dates(traffic_data=traffic_data, time_start_period=end, length_period=length_period_remove, dates=dates)
+
+
+def _get_traffic_data(day: pd.DatetimeIndex) -> xr.DataArray:
+    datetime_index = (day.values[:, None] + TimeOptions.get_times().values[None, :]).ravel()
+    return xr.DataArray(np.arange(len(datetime_index)), coords={'datetime': datetime_index}, dims=['datetime'])
+
+
+@pytest.mark.parametrize('city', [c for c in City])
+@pytest.mark.parametrize('start, end', [(time(22), time(2)), (time(0), time(6)), (time(19, 30), time(23, 45)), (time(23), time(23, 15))])
+@pytest.mark.parametrize('remove_noisy_nights', [True, False])
+def test_masks_remove_the_same_datetimes_as_baseline(city, start, end, remove_noisy_nights):
+    traffic_data = _get_traffic_data(day=TimeOptions.get_days())
+    expected = traffic_data
+    if remove_noisy_nights:
+        expected = _baseline_remove_nights_before_holidays(traffic_data=expected)
+        expected = _baseline_remove_nights_before_anomalies(traffic_data=expected, city=city)
+    expected = _baseline_remove_times_outside_range(traffic_data=expected, start=start, end=end, dates=list(TimeOptions.get_days().date))
+    result = clean.remove_nights_and_times_outside_range(traffic_data=traffic_data, city=city, start=start, end=end, remove_noisy_nights=remove_noisy_nights)
+    np.testing.assert_array_equal(result.datetime.values, expected.datetime.values)
+
+
+@pytest.mark.parametrize('day', [TimeOptions.get_days()[2:20], TimeOptions.get_days()[20:21], TimeOptions.get_days()[-10:]])
+def test_nights_before_holidays_mask_on_day_subsets(day):
+    # The first night that is kept depends on the first day of the data, so subsets that do not start on a saturday are compared too.
+    traffic_data = _get_traffic_data(day=day)
+    expected = _baseline_remove_nights_before_holidays(traffic_data=traffic_data)
+    result = clean.remove_nights_before_holidays(traffic_data=traffic_data)
+    np.testing.assert_array_equal(result.datetime.values, expected.datetime.values)
+
+
+def test_time_period_on_dates_mask_with_overlapping_periods():
+    traffic_data = _get_traffic_data(day=TimeOptions.get_days()[:5])
+    dates = [date(2019, 3, 17), date(2019, 3, 18)]
+    expected = _baseline_remove_time_period_on_dates(traffic_data=traffic_data, dates=dates, time_start_period=time(6), length_period=timedelta(days=2))
+    result = clean.remove_time_period_on_dates(traffic_data=traffic_data, dates=dates, time_start_period=time(6), length_period=timedelta(days=2))
+    np.testing.assert_array_equal(result.datetime.values, expected.datetime.values)
+
+
+@pytest.mark.parametrize('start, end', [(time(22), time(2)), (time(19, 30), time(23, 45))])
+def test_no_slot_outside_the_night_is_kept(start, end):
+    traffic_data = _get_traffic_data(day=TimeOptions.get_days())
+    result = clean.remove_nights_and_times_outside_range(traffic_data=traffic_data, city=City.DIJON, start=start, end=end)
+    t = pd.DatetimeIndex(result.datetime.values)
+    t = t - t.normalize()
+    start, end = pd.Timedelta(hours=start.hour, minutes=start.minute), pd.Timedelta(hours=end.hour, minutes=end.minute)
+    assert ((t >= start) | (t < end) if start > end else (t >= start) & (t < end)).all()
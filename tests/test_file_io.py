@@ -0,0 +1,90 @@
+from datetime import time
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import City, TrafficDataDimensions
+from mobile_traffic.aggregate import MobileTrafficDataset
+from mobile_traffic import file_io, sparsity
+
+
+def _get_traffic_data(service: list, seed: int = 0) -> xr.DataArray:
+    values = np.random.default_rng(seed).random((30, len(service), 8))
+    coords = {TrafficDataDimensions.TILE.value: np.arange(30),
+              TrafficDataDimensions.SERVICE.value: service,
+              TrafficDataDimensions.TIME.value: [time(h) for h in range(22, 24)] + [time(h) for h in range(6)]}
+    return xr.DataArray(values, coords=coords, dims=list(coords))
+
+
+def _assert_same(xar: xr.DataArray, other: xr.DataArray):
+    assert list(other.indexes[TrafficDataDimensions.TIME.value]) == list(xar.indexes[TrafficDataDimensions.TIME.value])
+    assert list(other.indexes[TrafficDataDimensions.SERVICE.value]) == list(xar.indexes[TrafficDataDimensions.SERVICE.value])
+    np.testing.assert_array_equal(np.asarray(other.values), xar.values)
+
+
+def test_zarr_store_is_loaded_lazily(tmp_path):
+    pytest.importorskip('zarr')
+    data = {City.DIJON: _get_traffic_data(service=['Twitch', 'Netflix']), City.NICE: _get_traffic_data(service=['Twitch'], seed=1)}
+    MobileTrafficDataset(data=data).save(folder_path=str(tmp_path), n_jobs=1, format='zarr')
+    loaded = MobileTrafficDataset.load(folder_path=str(tmp_path))
+    assert set(loaded.data) == {City.DIJON, City.NICE}
+    # Nothing is read before the values are asked for.
+    assert not isinstance(loaded.data[City.DIJON].variable._data, np.ndarray)
+    _assert_same(data[City.DIJON], loaded.data[City.DIJON].load())
+    chunked = MobileTrafficDataset.load(folder_path=str(tmp_path), city=[City.NICE], chunks={}).data[City.NICE]
+    assert chunked.chunks is not None
+    _assert_same(data[City.NICE], chunked.compute())
+
+
+def test_zarr_append_adds_services_and_cities(tmp_path):
+    pytest.importorskip('zarr')
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(service=['Twitch'])}, folder_path=str(tmp_path), n_jobs=1)
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(service=['Netflix', 'Waze'], seed=1), City.NICE: _get_traffic_data(service=['Twitch'], seed=2)}, folder_path=str(tmp_path), append=True, n_jobs=1)
+    loaded = file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))
+    _assert_same(xr.concat([_get_traffic_data(service=['Twitch']), _get_traffic_data(service=['Netflix', 'Waze'], seed=1)], dim=TrafficDataDimensions.SERVICE.value), loaded[City.DIJON].load())
+    _assert_same(_get_traffic_data(service=['Twitch'], seed=2), loaded[City.NICE].load())
+
+
+def test_zarr_append_rejects_overlapping_services_and_other_coordinates(tmp_path):
+    pytest.importorskip('zarr')
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(service=['Twitch'])}, folder_path=str(tmp_path), n_jobs=1)
+    with pytest.raises(ValueError):
+        file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(service=['Twitch'])}, folder_path=str(tmp_path), append=True, n_jobs=1)
+    with pytest.raises(ValueError):
+        file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(service=['Netflix']).isel(tile=slice(0, 10))}, folder_path=str(tmp_path), append=True, n_jobs=1)
+
+
+def test_sparse_arrays_are_saved_dense(tmp_path):
+    pytest.importorskip('zarr')
+    pytest.importorskip('sparse')
+    xar = _get_traffic_data(service=['Twitch']).where(lambda x: x > 0.9, 0.)
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: sparsity.to_sparse(xar)}, folder_path=str(tmp_path), n_jobs=1)
+    _assert_same(xar, file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].load())
+
+
+def test_netcdf_format_round_trip(tmp_path):
+    data = {City.DIJON: _get_traffic_data(service=['Twitch', 'Netflix'])}
+    MobileTrafficDataset(data=data).save(folder_path=str(tmp_path), n_jobs=1, format='netcdf')
+    loaded = MobileTrafficDataset.load(folder_path=str(tmp_path))
+    _assert_same(data[City.DIJON], loaded.data[City.DIJON].load())
+    with pytest.raises(ValueError):
+        MobileTrafficDataset(data=data).save(folder_path=str(tmp_path), append=True, format='netcdf')
+    with pytest.raises(ValueError):
+        MobileTrafficDataset(data=data).save(folder_path=str(tmp_path), dtype=np.uint16, format='netcdf')
+
+
+def test_netcdf_is_the_default_without_zarr(tmp_path, monkeypatch):
+    find_spec = file_io.importlib.util.find_spec
+    monkeypatch.setattr(file_io.importlib.util, 'find_spec', lambda name, *args: None if name == 'zarr' else find_spec(name, *args))
+    assert file_io.get_default_dataset_format() == 'netcdf'
+    data = {City.DIJON: _get_traffic_data(service=['Twitch'])}
+    MobileTrafficDataset(data=data).save(folder_path=str(tmp_path), n_jobs=1)
+    assert not (tmp_path / 'mobile_traffic_by_tile_service_and_time.zarr').exists()
+    _assert_same(data[City.DIJON], MobileTrafficDataset.load(folder_path=str(tmp_path)).data[City.DIJON].load())
+
+
+def test_files_of_save_mobile_traffic_data_are_loaded(tmp_path):
+    data = {City.DIJON: _get_traffic_data(service=['Twitch'])}
+    file_io.save_mobile_traffic_data(data=data, folder_path=str(tmp_path))
+    _assert_same(data[City.DIJON], file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].load())
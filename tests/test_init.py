@@ -0,0 +1,29 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+import mobile_traffic as mt
+
+
+def test_importing_the_enums_does_not_import_the_heavy_dependencies():
+    code = 'import sys; from mobile_traffic import City, Service, TrafficType; print(" ".join(m for m in ("xarray", "geopandas", "joblib", "tqdm") if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, env={**os.environ, 'PYTHONPATH': os.path.dirname(mt.__path__[0])})
+    assert result.stdout.strip() == ''
+
+
+def test_lazy_attributes_resolve_to_their_module():
+    from mobile_traffic import aggregate, plan
+
+    assert mt.MobileTrafficDataset is aggregate.MobileTrafficDataset
+    assert mt.NightQuery is plan.NightQuery
+    assert 'NightQuery' in vars(mt)
+    assert set(mt.__all__) <= set(dir(mt))
+    for name in mt.__all__:
+        getattr(mt, name)
+
+
+def test_unknown_attribute_raises():
+    with pytest.raises(AttributeError):
+        mt.not_an_attribute
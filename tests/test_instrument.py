@@ -0,0 +1,50 @@
+from datetime import time
+
+import pytest
+
+from mobile_traffic.enums import TrafficType
+from mobile_traffic import instrument, aggregate
+
+from conftest import city, service, day
+
+
+@pytest.fixture
+def instrumentation(tmp_path):
+    yield instrument.enable(jsonl_path=str(tmp_path / 'stages.jsonl'))
+    instrument.disable()
+
+
+def test_stages_are_no_ops_when_disabled():
+    instrument.disable()
+    assert not instrument.is_enabled()
+    with instrument.stage('load', city='Dijon') as metrics:
+        metrics['files_read'] = 1
+    assert instrument.get_instrumentation() is None
+
+
+def test_nested_stages_inherit_their_context(instrumentation):
+    with instrument.stage('outer', city='Dijon'):
+        with instrument.stage('inner', service='Wikipedia') as metrics:
+            metrics['files_read'] = 2
+    inner, outer = instrumentation.records
+    assert (inner['stage'], inner['city'], inner['service'], inner['files_read']) == ('inner', 'Dijon', 'Wikipedia', 2)
+    assert outer['stage'] == 'outer' and 'service' not in outer
+    assert inner['seconds'] >= 0 and inner['peak_rss_bytes'] > 0
+
+
+def test_records_are_appended_to_the_jsonl_file(instrumentation):
+    for _ in range(3):
+        with instrument.stage('read_file', city='Dijon') as metrics:
+            metrics.update({'files_read': 1, 'bytes_read': 10})
+    records = instrument.Instrumentation.from_jsonl(jsonl_path=instrumentation.jsonl_path).records
+    assert records == instrumentation.records
+    summary = instrumentation.summary()
+    assert summary.loc[('Dijon', 'read_file'), 'calls'] == 3 and summary.loc[('Dijon', 'read_file'), 'bytes_read'] == 30
+
+
+def test_aggregation_reports_its_stages_per_city(synthetic_data_dir, instrumentation):
+    aggregate.get_night_traffic_by_tile_service_time_city(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day, streaming=False)
+    summary = instrumentation.summary()
+    stages = set(summary.loc[city.value].index)
+    assert {'night_traffic_city', 'load_traffic_data', 'stack', 'groupby_sum', 'concat'} <= stages
+    assert summary.loc[(city.value, 'load_traffic_data'), 'files_read'] > 0
@@ -0,0 +1,60 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import TrafficType, Service, TimeOptions
+from mobile_traffic import load, file_io, synthetic
+
+from conftest import city, service, day
+
+
+def test_location_list_is_the_tile_order_of_loaded_files(synthetic_data_dir):
+    tile_index = load.get_location_list(city=city)
+    traffic_data = load.load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0], use_cache=False)
+    assert traffic_data.index.equals(tile_index)
+
+
+def test_files_out_of_tile_order_are_realigned(synthetic_data_dir):
+    # A file with its rows reversed and one tile missing is stored as another service, and must load as the original with the missing tile at 0.
+    traffic_data = load.load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=service[0], day=day[0], use_cache=False)
+    shuffled = traffic_data.iloc[:0:-1]
+    file_path = file_io.get_mobile_traffic_data_file_path(traffic_type=TrafficType.UL, city=city, service=Service.WEB_GAMES, day=day[0])
+    synthetic._write_traffic_data_file(file_path=file_path, tile=shuffled.index.to_numpy(), values=shuffled.to_numpy())
+    realigned = load.load_traffic_data_file(traffic_type=TrafficType.UL, city=city, service=Service.WEB_GAMES, day=day[0], use_cache=False)
+    assert realigned.index.equals(load.get_location_list(city=city))
+    expected = traffic_data.to_numpy().copy()
+    expected[0] = 0
+    np.testing.assert_allclose(realigned.to_numpy(), expected)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_readahead_loads_the_same_data(synthetic_data_dir, cached, tmp_path):
+    if cached:
+        load.convert_traffic_data_city_to_cache(city=city, service=service, day=day)
+    time = list(TimeOptions.get_times()[::7])
+    kwargs = dict(traffic_type=TrafficType.UL_AND_DL, city=city, service=service, day=day, time=time, tile=list(load.get_location_list(city=city)[10:40]))
+    expected = load.load_traffic_data(readahead=0, **kwargs)
+    xr.testing.assert_equal(load.load_traffic_data(readahead=2, **kwargs), expected)
+    xr.testing.assert_equal(load.load_traffic_data(readahead=2, memmap_path=str(tmp_path / 'cube.npy'), dtype=np.float64, **kwargs), expected)
+
+
+def test_readahead_defaults_to_the_module_setting_and_is_bounded(synthetic_data_dir, monkeypatch):
+    # When the file contents of task i are handed over, no more than i + readahead reads have been submitted.
+    read_traffic_data_files = load._read_traffic_data_files
+    submitted, consumed = [], []
+
+    def read_traffic_data_files_recorded(**kwargs):
+        submitted.append((kwargs['service'], kwargs['day']))
+        return read_traffic_data_files(**kwargs)
+
+    monkeypatch.setattr(load, '_read_traffic_data_files', read_traffic_data_files_recorded)
+    service_day = [(s, d) for s in service for d in day]
+    for i, buffers in enumerate(load._prefetch_traffic_data_files(traffic_type=TrafficType.UL, city=city, service_day=service_day, readahead=3)):
+        assert len(submitted) <= min(i + 3, len(service_day))
+        consumed.append(buffers)
+    assert submitted == service_day and len(consumed) == len(service_day)
+
+    submitted.clear()
+    monkeypatch.setattr(load, 'default_readahead', 2)
+    load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day[:2], n_jobs=1)
+    assert set(submitted) == {(s, d) for s in service for d in day[:2]}
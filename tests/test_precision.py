@@ -0,0 +1,85 @@
+from datetime import time
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import City, Service, TrafficDataDimensions
+from mobile_traffic import precision, file_io
+
+
+def _get_traffic_data(values: np.ndarray) -> xr.DataArray:
+    coords = {TrafficDataDimensions.TILE.value: np.arange(values.shape[0]),
+              TrafficDataDimensions.SERVICE.value: [Service.TWITCH.value, Service.WEB_GAMES.value],
+              TrafficDataDimensions.TIME.value: [time(h) for h in range(values.shape[2])]}
+    return xr.DataArray(values, coords=coords, dims=list(coords))
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.uint32])
+def test_quantization_error_is_within_its_bound(dtype, tmp_path):
+    pytest.importorskip('zarr')
+    values = np.random.default_rng(0).lognormal(size=(50, 2, 6)) * 1000
+    values[0, 0, 0] = 0
+    traffic_data = _get_traffic_data(values=values)
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: traffic_data}, folder_path=str(tmp_path), n_jobs=1, dtype=dtype)
+    stored = file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].load()
+    bound = values.max() / (2 * (np.iinfo(dtype).max - 1))
+    assert np.abs(stored.values - values).max() <= bound * (1 + 1e-9)
+    assert stored.values[0, 0, 0] == 0
+
+
+def test_values_outside_the_quantization_range_are_saturated():
+    traffic_data = _get_traffic_data(values=np.array([[[-1., 10., 100., 1e6]] * 2]).reshape(1, 2, 4))
+    encoding = precision.get_quantization_encoding(xar=traffic_data, dtype=np.uint8, scale_factor=1.)
+    clipped = precision.clip_to_quantization_range(xar=traffic_data, encoding=encoding)
+    np.testing.assert_array_equal(clipped.values[0, 0], [0., 10., 100., 254.])
+
+
+def test_default_scale_factor_fits_the_largest_value():
+    traffic_data = _get_traffic_data(values=np.full((3, 2, 2), 7.))
+    encoding = precision.get_quantization_encoding(xar=traffic_data, dtype=np.uint16)
+    assert encoding['_FillValue'] == np.iinfo(np.uint16).max
+    assert np.round(7. / encoding['scale_factor']) <= np.iinfo(np.uint16).max - 1
+
+
+def test_integer_dtypes_are_rejected_in_memory():
+    with pytest.raises(ValueError):
+        precision.get_dtype(dtype=np.int32)
+
+
+def test_values_outside_the_quantization_range_are_rejected_unless_clipped(tmp_path):
+    pytest.importorskip('zarr')
+    traffic_data = _get_traffic_data(values=np.array([[[-1., 10., 100., 1e6]] * 2]).reshape(1, 2, 4))
+    with pytest.raises(ValueError):
+        file_io.save_mobile_traffic_dataset(data={City.DIJON: traffic_data}, folder_path=str(tmp_path), n_jobs=1, dtype=np.uint8, scale_factor=1.)
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: traffic_data}, folder_path=str(tmp_path), n_jobs=1, dtype=np.uint8, scale_factor=1., clip=True)
+    stored = file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].load()
+    np.testing.assert_array_equal(stored.values[0, 0], [0., 10., 100., 254.])
+
+
+def test_appended_values_are_packed_with_the_encoding_of_the_store(tmp_path):
+    pytest.importorskip('zarr')
+    values = np.random.default_rng(0).random((50, 2, 6)) * 1000
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(values=values)}, folder_path=str(tmp_path), n_jobs=1, dtype=np.uint16)
+    appended = _get_traffic_data(values=values / 2).assign_coords({TrafficDataDimensions.SERVICE.value: [Service.WAZE.value, Service.NETFLIX.value]})
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: appended}, folder_path=str(tmp_path), append=True, n_jobs=1)
+    stored = file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].load()
+    bound = values.max() / (2 * (np.iinfo(np.uint16).max - 1))
+    assert np.abs(stored.sel({TrafficDataDimensions.SERVICE.value: [Service.WAZE.value, Service.NETFLIX.value]}).values - values / 2).max() <= bound * (1 + 1e-9)
+
+
+def test_append_rejects_values_outside_the_range_of_the_store_and_a_new_encoding(tmp_path):
+    pytest.importorskip('zarr')
+    values = np.random.default_rng(0).random((50, 2, 6)) * 1000
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: _get_traffic_data(values=values)}, folder_path=str(tmp_path), n_jobs=1, dtype=np.uint16)
+    appended = _get_traffic_data(values=values * 2).assign_coords({TrafficDataDimensions.SERVICE.value: [Service.WAZE.value, Service.NETFLIX.value]})
+    with pytest.raises(ValueError):
+        file_io.save_mobile_traffic_dataset(data={City.DIJON: appended}, folder_path=str(tmp_path), append=True, n_jobs=1)
+    with pytest.raises(ValueError):
+        file_io.save_mobile_traffic_dataset(data={City.DIJON: appended}, folder_path=str(tmp_path), append=True, n_jobs=1, dtype=np.uint32)
+    with pytest.raises(ValueError):
+        file_io.save_mobile_traffic_dataset(data={City.DIJON: appended}, folder_path=str(tmp_path), append=True, n_jobs=1, scale_factor=1.)
+    assert list(file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].indexes[TrafficDataDimensions.SERVICE.value]) == [Service.TWITCH.value, Service.WEB_GAMES.value]
+    file_io.save_mobile_traffic_dataset(data={City.DIJON: appended}, folder_path=str(tmp_path), append=True, n_jobs=1, clip=True)
+    stored = file_io.load_mobile_traffic_dataset(folder_path=str(tmp_path))[City.DIJON].load()
+    assert stored.sel({TrafficDataDimensions.SERVICE.value: Service.WAZE.value}).max() <= values.max() * (1 + 1e-9)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import TrafficDataDimensions
+from mobile_traffic import raster, synthetic, sparsity, load
+
+from conftest import city
+
+n_rows, n_cols = synthetic.get_synthetic_grid_shape(city=city, scale=0.05)
+
+
+def _get_traffic_data(tile: pd.Index) -> xr.DataArray:
+    values = np.random.default_rng(0).random((len(tile), 3))
+    values[values < 0.5] = 0
+    return xr.DataArray(values, coords={TrafficDataDimensions.TILE.value: tile, TrafficDataDimensions.SERVICE.value: ['a', 'b', 'c']}, dims=[TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value])
+
+
+def test_raster_places_tiles_on_the_grid_and_back(synthetic_data_dir):
+    # The synthetic tiles are numbered row by row from the top left corner.
+    xar = _get_traffic_data(tile=load.get_location_list(city=city))
+    xar_raster = raster.to_raster(xar=xar, city=city)
+    assert xar_raster.dims == (TrafficDataDimensions.ROW.value, TrafficDataDimensions.COL.value, TrafficDataDimensions.SERVICE.value)
+    assert xar_raster.shape[:2] == (n_rows, n_cols)
+    tile = np.asarray(xar.indexes[TrafficDataDimensions.TILE.value])
+    np.testing.assert_array_equal(xar_raster.values[tile // n_cols, tile % n_cols], xar.values)
+    xr.testing.assert_equal(raster.from_raster(raster=xar_raster, city=city), xar)
+
+
+def test_chunked_raster_matches_the_dense_raster(synthetic_data_dir):
+    # A subset of the tiles, so that cells of tiles missing from the input hold the fill value too.
+    xar = _get_traffic_data(tile=load.get_location_list(city=city)[::3])
+    dense = raster.to_raster(xar=xar, city=city, fill_value=-1.)
+    assert (dense.values == -1).sum() == (n_rows * n_cols - xar.sizes[TrafficDataDimensions.TILE.value]) * 3
+    for chunked_input in [xar, sparsity.to_sparse(xar), xar.chunk({TrafficDataDimensions.TILE.value: 7})]:
+        chunked = raster.to_raster(xar=chunked_input, city=city, fill_value=-1., chunks=(4, 5))
+        assert chunked.chunks is not None
+        np.testing.assert_array_equal(chunked.values, dense.values)
+        np.testing.assert_array_equal(raster.from_raster(raster=chunked, city=city, tile=xar.indexes[TrafficDataDimensions.TILE.value]).values, xar.values)
+
+
+def test_chunked_raster_does_not_compute_a_dask_input(synthetic_data_dir):
+    import dask
+    import dask.array as da
+
+    computed = []
+
+    def get_values(values):
+        computed.append(True)
+        return values
+
+    xar = _get_traffic_data(tile=load.get_location_list(city=city))
+    xar_dask = xar.copy(data=da.from_delayed(dask.delayed(get_values)(xar.values), shape=xar.shape, dtype=xar.dtype))
+    chunked = raster.to_raster(xar=xar_dask, city=city, chunks=(4, 5))
+    assert computed == []
+    np.testing.assert_array_equal(chunked.values, raster.to_raster(xar=xar, city=city).values)
+
+
+@pytest.mark.parametrize('block_shape', [(3, 4), (100, 100)])
+def test_blocked_convolution_matches_scipy(synthetic_data_dir, block_shape):
+    from scipy import ndimage
+
+    xar = _get_traffic_data(tile=load.get_location_list(city=city)[5:])
+    kernel = np.arange(15, dtype=np.float64).reshape(3, 5)
+    expected = ndimage.convolve(raster.to_raster(xar=xar, city=city).values, kernel[..., None], mode='constant', cval=0.)
+    convolved = raster.convolve_tiles(xar=xar, kernel=kernel, city=city, block_shape=block_shape)
+    tile = np.asarray(xar.indexes[TrafficDataDimensions.TILE.value])
+    assert convolved.dims == xar.dims
+    np.testing.assert_allclose(convolved.values, expected[tile // n_cols, tile % n_cols], rtol=1e-12)
+    smoothed = raster.smooth_tiles(xar=xar, city=city, size=3, block_shape=block_shape)
+    expected = ndimage.uniform_filter(raster.to_raster(xar=xar, city=city).values, size=(3, 3, 1), mode='constant', cval=0.)
+    np.testing.assert_allclose(smoothed.values, expected[tile // n_cols, tile % n_cols], rtol=1e-12, atol=1e-12)
+
+
+def test_grids_without_a_city_are_passed_as_a_grid(synthetic_data_dir):
+    grid = raster.TileGrid.from_tile_geo_data(tile_geo_data=load.load_tile_geo_data_city(city=city))
+    xar = _get_traffic_data(tile=load.get_location_list(city=city))
+    xr.testing.assert_equal(raster.to_raster(xar=xar, grid=grid), raster.to_raster(xar=xar, city=city))
+    xr.testing.assert_equal(raster.smooth_tiles(xar=xar, grid=grid), raster.smooth_tiles(xar=xar, city=city))
+    with pytest.raises(ValueError):
+        raster.to_raster(xar=xar)
@@ -0,0 +1,51 @@
+import os
+from datetime import time
+
+import numpy as np
+import pytest
+
+from mobile_traffic.enums import Backend, TrafficType, TimeOptions
+from mobile_traffic.plan import NightQuery
+from mobile_traffic.scheduler import Scheduler
+from mobile_traffic.utils import CityDimensions
+from mobile_traffic import aggregate
+
+from conftest import city, service, day
+
+
+def _square(x: int) -> int:
+    return x * x
+
+
+@pytest.mark.parametrize('backend', [Backend.SERIAL, Backend.THREADS, Backend.PROCESSES])
+def test_map_returns_results_in_task_order(backend):
+    assert Scheduler(backend=backend, n_jobs=2).map(func=_square, tasks=[dict(x=x) for x in range(5)]) == [0, 1, 4, 9, 16]
+
+
+def test_n_workers_fit_in_the_memory_budget():
+    assert Scheduler(backend=Backend.THREADS, n_jobs=8, max_memory_bytes=300).get_n_workers(task_memory_bytes=100) == 3
+    assert Scheduler(backend=Backend.THREADS, n_jobs=8, max_memory_bytes=50).get_n_workers(task_memory_bytes=100) == 1
+    assert Scheduler(backend=Backend.SERIAL, n_jobs=8).get_n_workers() == 1
+    assert Scheduler(backend=Backend.THREADS, n_jobs=-1).get_n_workers() == os.cpu_count()
+
+
+def test_cube_tasks_are_estimated_with_every_day_of_the_query():
+    n_rows, n_cols = CityDimensions.get_city_dim(city=city)
+    n_values = n_rows * n_cols * len(TimeOptions.get_times())
+    query = NightQuery(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2))
+    streaming = aggregate._estimate_night_traffic_memory(query=query, city=city, n_service=2)
+    cube = aggregate._estimate_night_traffic_memory(query=NightQuery(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), streaming=False), city=city, n_service=2)
+    assert streaming == (2 * 8 + 8) * n_values * 2
+    assert cube == 2 * 8 * n_values * 2 * len(TimeOptions.get_days())
+    # Services beyond a batch are loaded later and do not add up.
+    assert aggregate._estimate_night_traffic_memory(query=NightQuery(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), streaming=False, day=day), city=city, n_service=20) == 2 * 8 * n_values * 5 * len(day)
+
+
+@pytest.mark.parametrize('backend', [Backend.SERIAL, Backend.THREADS, Backend.PROCESSES])
+@pytest.mark.parametrize('streaming', [True, False])
+def test_scheduled_aggregate_matches_the_sequential_one(synthetic_data_dir, backend, streaming):
+    kwargs = dict(traffic_type=TrafficType.UL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day, streaming=streaming)
+    expected = aggregate.get_night_traffic_by_tile_service_time_city(**kwargs).data[city]
+    scheduled = aggregate.get_night_traffic_by_tile_service_time_city(scheduler=Scheduler(backend=backend, n_jobs=2), service_batch_size=1, **kwargs).data[city]
+    assert list(scheduled.indexes['service']) == list(expected.indexes['service'])
+    np.testing.assert_allclose(scheduled.transpose(*expected.dims).values, expected.values, rtol=1e-12)
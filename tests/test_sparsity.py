@@ -0,0 +1,68 @@
+from datetime import time
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import TrafficType
+from mobile_traffic import sparsity, load, aggregate
+
+from conftest import city, service, day
+
+pytest.importorskip('sparse')
+
+
+def _get_array(density: float, seed: int = 0) -> xr.DataArray:
+    rng = np.random.default_rng(seed)
+    values = rng.random((20, 3, 4)) * (rng.random((20, 3, 4)) < density)
+    return xr.DataArray(values, dims=['tile', 'service', 'time'], coords={'tile': np.arange(20), 'service': ['a', 'b', 'c'], 'time': np.arange(4)})
+
+
+def test_storage_follows_the_density_threshold():
+    xar = _get_array(density=0.1)
+    assert sparsity.is_sparse(sparsity.to_sparse_if_sparse(xar=xar, density_threshold=0.5))
+    assert not sparsity.is_sparse(sparsity.to_sparse_if_sparse(xar=xar, density_threshold=0.01))
+    assert sparsity.to_sparse_if_sparse(xar=xar) is xar
+    np.testing.assert_array_equal(sparsity.to_dense(sparsity.to_sparse(xar)).values, xar.values)
+
+
+def test_concat_of_mixed_storage():
+    dense, sparse_ = _get_array(density=0.9, seed=1), sparsity.to_sparse(_get_array(density=0.1, seed=2))
+    expected = xr.concat([dense, sparsity.to_dense(sparse_)], dim='tile')
+    for density_threshold, is_sparse in [(0.9, True), (0.2, False), (None, False)]:
+        result = sparsity.concat([dense, sparse_], dim='tile', density_threshold=density_threshold)
+        assert sparsity.is_sparse(result) == is_sparse
+        np.testing.assert_array_equal(sparsity.to_dense(result).values, expected.values)
+
+
+def test_coo_from_slabs_matches_the_dense_cube():
+    values = _get_array(density=0.2).values
+    slabs = (((j,), values[:, :, j]) for j in range(values.shape[2]))
+    np.testing.assert_array_equal(sparsity.coo_from_slabs(slabs=slabs, shape=values.shape).todense(), values)
+
+
+def test_coo_dataset_round_trip():
+    xar = _get_array(density=0.2)
+    result = sparsity.from_coo_dataset(ds=sparsity.to_coo_dataset(xar=xar))
+    assert result.dims == xar.dims and sparsity.is_sparse(result)
+    np.testing.assert_array_equal(sparsity.to_dense(result).values, xar.values)
+
+
+def test_add_keeps_sparse_storage():
+    xar_a, xar_b = sparsity.to_sparse(_get_array(density=0.1, seed=3)), _get_array(density=0.1, seed=4)
+    result = sparsity.add(xar_a=xar_a, xar_b=xar_b, density_threshold=0.5)
+    assert sparsity.is_sparse(result)
+    np.testing.assert_allclose(sparsity.to_dense(result).values, sparsity.to_dense(xar_a).values + xar_b.values)
+
+
+def test_sparse_load_and_aggregate_match_the_dense_ones(synthetic_data_dir):
+    dense = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day[:2])
+    sparse_ = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day[:2], density_threshold=1.)
+    assert sparsity.is_sparse(sparse_)
+    np.testing.assert_array_equal(sparsity.to_dense(sparse_).values, dense.values)
+    kwargs = dict(traffic_type=TrafficType.UL_AND_DL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day)
+    for streaming in [True, False]:
+        expected = aggregate.get_night_traffic_by_tile_service_time_city(streaming=streaming, **kwargs).data[city]
+        result = aggregate.get_night_traffic_by_tile_service_time_city(streaming=streaming, density_threshold=1., **kwargs).data[city]
+        assert sparsity.is_sparse(result)
+        np.testing.assert_allclose(sparsity.to_dense(result).transpose(*expected.dims).values, expected.values, rtol=1e-12)
@@ -0,0 +1,118 @@
+from datetime import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from mobile_traffic.enums import TrafficType, TrafficDataDimensions
+from mobile_traffic.aggregate import MobileTrafficDataset, get_night_traffic_by_tile_service_time_city
+from mobile_traffic import spatial, synthetic, sparsity, load
+
+from conftest import city, service, day
+
+# The synthetic grid is in Lambert-93, with 100 m tiles numbered row by row from the top left corner.
+n_rows, n_cols = synthetic.get_synthetic_grid_shape(city=city, scale=0.05)
+x0, y0 = synthetic._grid_origin
+size = synthetic._tile_size
+
+
+def _get_regions(split_x: float):
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    x1, y1 = x0 + n_cols * size, y0 + n_rows * size
+    return gpd.GeoDataFrame({'name': ['west', 'east']}, geometry=[box(x0, y0, split_x, y1), box(split_x, y0, x1, y1)], crs=2154)
+
+
+def _get_traffic_data(tile: pd.Index) -> xr.DataArray:
+    values = np.random.default_rng(0).random((len(tile), 2))
+    return xr.DataArray(values, coords={TrafficDataDimensions.TILE.value: tile, TrafficDataDimensions.SERVICE.value: ['a', 'b']}, dims=[TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value])
+
+
+def test_operator_splits_tiles_by_area(synthetic_data_dir):
+    # The split runs through the middle of column 5, so its tiles are shared half and half.
+    operator = spatial.build_tile_region_operator(tiles=spatial.load_tile_geo_data_city(city=city), regions=_get_regions(split_x=x0 + 5.5 * size).set_index('name'))
+    weights = operator.weights.toarray()
+    np.testing.assert_allclose(weights.sum(axis=0), 1, rtol=1e-6)
+    col = np.asarray(operator.tile) % n_cols
+    west = weights[list(operator.region).index('west')]
+    np.testing.assert_allclose(west[col < 5], 1, rtol=1e-6)
+    np.testing.assert_allclose(west[col == 5], 0.5, rtol=1e-4)
+    np.testing.assert_allclose(west[col > 5], 0, atol=1e-6)
+
+
+def test_operator_rolls_tiles_up_to_regions(synthetic_data_dir):
+    operator = spatial.build_tile_region_operator(tiles=spatial.load_tile_geo_data_city(city=city), regions=_get_regions(split_x=x0 + 5.5 * size).set_index('name'))
+    xar = _get_traffic_data(tile=operator.tile)
+    result = operator.apply(xar=xar)
+    assert result.dims == (TrafficDataDimensions.REGION.value, TrafficDataDimensions.SERVICE.value)
+    np.testing.assert_allclose(result.values, operator.weights.toarray() @ xar.values)
+    np.testing.assert_allclose(result.sum(TrafficDataDimensions.REGION.value).values, xar.sum(TrafficDataDimensions.TILE.value).values)
+    dataset = spatial.aggregate_tiles_to_regions(dataset=MobileTrafficDataset(data={city: xar}), operators={city: operator})
+    np.testing.assert_allclose(dataset.data[city].values, result.values)
+
+
+def test_operator_applies_to_sparse_arrays(synthetic_data_dir):
+    pytest.importorskip('sparse')
+    operator = spatial.build_tile_region_operator(tiles=spatial.load_tile_geo_data_city(city=city), regions=_get_regions(split_x=x0 + 5.5 * size).set_index('name'))
+    xar = _get_traffic_data(tile=operator.tile)
+    np.testing.assert_allclose(sparsity.to_dense(operator.apply(xar=sparsity.to_sparse(xar))).values, operator.apply(xar=xar).values)
+
+
+def test_operator_is_cached_per_region_set(synthetic_data_dir):
+    regions = _get_regions(split_x=x0 + 3 * size)
+    operator = spatial.get_tile_region_operator(city=city, regions=regions, region_set='halves', region_column='name')
+    cached = spatial.get_tile_region_operator(city=city, regions=regions, region_set='halves', region_column='name')
+    assert cached.tile.equals(operator.tile) and list(cached.region) == ['west', 'east']
+    np.testing.assert_array_equal(cached.weights.toarray(), operator.weights.toarray())
+
+
+def _get_tile(row: int, col: int) -> int:
+    return row * n_cols + col
+
+
+def _get_tile_center(row: int, col: int):
+    return x0 + (col + 0.5) * size, y0 + (n_rows - 1 - row + 0.5) * size
+
+
+def test_tiles_are_found_at_a_point(synthetic_data_dir):
+    x, y = _get_tile_center(row=2, col=3)
+    assert list(spatial.get_tiles_at_point(city=city, x=x, y=y, crs=2154)) == [_get_tile(row=2, col=3)]
+    # Query geometries are in longitude/latitude by default.
+    import geopandas as gpd
+    from shapely import Point
+    point = gpd.GeoSeries([Point(x, y)], crs=2154).to_crs(4326).iloc[0]
+    assert list(spatial.get_tiles_at_point(city=city, x=point.x, y=point.y)) == [_get_tile(row=2, col=3)]
+    assert len(spatial.get_tiles_at_point(city=city, x=x0 - size, y=y0 - size, crs=2154)) == 0
+
+
+def test_tiles_are_found_in_a_bbox_and_a_polygon(synthetic_data_dir):
+    from shapely import Polygon
+
+    bbox = (x0 + 1.2 * size, y0 + (n_rows - 2 + 0.2) * size, x0 + 2.8 * size, y0 + (n_rows - 0.2) * size)
+    expected = [_get_tile(row=0, col=1), _get_tile(row=0, col=2), _get_tile(row=1, col=1), _get_tile(row=1, col=2)]
+    assert list(spatial.get_tiles_in_bbox(city=city, bbox=bbox, crs=2154)) == expected
+    # A triangle over the same tiles that leaves out the bottom right one.
+    triangle = Polygon([(bbox[0], bbox[1]), (bbox[0], bbox[3]), (x0 + 2.5 * size, bbox[3])])
+    assert list(spatial.get_tiles_in_polygon(city=city, polygon=triangle, crs=2154)) == expected[:3]
+
+
+def test_tile_subset_is_loaded_in_the_requested_order(synthetic_data_dir):
+    tile = list(load.get_location_list(city=city)[[5, 2, 7]])
+    whole = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day[:2])
+    subset = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day[:2], tile=tile)
+    assert list(subset.indexes[TrafficDataDimensions.TILE.value]) == tile
+    np.testing.assert_array_equal(subset.values, whole.sel({TrafficDataDimensions.TILE.value: tile}).values)
+    with pytest.raises(ValueError):
+        load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day[:2], tile=tile + [-1])
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_aggregate_of_queried_tiles_is_the_restriction_of_the_whole_aggregate(synthetic_data_dir, streaming):
+    tile = list(spatial.get_tiles_in_bbox(city=city, bbox=(x0, y0, x0 + 3 * size, y0 + 4 * size), crs=2154))
+    kwargs = dict(traffic_type=TrafficType.UL_AND_DL, start_night=time(22), end_night=time(2), city=[city], service=service, day=day, streaming=streaming)
+    whole = get_night_traffic_by_tile_service_time_city(**kwargs).data[city]
+    subset = get_night_traffic_by_tile_service_time_city(tile={city: tile}, **kwargs).data[city]
+    assert list(subset.indexes[TrafficDataDimensions.TILE.value]) == tile
+    np.testing.assert_allclose(subset.values, whole.sel({TrafficDataDimensions.TILE.value: tile}).values)
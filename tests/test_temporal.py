@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mobile_traffic.enums import TrafficType, TrafficDataDimensions, ProfileKey, Backend
+from mobile_traffic.scheduler import Scheduler
+from mobile_traffic import load, temporal
+
+from conftest import city, service, day
+
+
+def _get_daily_totals():
+    traffic_data = load.load_traffic_data(traffic_type=TrafficType.UL, city=city, service=service, day=day, n_jobs=1)
+    return traffic_data, traffic_data.sum(TrafficDataDimensions.TIME.value).transpose(TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.DAY.value)
+
+
+def test_statistics_match_the_loaded_data(synthetic_data_dir):
+    statistics = [temporal.MeanProfile(by=ProfileKey.WEEKDAY_HOUR), temporal.MeanProfile(by=ProfileKey.TIME), temporal.DailyTotals(), temporal.DailyQuantiles(quantiles=(0.25, 0.5)), temporal.RollingMean(window=2)]
+    profiles = temporal.get_temporal_profiles(traffic_type=TrafficType.UL, city=city, statistics=statistics, service=service, day=day, n_jobs=1)
+    traffic_data, totals = _get_daily_totals()
+    values = traffic_data.transpose(TrafficDataDimensions.TILE.value, TrafficDataDimensions.SERVICE.value, TrafficDataDimensions.DAY.value, TrafficDataDimensions.TIME.value).values
+
+    np.testing.assert_allclose(profiles['daily_total'].values, totals.values, rtol=1e-12)
+    np.testing.assert_allclose(profiles['daily_quantiles'].values, totals.quantile(q=[0.25, 0.5], dim=TrafficDataDimensions.DAY.value).values, rtol=1e-12)
+    # The days are consecutive, so the trailing mean over 2 days is the mean of each day and the day before, when there is one.
+    rolling = np.concatenate([totals.values[..., :1], (totals.values[..., 1:] + totals.values[..., :-1]) / 2], axis=-1)
+    np.testing.assert_allclose(profiles['rolling_mean_2d'].values, rolling, rtol=1e-12)
+
+    # Each day is on a different weekday, so a weekday and hour group is the mean of the 4 slots of that hour on that day.
+    by_weekday_hour = profiles[f'mean_by_{ProfileKey.WEEKDAY_HOUR.value}']
+    hourly = values.reshape(values.shape[:3] + (24, 4)).mean(axis=-1)
+    for j, d in enumerate(day):
+        np.testing.assert_allclose(by_weekday_hour.sel({TrafficDataDimensions.WEEKDAY.value: d.weekday()}).values, hourly[:, :, j], rtol=1e-12)
+    assert np.isnan(by_weekday_hour.sel({TrafficDataDimensions.WEEKDAY.value: 6}).values).all()
+    np.testing.assert_allclose(profiles[f'mean_by_{ProfileKey.TIME.value}'].values, values.mean(axis=2), rtol=1e-12)
+
+
+def test_rolling_mean_skips_days_that_were_not_processed(synthetic_data_dir):
+    profiles = temporal.get_temporal_profiles(traffic_type=TrafficType.UL, city=city, statistics=[temporal.RollingMean(window=2)], service=service, day=[day[0], day[2]], n_jobs=1)
+    _, totals = _get_daily_totals()
+    assert list(profiles['rolling_mean_2d'].indexes[TrafficDataDimensions.DAY.value]) == list(pd.DatetimeIndex([day[0], day[2]]))
+    np.testing.assert_allclose(profiles['rolling_mean_2d'].values, totals.values[..., [0, 2]], rtol=1e-12)
+
+
+@pytest.mark.parametrize('backend', [Backend.SERIAL, Backend.THREADS])
+def test_merged_day_batches_match_a_single_pass(synthetic_data_dir, backend):
+    statistics = [temporal.MeanProfile(by=ProfileKey.HOUR), temporal.DailyQuantiles(), temporal.RollingMean(window=3)]
+    single = temporal.get_temporal_profiles(traffic_type=TrafficType.UL_AND_DL, city=city, statistics=statistics, service=service, day=day, n_jobs=1)
+    merged = temporal.get_temporal_profiles(traffic_type=TrafficType.UL_AND_DL, city=city, statistics=statistics, service=service, day=day, scheduler=Scheduler(backend=backend, n_jobs=2), n_day_batches=3)
+    assert set(merged) == set(single)
+    for name in single:
+        np.testing.assert_allclose(merged[name].values, single[name].values, rtol=1e-12)